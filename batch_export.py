@@ -0,0 +1,91 @@
+"""
+批量导出 - 线程池并行导出，由内存预算控制并发
+
+导出前先读取所有文件头，按 (尺寸, 模式, 方向) 分组调度：同一组的图片依次提交，
+按输出比例缩放的渲染计划、换算后的相对尺寸和水印图章在组内只计算一次。
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import watermark_engine
+from memory_governor import MemoryGovernor, estimate_image_bytes
+
+
+def default_workers():
+    """默认并发数"""
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+def read_header(path, options):
+    """只读取文件头，返回 (分组键, 内存估算)，分组键为 (正向尺寸, 模式, EXIF 方向)"""
+    with watermark_engine.open_image(path) as image:
+        orientation = watermark_engine.read_metadata(image)['orientation']
+        size = watermark_engine.oriented_size(image.size, orientation)
+        return (size, image.mode, orientation), estimate_image_bytes(image, options)
+
+
+def schedule_jobs(jobs, options):
+    """
+    读取文件头并按分组排序，返回 (调度后的任务, 读取失败的任务)
+
+    调度后的任务为 [(序号, 路径, 文件名, 内存估算), ...]：各组按首次出现的顺序排列，
+    组内保持原来的顺序，因此调度结果是确定的。失败的任务为 [(序号, 异常), ...]。
+    """
+    options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS, **options}
+    groups = {}
+    failed = []
+    for index, (path, name) in enumerate(jobs):
+        try:
+            key, estimate = read_header(path, options)
+        except Exception as e:
+            failed.append((index, e))
+            continue
+        groups.setdefault(key, []).append((index, path, name, estimate))
+    return [job for group in groups.values() for job in group], failed
+
+
+def export_batch(jobs, settings, options, output_dir, governor=None):
+    """
+    并行批量导出，按完成顺序逐个产出 (序号, 输出路径, 异常)
+
+    jobs 为 (路径, 文件名) 列表，序号始终是任务在 jobs 中的位置（{index} 占位符
+    也按它编号）。任务按 schedule_jobs 的分组顺序提交，只有内存预算允许时
+    才会启动下一个任务，预算不足时降低并发等待已有任务完成。
+    """
+    options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS, **options}
+    max_workers = options['max_workers'] or default_workers()
+    if governor is None:
+        governor = MemoryGovernor(options['memory_budget'])
+
+    scheduled, failed = schedule_jobs(jobs, options)
+    for index, error in failed:
+        yield index, None, error
+
+    pending = deque(scheduled)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            # 在预算和并发数允许的范围内提交任务
+            while pending and len(running) < max_workers:
+                index, path, name, estimate = pending[0]
+                if not governor.try_admit(name, estimate):
+                    break
+                pending.popleft()
+                future = pool.submit(watermark_engine.export_file, path, name,
+                                     settings, options, output_dir, index + 1)
+                running[future] = (index, estimate)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, estimate = running.pop(future)
+                governor.release(estimate)
+                try:
+                    yield index, future.result(), None
+                except Exception as e:
+                    yield index, None, e
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+性能基准测试 - 生成合成图片集，测量水印引擎和导出流程各阶段的耗时
+
+用法:
+    python benchmark.py                        # 默认图片集
+    python benchmark.py --quick                # 小尺寸快速测试
+    python benchmark.py --compare old.json     # 与之前的结果对比
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+import watermark_engine
+
+try:
+    from version import __version__
+except ImportError:
+    __version__ = "1.0.0"
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = [1, 12, 45, 100]  # 百万像素
+QUICK_SIZES = [1, 4]
+DEFAULT_MODES = ['RGB', 'RGBA', 'L', 'CMYK']
+DEFAULT_FORMATS = ['JPEG', 'PNG', 'TIFF']
+
+# 各格式支持的图片模式
+FORMAT_MODES = {
+    'JPEG': ('RGB', 'L', 'CMYK'),
+    'PNG': ('RGB', 'RGBA', 'L'),
+    'TIFF': ('RGB', 'RGBA', 'L', 'CMYK'),
+}
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'TIFF': '.tif'}
+
+BENCH_SETTINGS = {
+    'text': '© Benchmark 水印',
+    'font_size': 72,
+    'color': '#FFFFFF',
+    'opacity': 128,
+    'position': 'bottom_right',
+}
+PREVIEW_CANVAS = (860, 640)
+
+# 测试图片默认生成在当前目录下
+DEFAULT_CORPUS = "bench_images"
+
+
+def image_size_for(megapixels):
+    """按 3:2 比例计算指定像素数的图片尺寸"""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    return int(height * 1.5), height
+
+
+def create_synthetic_image(size, mode):
+    """生成带渐变和噪点的合成图片，压缩难度接近真实照片"""
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40)
+    base = Image.blend(gradient, noise, 0.3)
+    rgb = Image.merge('RGB', (base, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise))
+    if mode == 'RGBA':
+        rgb.putalpha(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+        return rgb
+    return rgb.convert(mode)
+
+
+def build_corpus(corpus_dir, sizes, modes, formats):
+    """生成合成图片集，已存在的文件直接复用"""
+    corpus_dir = Path(corpus_dir)
+    corpus_dir.mkdir(exist_ok=True)
+    cases = []
+
+    for megapixels in sizes:
+        size = image_size_for(megapixels)
+        for mode in modes:
+            image = None
+            for fmt in formats:
+                if mode not in FORMAT_MODES[fmt]:
+                    continue
+                path = corpus_dir / f"{megapixels}mp_{mode}{FORMAT_EXTENSIONS[fmt]}"
+                if not path.exists():
+                    if image is None:
+                        image = create_synthetic_image(size, mode)
+                    print(f"生成测试图片: {path}")
+                    save_params = {'quality': 90} if fmt == 'JPEG' else {}
+                    image.save(path, fmt, **save_params)
+                cases.append({
+                    'name': f"{megapixels}MP-{mode}-{fmt}",
+                    'path': str(path),
+                    'megapixels': megapixels,
+                    'mode': mode,
+                    'format': fmt,
+                })
+    return cases
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB），不支持时返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 计，macOS 以字节计
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(stages, name, func, *args, **kwargs):
+    """执行并累加一个阶段的耗时"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+    return result
+
+
+def run_case(case, repeat, output_format):
+    """在独立进程中运行一个测试用例，返回各阶段平均耗时和峰值内存"""
+    stages = {}
+    options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS, 'output_format': output_format}
+    output_dir = Path(case['path']).parent
+
+    for _ in range(repeat):
+        # 解码
+        image = timed(stages, 'decode', lambda: Image.open(case['path']))
+        timed(stages, 'decode', image.load)
+
+        # 水印引擎
+        working = image.copy()
+        timed(stages, 'apply_watermark', watermark_engine.apply_watermark,
+              working, BENCH_SETTINGS)
+
+        # 预览渲染：与界面相同，每张图片生成一次金字塔，生成耗时单独统计
+        pyramid = watermark_engine.PreviewPyramid(image)
+        timed(stages, 'preview_pyramid', pyramid.level_for,
+              watermark_engine.fit_scale(image.size, PREVIEW_CANVAS))
+        timed(stages, 'preview', watermark_engine.render_preview,
+              image, BENCH_SETTINGS, PREVIEW_CANVAS, pyramid=pyramid)
+        timed(stages, 'preview_fast', watermark_engine.render_preview,
+              image, BENCH_SETTINGS, PREVIEW_CANVAS, fast=True)
+
+        # 完整导出：渲染、编码、写入（编码参数和写出方式与 export_image 相同）
+        metadata = watermark_engine.read_metadata(image)
+        result = timed(stages, 'export_render', watermark_engine.render_export,
+                       image, BENCH_SETTINGS, options, metadata)
+        buffer = io.BytesIO()
+        encode_format, params = watermark_engine.encode_params(metadata, options, result.mode)
+        timed(stages, 'export_encode', watermark_engine.write_image,
+              result, buffer, encode_format, params)
+        output_path = output_dir / f"_bench_output{FORMAT_EXTENSIONS[output_format]}"
+        timed(stages, 'export_write', output_path.write_bytes, buffer.getvalue())
+        output_path.unlink()
+        image.close()
+
+    stages = {name: total / repeat for name, total in stages.items()}
+    return {'stages': stages, 'peak_rss_mb': peak_rss_mb()}
+
+
+def summarize(case, measured):
+    """计算吞吐量"""
+    with Image.open(case['path']) as image:
+        width, height = image.size
+    export_time = sum(measured['stages'][name] for name in
+                      ('decode', 'export_render', 'export_encode', 'export_write'))
+    megapixels = width * height / 1_000_000
+    return {
+        **case,
+        'width': width,
+        'height': height,
+        'stages': {name: round(value, 5) for name, value in measured['stages'].items()},
+        'throughput': {
+            'images_per_s': round(1 / export_time, 3),
+            'mp_per_s': round(megapixels / export_time, 2),
+        },
+        'peak_rss_mb': measured['peak_rss_mb'] and round(measured['peak_rss_mb'], 1),
+    }
+
+
+def compare_results(current, baseline_path):
+    """与之前保存的结果对比导出耗时"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {item['name']: item for item in baseline['results']}
+
+    print(f"\n与 {baseline_path}（版本 {baseline.get('version')}）对比:")
+    for item in current['results']:
+        old = previous.get(item['name'])
+        if not old:
+            continue
+        ratio = old['throughput']['mp_per_s'] / item['throughput']['mp_per_s']
+        flag = "  ⚠️ 变慢" if ratio > 1.1 else ""
+        print(f"  {item['name']:<20} {old['throughput']['mp_per_s']:>8.1f} -> "
+              f"{item['throughput']['mp_per_s']:>8.1f} MP/s{flag}")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="图片水印工具性能基准测试")
+    parser.add_argument('--sizes', type=float, nargs='+', help="图片尺寸（百万像素）")
+    parser.add_argument('--modes', nargs='+', default=DEFAULT_MODES, help="图片模式")
+    parser.add_argument('--formats', nargs='+', default=DEFAULT_FORMATS, help="输入格式")
+    parser.add_argument('--output-format', default='JPEG', choices=['JPEG', 'PNG', 'TIFF'],
+                        help="导出格式")
+    parser.add_argument('--repeat', type=int, default=3, help="每个用例的重复次数")
+    parser.add_argument('--quick', action='store_true', help="只测试小尺寸图片")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="测试图片目录")
+    parser.add_argument('--output', default=f"bench_results_{__version__}.json",
+                        help="结果 JSON 文件")
+    parser.add_argument('--compare', help="用于对比的历史结果 JSON 文件")
+    args = parser.parse_args()
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    sizes = [int(s) if float(s).is_integer() else s for s in sizes]
+    print("=== 图片水印工具性能基准测试 ===\n")
+    cases = build_corpus(args.corpus, sizes, args.modes, args.formats)
+
+    results = []
+    for case in cases:
+        # 每个用例使用新进程，峰值内存互不影响
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            measured = pool.apply(run_case, (case, args.repeat, args.output_format))
+        item = summarize(case, measured)
+        results.append(item)
+        print(f"{item['name']:<20} {item['throughput']['images_per_s']:>7.2f} 张/秒 "
+              f"{item['throughput']['mp_per_s']:>8.1f} MP/s  峰值内存 {item['peak_rss_mb']} MB")
+
+    report = {
+        'version': __version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pillow': Image.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'output_format': args.output_format,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {args.output}")
+
+    if args.compare:
+        compare_results(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
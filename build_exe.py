@@ -45,7 +45,7 @@ a = Analysis(
         'tornado', 'zmq', 'sqlite3', 'xml', 'xmlrpc', 'unittest',
         'test', 'tests', 'distutils', 'setuptools', 'pip',
         'wheel', 'pkg_resources', 'email', 'html', 'http',
-        'urllib', 'multiprocessing', 'concurrent', 'asyncio'
+        'urllib', 'asyncio'
     ],
     win_no_prefer_redirects=False,
     win_private_assemblies=False,
@@ -365,8 +365,6 @@ def build_ultra_lite_exe():
             "--exclude-module=pip",
             "--exclude-module=wheel",
             "--exclude-module=pkg_resources",
-            "--exclude-module=multiprocessing",
-            "--exclude-module=concurrent",
             "--exclude-module=asyncio",
             "--exclude-module=socket",
             "--exclude-module=ssl",
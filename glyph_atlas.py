@@ -0,0 +1,139 @@
+"""
+字形缓存 - 按 (字体, 字号, 字符) 缓存字形遮罩，用缓存的字形拼出文本
+
+输入水印文本时每次按键只改变少数字符，拼接时绝大多数字形直接取自缓存，
+不需要重新光栅化整段文本。字形间距按字体的字距调整（kerning）计算，笔位
+取整和重叠处的合成方式与 FreeType 相同，结果与 ImageDraw.text 逐像素一致。
+
+只适用于基础排版（Pillow 未启用 libraqm）；复杂文字需要整体排版，
+由调用方回退到 ImageDraw.text。
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+import profiler
+
+# 缓存的字形数上限（每个字形是一小块灰度遮罩）
+ATLAS_SIZE = 4096
+
+# 多行文本的行间距，与 ImageDraw.multiline_text 的默认值相同
+LINE_SPACING = 4
+
+
+class GlyphAtlas:
+    """字形遮罩、排版宽度和字距调整的缓存（线程安全）"""
+
+    def __init__(self, maxsize=ATLAS_SIZE):
+        self.maxsize = maxsize
+        self._glyphs = OrderedDict()
+        self._kerning = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._glyphs.clear()
+            self._kerning.clear()
+            self.hits = self.misses = 0
+
+    def glyph(self, font, font_key, char):
+        """返回 (遮罩, 左偏移, 上偏移, 排版宽度)，空白字符的遮罩为 None"""
+        key = (font_key, char)
+        with self._lock:
+            cached = self._glyphs.get(key)
+            if cached is not None:
+                self._glyphs.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        left, top, right, bottom = font.getbbox(char)
+        mask = None
+        if right > left and bottom > top:
+            with profiler.span('watermark.glyph_render'):
+                mask = Image.new('L', (right - left, bottom - top), 0)
+                ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+        cached = (mask, left, top, font.getlength(char))
+
+        with self._lock:
+            self._glyphs[key] = cached
+            while len(self._glyphs) > self.maxsize:
+                self._glyphs.popitem(last=False)
+        return cached
+
+    def kerning(self, font, font_key, pair):
+        """两个相邻字符之间的字距调整"""
+        key = (font_key, pair)
+        value = self._kerning.get(key)
+        if value is None:
+            value = font.getlength(pair) - font.getlength(pair[0]) - font.getlength(pair[1])
+            with self._lock:
+                self._kerning[key] = value
+        return value
+
+
+_atlas = GlyphAtlas()
+
+
+def get_atlas():
+    """全局字形缓存"""
+    return _atlas
+
+
+def font_key(font):
+    """字体在缓存中的标识：字体文件（内置字体用字体名称）和字号"""
+    path = getattr(font, 'path', None)
+    return (path if isinstance(path, str) else font.getname(), font.size)
+
+
+def supports(font):
+    """是否可以用字形拼接：TrueType 字体且使用基础排版"""
+    return (isinstance(font, ImageFont.FreeTypeFont)
+            and font.layout_engine == ImageFont.Layout.BASIC)
+
+
+def render_mask(text, font, atlas=None):
+    """
+    用缓存的字形拼出文本的覆盖率遮罩
+
+    返回 (遮罩, 文本框)，文本框取自 ImageDraw.textbbox((0, 0), text)（只排版、不光栅化），
+    空白和空行对文本框的影响与 ImageDraw 完全相同；文本中没有可见字符时遮罩为 None。
+    """
+    atlas = atlas or _atlas
+    key = font_key(font)
+    line_spacing = font.getbbox("A")[3] + LINE_SPACING
+
+    placed = []
+    for line_index, line in enumerate(text.split('\n')):
+        pen = 0.0
+        previous = None
+        y = line_index * line_spacing
+        for char in line:
+            if previous is not None:
+                pen += atlas.kerning(font, key, previous + char)
+            mask, left, top, advance = atlas.glyph(font, key, char)
+            if mask is not None:
+                # 与 FreeType 的 26.6 定点取整相同：四舍五入，0.5 进位
+                placed.append((mask, math.floor(pen + 0.5) + left, y + top))
+            pen += advance
+            previous = char
+    if not placed:
+        return None, None
+
+    bbox = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+    left, top, right, bottom = bbox
+    if right <= left or bottom <= top:
+        return None, None
+
+    with profiler.span('watermark.compose'):
+        coverage = Image.new('L', (right - left, bottom - top), 0)
+        for mask, x, y in placed:
+            # 以字形为遮罩填充：重叠处按 a + b * (255 - a) / 255 叠加并四舍五入，
+            # 与 FreeType 拼接整段文本时的合成方式相同
+            coverage.paste(255, (x - left, y - top), mask)
+    return coverage, bbox
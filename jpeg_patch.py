@@ -0,0 +1,151 @@
+"""
+JPEG 局部重编码 - 只重新编码与水印相交的 MCU 块，其余 DCT 数据原样复制
+
+借助 jpegtran 的无损变换完成：先用 -crop 无损取出与图章相交、按 MCU
+对齐的区域，解码该小区域并叠加水印，用原图的量化表和采样方式重新编码，
+再用 -drop 把它无损嵌回原图。整个过程不解码完整图片，未被覆盖的区域
+没有任何质量损失。
+
+需要支持 -drop 的 jpegtran（libjpeg 9 或兼容实现）。是否支持在第一次使用时
+用两张小图实际试一次并缓存结果，不支持时不做局部重编码。执行中失败时返回
+None，由调用方回退到完整重新编码，回退记录在日志和性能诊断中。
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from PIL import Image, JpegImagePlugin
+
+import profiler
+import watermark_engine
+
+logger = logging.getLogger(__name__)
+
+# 采样方式 -> MCU 尺寸（4:4:4, 4:2:2, 4:2:0）
+MCU_SIZES = {0: (8, 8), 1: (16, 8), 2: (16, 16)}
+
+_jpegtran_path = None
+_drop_supported = None
+
+
+def find_jpegtran():
+    """查找 jpegtran 可执行文件"""
+    global _jpegtran_path
+    if _jpegtran_path is None:
+        _jpegtran_path = shutil.which('jpegtran') or ''
+    return _jpegtran_path or None
+
+
+def supports_drop():
+    """jpegtran 是否可用且支持 -drop（只检查一次）"""
+    global _drop_supported
+    if _drop_supported is None:
+        _drop_supported = find_jpegtran() is not None and _probe_drop()
+        if not _drop_supported:
+            logger.info("未找到支持 -drop 的 jpegtran，JPEG 局部重编码不可用")
+    return _drop_supported
+
+
+def _probe_drop():
+    """把一个 8x8 的小图嵌入 16x16 的小图，检查 jpegtran 能否完成 -drop"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_path = os.path.join(temp_dir, 'base.jpg')
+        patch_path = os.path.join(temp_dir, 'patch.jpg')
+        output_path = os.path.join(temp_dir, 'output.jpg')
+        Image.new('RGB', (16, 16)).save(base_path, 'JPEG', subsampling=0)
+        Image.new('RGB', (8, 8), (255, 255, 255)).save(patch_path, 'JPEG', subsampling=0)
+        try:
+            _run_jpegtran(['-copy', 'all', '-drop', '+8+8', patch_path,
+                           '-outfile', output_path, base_path])
+            with Image.open(output_path) as output:
+                return output.size == (16, 16)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+
+def can_patch(image, options):
+    """判断是否可以做局部重编码"""
+    return (options.get('jpeg_patch', False)
+            and options.get('output_format') == 'JPEG'
+            and options.get('resize_mode', 'none') == 'none'
+            and image.format == 'JPEG'
+            and image.mode == 'RGB'
+            and JpegImagePlugin.get_sampling(image) in MCU_SIZES
+            and supports_drop())
+
+
+def aligned_box(image_size, stamp_size, position, mcu_size):
+    """把图章区域向外扩展到 MCU 边界"""
+    width, height = image_size
+    mcu_width, mcu_height = mcu_size
+    x, y = position
+    left = max(0, x) // mcu_width * mcu_width
+    top = max(0, y) // mcu_height * mcu_height
+    right = min(width, -(-(x + stamp_size[0]) // mcu_width) * mcu_width)
+    bottom = min(height, -(-(y + stamp_size[1]) // mcu_height) * mcu_height)
+    return left, top, right, bottom
+
+
+def _run_jpegtran(args):
+    subprocess.run([find_jpegtran()] + args, check=True, capture_output=True)
+
+
+def export_patched(image, source_path, name, settings, options, output_dir):
+    """局部重编码导出，返回输出路径；无法完成时返回 None"""
+    output_name = watermark_engine.build_output_name(
+        name, options['naming_option'], options['naming_text'], 'JPEG')
+    output_path = os.path.join(output_dir, output_name)
+    if os.path.exists(output_path) and os.path.samefile(source_path, output_path):
+        raise ValueError("输出文件不能覆盖原图")
+
+    sampling = JpegImagePlugin.get_sampling(image)
+    # 水印按正向坐标放置，再换算到文件的原始像素方向
+    orientation = watermark_engine.read_metadata(image)['orientation']
+    display_size = watermark_engine.oriented_size(image.size, orientation)
+    plan = (settings if isinstance(settings, watermark_engine.RenderPlan)
+            else watermark_engine.compile_plan(settings))
+    # 先换算相对尺寸，后面的自动对比色要用同一个像素尺寸的计划重新渲染图章
+    plan = plan.resolved(display_size)
+    stamp, position = watermark_engine.prepare_stamp(display_size, plan)
+    stamp, (x, y) = watermark_engine.stamp_to_raw(stamp, position, display_size, orientation)
+    left, top, right, bottom = aligned_box(image.size, stamp.size, (x, y), MCU_SIZES[sampling])
+    if right <= left or bottom <= top:
+        shutil.copyfile(source_path, output_path)
+        return output_path
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=output_dir) as temp_dir:
+        region_path = os.path.join(temp_dir, 'region.jpg')
+        patch_path = os.path.join(temp_dir, 'patch.jpg')
+        try:
+            # 无损取出相交区域
+            _run_jpegtran(['-copy', 'none', '-crop',
+                           f'{right - left}x{bottom - top}+{left}+{top}',
+                           '-outfile', region_path, source_path])
+
+            with Image.open(region_path) as region:
+                patched = region.convert('RGBA')
+            # 自动对比色只需要水印区域，正好是取出的这一块（亮度与方向无关）
+            box = (x - left, y - top, x - left + stamp.width, y - top + stamp.height)
+            contrasted = watermark_engine.contrast_plan(plan, patched, box)
+            if contrasted is not plan:
+                stamp, _ = watermark_engine.stamp_to_raw(contrasted.stamp[0], position,
+                                                         display_size, orientation)
+            watermark_engine.composite_stamp(patched, stamp, x - left, y - top)
+            patched.convert('RGB').save(patch_path, 'JPEG', qtables=image.quantization,
+                                        subsampling=sampling)
+
+            # 无损嵌回原图
+            _run_jpegtran(['-copy', 'all', '-drop', f'+{left}+{top}', patch_path,
+                           '-outfile', output_path, source_path])
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("JPEG 局部重编码 %s 失败，回退到完整重新编码: %s", name, e)
+            if profiler.enabled:
+                profiler.record('jpeg_patch.fallback', start, time.perf_counter() - start)
+            return None
+
+    return output_path
@@ -0,0 +1,230 @@
+"""
+内存预算控制 - 根据文件头估算每个导出任务的峰值内存，只在预算内放行
+"""
+
+import os
+import sys
+import threading
+
+import watermark_engine
+
+# 无法检测物理内存时使用的默认预算
+FALLBACK_BUDGET = 1024 * 1024 * 1024
+
+# 分块导出只持有缓冲区、单个条带和图章附近的区域，按固定开销估算
+TILED_EXPORT_BYTES = 64 * 1024 * 1024
+
+# 解码器、编码器的工作缓冲区和图章等小对象，每个完整导出任务按固定开销另加
+CODEC_BYTES = 16 * 1024 * 1024
+
+# resize_for_export 可以直接缩小的模式，其他模式先转换为 RGBA
+RESIZE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK')
+
+
+def detect_physical_memory():
+    """检测物理内存大小（字节），失败时返回 None"""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [
+                    ('dwLength', ctypes.c_ulong),
+                    ('dwMemoryLoad', ctypes.c_ulong),
+                    ('ullTotalPhys', ctypes.c_ulonglong),
+                    ('ullAvailPhys', ctypes.c_ulonglong),
+                    ('ullTotalPageFile', ctypes.c_ulonglong),
+                    ('ullAvailPageFile', ctypes.c_ulonglong),
+                    ('ullTotalVirtual', ctypes.c_ulonglong),
+                    ('ullAvailVirtual', ctypes.c_ulonglong),
+                    ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+                ]
+
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return int(status.ullTotalPhys)
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_budget():
+    """默认预算：物理内存的一半"""
+    total = detect_physical_memory()
+    return total // 2 if total else FALLBACK_BUDGET
+
+
+def pixel_bytes(mode):
+    """Pillow 内部每个像素占用的字节数（多通道图片按 4 字节存储）"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def _area(size):
+    return size[0] * size[1]
+
+
+def _scale_bytes(size, target, bytes_per_pixel):
+    """
+    缩放新产生的图片：与 downscale() 相同，缩小时先 reduce() 整数倍缩小，再精确缩放
+
+    精确缩放先水平、后垂直各做一遍，中间结果为目标宽度 x 原高度。
+    """
+    total = 0
+    if target[0] < size[0] and target[1] < size[1]:
+        factor = min(size[0] // target[0], size[1] // target[1])
+        if factor >= 2:
+            size = (size[0] // factor, size[1] // factor)
+            total += _area(size) * bytes_per_pixel
+    if tuple(size) != tuple(target):
+        if size[0] != target[0] and size[1] != target[1]:
+            total += target[0] * size[1] * bytes_per_pixel
+        total += _area(target) * bytes_per_pixel
+    return total
+
+
+def _resize_bytes(size, mode, target):
+    """
+    resize_for_export 新产生的图片，返回 (字节数, 缩放后的模式)
+
+    不支持直接缩小的模式先转换为 RGBA（与原图同样大小）。
+    """
+    total = 0
+    if target[0] < size[0] and target[1] < size[1] and mode not in RESIZE_MODES:
+        mode = 'RGBA'
+        total += _area(size) * pixel_bytes(mode)
+    return total + _scale_bytes(size, target, pixel_bytes(mode)), mode
+
+
+def estimate_export_bytes(size, mode, options, orientation=1):
+    """
+    估算一次导出的峰值内存
+
+    按流水线产生的图片副本累加（按全部同时存在估算，宁多勿少）：解码后的原图，
+    缩放时的格式转换、reduce() 和两遍重采样的中间结果、缩放结果，按 EXIF
+    方向转正的副本，加水印的 RGBA 副本，以及 JPEG 去除透明通道时的 RGB 副本。多规格输出时
+    原图和最大一级只计算一次，之后每一级由上一级缩小得到。
+    """
+    options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS, **options}
+    display_size = watermark_engine.oriented_size(size, orientation)
+    total = CODEC_BYTES + _area(size) * pixel_bytes(mode)
+
+    if options['renditions']:
+        specs = watermark_engine.rendition_options(options)
+        targets = sorted(((watermark_engine.compute_resize_target(
+            display_size, spec['resize_mode'], spec['resize_value']) or display_size, spec)
+            for spec in specs), key=lambda item: _area(item[0]), reverse=True)
+    else:
+        target = watermark_engine.compute_resize_target(
+            display_size, options['resize_mode'], options['resize_value'])
+        targets = [(target or display_size, options)]
+
+    # 最大的输出尺寸：缩放后转正
+    largest = targets[0][0]
+    if largest != display_size:
+        resized, mode = _resize_bytes(size, mode,
+                                      watermark_engine.oriented_size(largest, orientation))
+        total += resized
+    if orientation != 1:
+        total += _area(largest) * pixel_bytes(mode)
+    if options['renditions'] and mode not in RESIZE_MODES:
+        # 多规格输出的各级都从 RGBA 图片缩小
+        mode = 'RGBA'
+        total += _area(largest) * pixel_bytes(mode)
+
+    level = largest
+    for target, spec in targets:
+        if target != level:
+            total += _scale_bytes(level, target, pixel_bytes(mode))
+            level = target
+        # 加水印的 RGBA 副本（RGBA 图片先复制一份再就地叠加），JPEG 另有
+        # RGB 副本和合成时取出的透明通道
+        total += _area(target) * 4
+        if spec['output_format'] == 'JPEG':
+            total += _area(target) * 5
+    return total
+
+
+def estimate_image_bytes(image, options):
+    """
+    按已打开（未解码）的图片估算导出任务的峰值内存
+
+    分块导出不会回退到完整解码，按固定开销计算。JPEG 局部重编码在 jpegtran
+    失败时会回退到完整重新编码，仍按完整导出估算。
+    """
+    import tiled_export
+
+    if not options['renditions'] and tiled_export.should_export_tiled(image, options):
+        return TILED_EXPORT_BYTES
+    orientation = watermark_engine.read_metadata(image)['orientation']
+    total = estimate_export_bytes(image.size, image.mode, options, orientation)
+    if image.format == 'TIFF' and tiled_export.raw_orientation(image) != 1:
+        # Pillow 解码 TIFF 时就地转正，转置过程中多一份原图大小的副本
+        total += _area(image.size) * pixel_bytes(image.mode)
+    return total
+
+
+def estimate_file_bytes(path, options):
+    """读取文件头估算导出任务的峰值内存"""
+    options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS, **options}
+    with watermark_engine.open_image(path) as image:
+        return estimate_image_bytes(image, options)
+
+
+class MemoryGovernor:
+    """按内存预算放行任务的准入控制器"""
+
+    def __init__(self, budget=None):
+        self.budget = budget or default_budget()
+        self.in_use = 0
+        self.running = 0
+        self.decisions = []  # 准入记录
+        self._lock = threading.Lock()
+
+    def try_admit(self, name, estimate):
+        """
+        尝试放行一个任务
+
+        预算足够时放行；单个任务超过整个预算时，只在没有其他任务运行时
+        单独放行，从而降低并发而不是直接失败。
+        """
+        with self._lock:
+            if self.in_use + estimate <= self.budget:
+                decision = 'admit'
+            elif self.running == 0:
+                decision = 'admit_alone'
+            else:
+                decision = 'wait'
+
+            self.decisions.append({
+                'name': name,
+                'estimate': estimate,
+                'in_use': self.in_use,
+                'running': self.running,
+                'decision': decision
+            })
+            if decision == 'wait':
+                return False
+
+            self.in_use += estimate
+            self.running += 1
+            return True
+
+    def release(self, estimate):
+        """任务结束后归还预算"""
+        with self._lock:
+            self.in_use -= estimate
+            self.running -= 1
+
+    def summary(self):
+        """汇总准入决策"""
+        counts = {'admit': 0, 'admit_alone': 0, 'wait': 0}
+        for decision in self.decisions:
+            counts[decision['decision']] += 1
+        return (f"内存预算 {self.budget / 1024 ** 2:.0f} MB: "
+                f"放行 {counts['admit']} 次, 单独运行 {counts['admit_alone']} 次, "
+                f"等待 {counts['wait']} 次")
@@ -0,0 +1,129 @@
+"""
+性能诊断 - 可选的分阶段计时、耗时直方图和 Chrome Trace 导出
+
+默认关闭，关闭时 span() 只返回一个空的上下文管理器，几乎没有开销。
+可以在诊断窗口中开启，或设置环境变量 WATERMARK_PROFILE=1。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+# 直方图的分桶上界（毫秒）
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# 最多保留的事件数，超出后丢弃最早的事件
+MAX_EVENTS = 200_000
+
+enabled = os.environ.get('WATERMARK_PROFILE') == '1'
+
+_events = deque(maxlen=MAX_EVENTS)
+_null_span = nullcontext()
+_origin = time.perf_counter()
+
+
+def enable():
+    """开启计时"""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """关闭计时"""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """清空已记录的事件"""
+    _events.clear()
+
+
+def record(name, start, duration):
+    """记录一个已完成的阶段（start 为 perf_counter 时间）"""
+    _events.append((name, start, duration, threading.get_ident()))
+
+
+@contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - start)
+
+
+def span(name):
+    """为一个阶段计时的上下文管理器"""
+    if not enabled:
+        return _null_span
+    return _span(name)
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def histogram(durations_ms):
+    """按 HISTOGRAM_BUCKETS 统计耗时分布，最后一个桶为超出上界的部分"""
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for value in durations_ms:
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+
+def summary():
+    """按阶段汇总：次数、总耗时、平均值、分位数和直方图（毫秒）"""
+    grouped = {}
+    for name, _, duration, _ in list(_events):
+        grouped.setdefault(name, []).append(duration * 1000)
+
+    rows = []
+    for name, durations in sorted(grouped.items()):
+        durations.sort()
+        rows.append({
+            'name': name,
+            'count': len(durations),
+            'total_ms': sum(durations),
+            'mean_ms': sum(durations) / len(durations),
+            'p50_ms': _percentile(durations, 0.5),
+            'p95_ms': _percentile(durations, 0.95),
+            'max_ms': durations[-1],
+            'histogram': histogram(durations),
+        })
+    return rows
+
+
+def chrome_trace():
+    """生成 Chrome Trace（chrome://tracing、Perfetto）格式的事件列表"""
+    pid = os.getpid()
+    return {
+        'traceEvents': [
+            {
+                'name': name,
+                'cat': name.split('.')[0],
+                'ph': 'X',
+                'ts': (start - _origin) * 1_000_000,
+                'dur': duration * 1_000_000,
+                'pid': pid,
+                'tid': tid,
+            }
+            for name, start, duration, tid in list(_events)
+        ],
+        'displayTimeUnit': 'ms',
+    }
+
+
+def dump_chrome_trace(path):
+    """把记录的事件保存为 Chrome Trace JSON 文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chrome_trace(), f)
@@ -0,0 +1,90 @@
+"""
+启动性能分析 - 记录各模块的导入耗时和首次绘制时间
+
+用法:
+    python watermark_app.py --startup-profile
+"""
+
+import builtins
+import sys
+import time
+
+FLAG = '--startup-profile'
+
+# 启动时间目标：从脚本开始执行到主窗口首次绘制（毫秒）
+STARTUP_TARGET_MS = 500
+
+_original_import = builtins.__import__
+_records = []  # (模块名, 累计耗时, 自身耗时, 嵌套深度)
+_stack = []
+_start = time.perf_counter()
+_milestones = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """只为首次导入的模块计时，自身耗时扣除嵌套导入的部分"""
+    if not level and name in sys.modules and fromlist:
+        # from 包 import 子模块：只有子模块尚未导入时才计时
+        missing = [item for item in fromlist
+                   if item != '*' and f"{name}.{item}" not in sys.modules
+                   and not hasattr(sys.modules[name], item)]
+        if missing:
+            return _record_import(f"{name}.{','.join(missing)}", name,
+                                  globals, locals, fromlist, level)
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    return _record_import(name, name, globals, locals, fromlist, level)
+
+
+def _record_import(record_name, name, globals, locals, fromlist, level):
+    """执行导入并记录累计耗时和自身耗时"""
+    _stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        _records.append((record_name, elapsed, elapsed - children, len(_stack)))
+
+
+def install(start=None):
+    """安装导入计时，start 为启动计时的起点（perf_counter）"""
+    global _start
+    if start is not None:
+        _start = start
+    builtins.__import__ = _timed_import
+
+
+def uninstall():
+    """恢复原始的导入函数"""
+    builtins.__import__ = _original_import
+
+
+def mark(name):
+    """记录一个启动里程碑（如首次绘制）"""
+    _milestones.append((name, (time.perf_counter() - _start) * 1000))
+
+
+def report(top=15):
+    """打印导入耗时明细和启动里程碑"""
+    uninstall()
+    print("\n=== 启动性能分析 ===")
+    print(f"{'模块':<32}{'累计(ms)':>10}{'自身(ms)':>10}")
+    top_level = [record for record in _records if record[3] == 0]
+    for name, cumulative, own, _ in sorted(top_level, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"{name:<32}{cumulative * 1000:>10.1f}{own * 1000:>10.1f}")
+
+    print("\n自身耗时最多的模块:")
+    for name, _, own, _ in sorted(_records, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"  {name:<30}{own * 1000:>10.1f}")
+
+    print()
+    for name, elapsed in _milestones:
+        print(f"{name}: {elapsed:.0f} ms")
+    first_paint = dict(_milestones).get('首次绘制')
+    if first_paint is not None:
+        status = "✓ 达标" if first_paint <= STARTUP_TARGET_MS else "✗ 超出目标"
+        print(f"启动目标 {STARTUP_TARGET_MS} ms: {status}")
@@ -0,0 +1,229 @@
+"""
+模板库 - 维护模板文件夹的索引，支持搜索、重命名、删除和热更新
+
+索引保存在模板文件夹的 .index.json 中，记录每个模板的名称、渲染计划摘要、
+修改时间和水印图章缩略图。刷新时只列出一次文件夹并比较文件状态，只有新增或
+修改过的模板才会重新读取，适合放在网络存储上的共享模板文件夹。
+"""
+
+import base64
+import io
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image
+
+import watermark_engine
+
+INDEX_NAME = ".index.json"
+INDEX_VERSION = 1
+
+# 缩略图的最大尺寸
+THUMBNAIL_SIZE = (160, 40)
+
+# 两次自动刷新之间的最短间隔（秒）
+DEFAULT_REFRESH_INTERVAL = 2.0
+
+# 模板名称中不允许出现的字符
+INVALID_NAME_CHARS = set('/\\:*?"<>|')
+
+
+def validate_name(name):
+    """检查模板名称，无效时抛出 ValueError"""
+    name = name.strip()
+    if (not name or name.startswith('.') or any(c in INVALID_NAME_CHARS for c in name)
+            or any(ord(c) < 32 for c in name)):
+        raise ValueError(f"无效的模板名称: {name!r}")
+    return name
+
+
+def make_thumbnail(plan):
+    """把水印图章缩小为 PNG 缩略图，返回 base64 文本（可直接用于 Tk PhotoImage）"""
+    stamp = plan.stamp[0].copy()
+    stamp.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    stamp.save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class TemplateLibrary:
+    """模板文件夹的索引，按名称 O(1) 查找，刷新时只重新读取变化的文件"""
+
+    def __init__(self, templates_dir=watermark_engine.TEMPLATES_DIR,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.templates_dir = Path(templates_dir)
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        self.entries = {}   # 名称 -> 索引项
+        self._plans = {}    # 名称 -> (渲染计划, 导出设置)，首次使用时编译
+        self._last_refresh = None
+        self._load_index()
+
+    @property
+    def index_path(self):
+        return self.templates_dir / INDEX_NAME
+
+    def _template_path(self, name):
+        return self.templates_dir / f"{name}.json"
+
+    def _load_index(self):
+        """读取上次保存的索引，索引损坏或版本不符时忽略"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.entries = index.get('templates', {})
+
+    def _save_index(self):
+        """保存索引，写入临时文件后替换，避免读到写了一半的索引"""
+        if not self.templates_dir.is_dir():
+            return
+        temp_path = self.index_path.with_name(f"{INDEX_NAME}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'templates': self.entries}, f,
+                          ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            # 只读的共享文件夹：索引只保存在内存中
+            print(f"保存模板索引失败: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def _build_entry(self, name, data, stat):
+        plan, options = watermark_engine.compile_template(data)
+        self._plans[name] = (plan, options)
+        return {
+            'name': name,
+            'key': plan.key,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'text': plan.text,
+            'data': data,
+            'thumbnail': make_thumbnail(plan),
+        }
+
+    def refresh(self, force=False):
+        """
+        增量刷新索引，返回发生变化的模板名称
+
+        未设置 force 时，距上次刷新不足 refresh_interval 秒则直接返回。
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (not force and self._last_refresh is not None
+                    and now - self._last_refresh < self.refresh_interval):
+                return set()
+            self._last_refresh = now
+
+            found = {}
+            try:
+                with os.scandir(self.templates_dir) as it:
+                    for entry in it:
+                        if (entry.name.endswith('.json') and not entry.name.startswith('.')
+                                and entry.is_file()):
+                            found[entry.name[:-5]] = entry.stat()
+            except FileNotFoundError:
+                pass
+
+            changed = set(self.entries) - set(found)
+            for name in changed:
+                del self.entries[name]
+                self._plans.pop(name, None)
+
+            for name, stat in found.items():
+                entry = self.entries.get(name)
+                if (entry is not None and entry['mtime_ns'] == stat.st_mtime_ns
+                        and entry['size'] == stat.st_size):
+                    continue
+                try:
+                    with open(self._template_path(name), 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    self.entries[name] = self._build_entry(name, data, stat)
+                except (OSError, ValueError, TypeError) as e:
+                    print(f"读取模板 {name} 失败: {e}")
+                    self.entries.pop(name, None)
+                    self._plans.pop(name, None)
+                changed.add(name)
+
+            if changed:
+                self._save_index()
+            return changed
+
+    def names(self):
+        """按名称排序的模板列表"""
+        self.refresh()
+        with self.lock:
+            return sorted(self.entries)
+
+    def search(self, query):
+        """按名称或水印文本搜索（不区分大小写），返回排序后的索引项"""
+        self.refresh()
+        query = query.strip().casefold()
+        with self.lock:
+            return [self.entries[name] for name in sorted(self.entries)
+                    if query in name.casefold() or query in self.entries[name]['text'].casefold()]
+
+    def get(self, name):
+        """返回模板的索引项，不存在时抛出 KeyError"""
+        self.refresh()
+        with self.lock:
+            return self.entries[name]
+
+    def load(self, name):
+        """返回 (渲染计划, 导出设置)，不存在时抛出 KeyError"""
+        entry = self.get(name)
+        with self.lock:
+            compiled = self._plans.get(name)
+            if compiled is None or compiled[0].key != entry['key']:
+                compiled = watermark_engine.compile_template(entry['data'])
+                self._plans[name] = compiled
+            plan, options = compiled
+            return plan, dict(options)
+
+    def save(self, name, template_data):
+        """保存模板并更新索引"""
+        name = validate_name(name)
+        with self.lock:
+            self.templates_dir.mkdir(parents=True, exist_ok=True)
+            path = self._template_path(name)
+            temp_path = path.with_name(f".{name}.{os.getpid()}.tmp")
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(template_data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+            self.entries[name] = self._build_entry(name, template_data, path.stat())
+            self._save_index()
+        return name
+
+    def delete(self, name):
+        """删除模板"""
+        with self.lock:
+            self._template_path(name).unlink()
+            self.entries.pop(name, None)
+            self._plans.pop(name, None)
+            self._save_index()
+
+    def rename(self, old_name, new_name):
+        """重命名模板，新名称已存在时抛出 FileExistsError"""
+        new_name = validate_name(new_name)
+        with self.lock:
+            new_path = self._template_path(new_name)
+            if new_path.exists():
+                raise FileExistsError(f"模板 '{new_name}' 已存在")
+            self._template_path(old_name).rename(new_path)
+            entry = self.entries.pop(old_name, None)
+            compiled = self._plans.pop(old_name, None)
+            if entry is not None:
+                # 重命名不改变修改时间，索引项可以直接沿用
+                self.entries[new_name] = {**entry, 'name': new_name}
+            if compiled is not None:
+                self._plans[new_name] = compiled
+            self._save_index()
+        return new_name
@@ -82,6 +82,1062 @@ def test_basic_functionality():
         print(f"✗ 测试失败: {e}")
         return False
 
+def test_export_resize():
+    """测试导出缩放：先缩小再按输出尺寸渲染水印"""
+    import tempfile
+    from PIL import ImageChops
+    import watermark_engine
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        source_path = os.path.join(output_dir, "source.jpg")
+        Image.new('RGB', (1600, 1200), (100, 100, 255)).save(source_path, "JPEG")
+
+        settings = {'text': 'wm', 'font_size': 80, 'position': 'bottom_right'}
+        options = {'output_format': 'JPEG', 'resize_mode': 'width', 'resize_value': 400}
+        with Image.open(source_path) as image:
+            output_path = watermark_engine.export_image(image, "source.jpg", settings,
+                                                        options, output_dir)
+
+        with Image.open(output_path) as result:
+            assert result.size == (400, 300)
+        assert watermark_engine.compute_resize_target((1600, 1200), 'percent', 50) == (800, 600)
+        assert watermark_engine.compute_resize_target((1600, 1200), 'none', 50) is None
+
+        # 设置字典和渲染计划两条导出路径缩放后的阴影一致（阴影参数使用默认值）
+        source_path = os.path.join(output_dir, "shadow.png")
+        Image.new('RGB', (2000, 1500), (90, 120, 150)).save(source_path)
+        settings = {'text': 'Shadow', 'font_size': 160, 'color': '#FFFFFF',
+                    'opacity': 255, 'shadow': True}
+        options = {'output_format': 'PNG', 'resize_mode': 'percent', 'resize_value': 25,
+                   'naming_option': 'prefix'}
+        results = []
+        for prefix, source in (("dict_", settings),
+                               ("plan_", watermark_engine.compile_plan(settings))):
+            options['naming_text'] = prefix
+            with Image.open(source_path) as image:
+                output_path = watermark_engine.export_image(image, "shadow.png", source,
+                                                            options, output_dir)
+            with Image.open(output_path) as result:
+                results.append(result.convert('RGB'))
+        assert results[0].size == (500, 375)
+        assert ImageChops.difference(*results).getbbox() is None
+    print("✓ 导出缩放正常")
+
+def test_tiled_export():
+    """测试超大 TIFF 分块导出与完整渲染结果一致"""
+    import tempfile
+    from PIL import ImageChops
+    import watermark_engine
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        source_path = os.path.join(output_dir, "source.tif")
+        Image.linear_gradient('L').resize((600, 400)).convert('RGB').save(source_path, "TIFF")
+
+        settings = {'text': 'wm', 'font_size': 60, 'position': 'bottom_right'}
+        options = {'output_format': 'TIFF', 'tiled_threshold': 0}
+        output_path = watermark_engine.export_file(source_path, "source.tif", settings,
+                                                   options, output_dir)
+
+        with Image.open(source_path) as source:
+            expected = watermark_engine.apply_watermark(source, settings).convert('RGB')
+        with Image.open(output_path) as result:
+            assert ImageChops.difference(result.convert('RGB'), expected).getbbox() is None
+
+        # LZW、Deflate 压缩（带预测器）的多条带 TIFF 逐条带改写，结果与完整渲染一致
+        noise = Image.effect_noise((600, 400), 40).convert('RGB')
+        for compression in ('tiff_lzw', 'tiff_adobe_deflate'):
+            path = os.path.join(output_dir, f"{compression}.tif")
+            noise.save(path, "TIFF", compression=compression, tiffinfo={317: 2},
+                       strip_size=20000)
+            output_path = watermark_engine.export_file(path, f"{compression}.tif", settings,
+                                                       options, output_dir)
+            expected = watermark_engine.apply_watermark(noise.copy(), settings).convert('RGB')
+            with Image.open(output_path) as result:
+                assert result.info['compression'] == compression
+                assert len(result.tag_v2[273]) > 1
+                assert ImageChops.difference(result.convert('RGB'), expected).getbbox() is None
+
+        # 不能逐条带重新编码的压缩方式明确报错，而不是悄悄完整解码
+        jpeg_path = os.path.join(output_dir, "jpeg.tif")
+        noise.save(jpeg_path, "TIFF", compression='jpeg')
+        try:
+            watermark_engine.export_file(jpeg_path, "jpeg.tif", settings, options, output_dir)
+        except ValueError as e:
+            assert "jpeg" in str(e)
+        else:
+            raise AssertionError("JPEG 压缩的 TIFF 不应回退到完整解码")
+        watermark_engine.export_file(jpeg_path, "jpeg.tif", settings,
+                                     {**options, 'tiled_threshold': 10 ** 9}, output_dir)
+    print("✓ 分块导出正常")
+
+def test_pixel_limit():
+    """测试像素上限策略：超过 Pillow 默认上限的 TIFF 解码时不再被全局检查拦截"""
+    import tempfile
+    import watermark_engine
+
+    previous_limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = 10_000  # 把 Pillow 的默认上限调小，模拟超大 TIFF
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            source_path = os.path.join(output_dir, "huge.tif")
+            Image.new('RGB', (300, 200), (40, 50, 60)).save(source_path, "TIFF")
+
+            for max_pixels in (None, 100_000):
+                options = {'output_format': 'PNG', 'max_pixels': max_pixels}
+                output_path = watermark_engine.export_file(source_path, "huge.tif",
+                                                           {'text': 'wm'}, options, output_dir)
+                with open(source_path, 'rb') as f:
+                    watermark_engine.watermark_bytes(f.read(), {'text': 'wm'}, options)
+            assert os.path.basename(output_path) == "huge_watermarked.png"
+
+            try:
+                watermark_engine.export_file(source_path, "huge.tif", {'text': 'wm'},
+                                             {'max_pixels': 50_000}, output_dir)
+            except Image.DecompressionBombError:
+                pass
+            else:
+                raise AssertionError("超过 max_pixels 的图片应被拒绝")
+        assert Image.MAX_IMAGE_PIXELS == 10_000
+    finally:
+        Image.MAX_IMAGE_PIXELS = previous_limit
+    print("✓ 像素上限策略正常")
+
+def test_memory_governor():
+    """测试内存预算控制：超出预算时等待，超大任务单独运行，估算包含中间副本"""
+    import io
+    import watermark_engine
+    from memory_governor import MemoryGovernor
+
+    governor = MemoryGovernor(budget=100)
+    assert governor.try_admit("a", 60)
+    assert not governor.try_admit("b", 60)
+    governor.release(60)
+    assert governor.try_admit("huge", 500)
+    assert [d['decision'] for d in governor.decisions] == ['admit', 'wait', 'admit_alone']
+
+    # 估算包含 reduce() 和两遍重采样的中间结果、转正的副本和 JPEG 的透明通道
+    import memory_governor
+    from memory_governor import CODEC_BYTES, estimate_export_bytes
+    options = {'output_format': 'JPEG', 'resize_mode': 'percent', 'resize_value': 30}
+    reduced, resampled, output = 2000 * 1333, 1800 * 1333, 1800 * 1200
+    assert estimate_export_bytes((6000, 4000), 'RGB', options) == (
+        CODEC_BYTES + 6000 * 4000 * 4 + (reduced + resampled + output) * 4 + output * 9)
+    rotated = estimate_export_bytes((4000, 6000), 'RGB', options, orientation=6)
+    assert rotated == estimate_export_bytes((4000, 6000), 'RGB', options) + output * 4
+
+    # JPEG 局部重编码可能回退到完整重新编码，按完整导出估算
+    image = Image.new('RGB', (600, 400))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG')
+    with Image.open(buffer) as image:
+        options = {**watermark_engine.DEFAULT_EXPORT_OPTIONS,
+                   'output_format': 'JPEG', 'jpeg_patch': True}
+        assert memory_governor.estimate_image_bytes(image, options) == \
+            estimate_export_bytes((600, 400), 'RGB', options)
+    print("✓ 内存预算控制正常")
+
+class _FakeVar:
+    """代替 tkinter 变量，用于在没有显示器的环境中调用界面方法"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+def test_export_all_options():
+    """测试界面批量导出：导出设置能直接用于内存预算和批量导出"""
+    import tempfile
+    from types import SimpleNamespace
+    from tkinter import filedialog
+    import watermark_app
+    from watermark_app import WatermarkApp
+
+    with tempfile.TemporaryDirectory() as folder:
+        source_path = os.path.join(folder, "photo.png")
+        Image.new('RGB', (320, 240), (20, 40, 60)).save(source_path)
+        output_dir = os.path.join(folder, "out")
+        os.makedirs(output_dir)
+
+        messages = []
+        app = SimpleNamespace(
+            images=[{'path': source_path, 'name': "photo.png"}], renditions=None,
+            output_format=_FakeVar('PNG'), naming_option=_FakeVar('suffix'),
+            naming_text=_FakeVar('_wm'), resize_mode=_FakeVar('原始尺寸'),
+            resize_value=_FakeVar(100), jpeg_patch_var=_FakeVar(False), csv_path=_FakeVar(''),
+            get_current_settings=lambda: {'text': 'wm'}, update_status=lambda text: None)
+        app.get_export_options = lambda: WatermarkApp.get_export_options(app)
+        fake_messagebox = SimpleNamespace(
+            showinfo=lambda *args: messages.append(('info',) + args),
+            showerror=lambda *args: messages.append(('error',) + args),
+            showwarning=lambda *args: messages.append(('warning',) + args))
+
+        originals = watermark_app.messagebox, filedialog.askdirectory
+        watermark_app.messagebox = fake_messagebox
+        filedialog.askdirectory = lambda **kwargs: output_dir
+        try:
+            WatermarkApp.export_all(app)
+        finally:
+            watermark_app.messagebox, filedialog.askdirectory = originals
+
+        assert [message[0] for message in messages] == ['info'], messages
+        assert os.listdir(output_dir) == ["photo_wm.png"]
+    print("✓ 界面批量导出正常")
+
+def test_batch_schedule():
+    """测试批量导出按尺寸分组调度，序号和输出不受调度顺序影响"""
+    import tempfile
+    import watermark_engine
+    from batch_export import export_batch, schedule_jobs
+
+    with tempfile.TemporaryDirectory() as folder:
+        output_dir = os.path.join(folder, "out")
+        os.makedirs(output_dir)
+        jobs = []
+        for i, size in enumerate([(400, 300), (300, 400), (400, 300), (640, 480), (300, 400)]):
+            path = os.path.join(folder, f"img_{i}.png")
+            Image.new('RGB', size, (50, 60, 70)).save(path)
+            jobs.append((path, f"img_{i}.png"))
+        jobs.append((os.path.join(folder, "missing.png"), "missing.png"))
+
+        scheduled, failed = schedule_jobs(jobs, {})
+        assert [job[0] for job in scheduled] == [0, 2, 1, 4, 3]
+        assert [index for index, _ in failed] == [5]
+
+        settings = {'text': "{index}", 'font_size': 20}
+        results = {index: (path, error) for index, path, error in
+                   export_batch(jobs, settings, {'max_workers': 1}, output_dir)}
+        assert sorted(results) == list(range(6)) and results[5][1] is not None
+        assert all(results[i][0].endswith(f"img_{i}_watermarked.png") for i in range(5))
+    print("✓ 批量导出分组调度正常")
+
+def test_renditions():
+    """测试多规格输出：一次解码输出三个文件，每个规格按自己的尺寸渲染水印"""
+    import tempfile
+    import profiler
+    import watermark_engine
+
+    template = {'text': 'wm', 'font_size': 40, 'output_format': 'JPEG', 'renditions': [
+        {'suffix': ''},
+        {'suffix': '_thumb', 'resize_mode': 'width', 'resize_value': 200, 'output_format': 'PNG'},
+        {'suffix': '_web', 'resize_mode': 'width', 'resize_value': 600, 'quality': 80},
+    ]}
+    settings, options = watermark_engine.split_template(template)
+    with tempfile.TemporaryDirectory() as folder:
+        source_path = os.path.join(folder, "photo.jpg")
+        Image.new('RGB', (1200, 800), (90, 120, 150)).save(source_path, "JPEG")
+        output_dir = os.path.join(folder, "out")
+        os.makedirs(output_dir)
+        profiler.reset()
+        profiler.enable()
+        try:
+            paths = watermark_engine.export_file(source_path, "photo.jpg", settings, options,
+                                                 output_dir)
+        finally:
+            profiler.disable()
+        orients = [row['count'] for row in profiler.summary() if row['name'] == 'export.orient']
+        profiler.reset()
+        assert orients == [1]
+        assert [os.path.basename(path) for path in paths] == [
+            "photo_watermarked.jpg", "photo_watermarked_thumb.png", "photo_watermarked_web.jpg"]
+        sizes = []
+        for path in paths:
+            with Image.open(path) as result:
+                sizes.append(result.size)
+                # 每个规格的水印都在图片中心，按比例缩放
+                assert result.convert('RGB').getpixel((result.width // 2, result.height // 2)) \
+                    != (90, 120, 150)
+        assert sizes == [(1200, 800), (200, 133), (600, 400)]
+
+        # 两个规格输出到同一文件时不写任何文件
+        duplicate_dir = os.path.join(folder, "duplicate")
+        os.makedirs(duplicate_dir)
+        options['renditions'] = [{'suffix': '_web', 'resize_mode': 'width', 'resize_value': 600},
+                                 {'suffix': '_web', 'resize_mode': 'width', 'resize_value': 200}]
+        try:
+            watermark_engine.export_file(source_path, "photo.jpg", settings, options,
+                                         duplicate_dir)
+            assert False, "重复的输出文件应当报错"
+        except ValueError as e:
+            assert "photo_watermarked_web.jpg" in str(e)
+        assert os.listdir(duplicate_dir) == []
+    print("✓ 多规格输出正常")
+
+def test_jpeg_patch_box():
+    """测试 JPEG 局部重编码区域按 MCU 对齐"""
+    from jpeg_patch import aligned_box
+
+    assert aligned_box((1000, 800), (150, 50), (837, 737), (16, 16)) == (832, 736, 992, 800)
+    assert aligned_box((1000, 800), (10, 10), (3, 3), (8, 8)) == (0, 0, 16, 16)
+    print("✓ JPEG 局部重编码区域正常")
+
+def test_jpeg_patch_relative_contrast():
+    """测试 JPEG 局部重编码：相对尺寸和自动对比色下的图章与完整导出一致"""
+    import re
+    import tempfile
+    from PIL import ImageChops
+    import jpeg_patch
+    import watermark_engine
+
+    def fake_jpegtran(args):
+        # 用 Pillow 模拟 jpegtran 的 -crop 和 -drop（测试环境不一定装有 jpegtran）
+        if '-crop' in args:
+            width, height, left, top = (int(v) for v in re.split(
+                '[x+]', args[args.index('-crop') + 1]))
+            with Image.open(args[-1]) as source:
+                source.crop((left, top, left + width, top + height)).save(
+                    args[args.index('-outfile') + 1], 'JPEG', quality=100)
+        else:
+            left, top = (int(v) for v in args[args.index('-drop') + 1].split('+')[1:])
+            patch_path = args[args.index('-drop') + 2]
+            with Image.open(args[-1]) as source, Image.open(patch_path) as patch:
+                source = source.copy()
+                source.paste(patch, (left, top))
+                source.save(args[args.index('-outfile') + 1], 'JPEG', quality=100)
+
+    settings = {'text': 'wm', 'color': '#808080', 'opacity': 255, 'auto_contrast': True,
+                'relative': True, 'relative_font_size': 0.1, 'position': 'bottom_right'}
+    original_run, original_find = jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran
+    original_supported = jpeg_patch._drop_supported
+    jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran = fake_jpegtran, lambda: 'jpegtran'
+    jpeg_patch._drop_supported = None
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            source_path = os.path.join(output_dir, "photo.jpg")
+            Image.new('RGB', (2400, 1600), (128, 128, 128)).save(source_path, "JPEG")
+            options = {'output_format': 'JPEG', 'jpeg_patch': True}
+            output_path = watermark_engine.export_file(source_path, "photo.jpg", settings,
+                                                       options, output_dir)
+            with Image.open(source_path) as source, Image.open(output_path) as result:
+                expected = watermark_engine.apply_watermark(source.copy(), settings)
+                patched_box = ImageChops.difference(source, result).getbbox()
+                expected_box = ImageChops.difference(source, expected.convert('RGB')).getbbox()
+    finally:
+        jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran = original_run, original_find
+        jpeg_patch._drop_supported = original_supported
+
+    # 图章按换算后的字号（短边的 10%）渲染，并改用了对比色
+    assert expected_box[2] - expected_box[0] > 150
+    assert all(abs(a - b) <= 16 for a, b in zip(patched_box, expected_box))
+    print("✓ JPEG 局部重编码相对尺寸正常")
+
+def test_jpeg_patch_without_drop():
+    """测试 jpegtran 不支持 -drop 时只探测一次，直接完整重新编码"""
+    import subprocess
+    import tempfile
+    import jpeg_patch
+    import watermark_engine
+
+    calls = []
+
+    def fake_jpegtran(args):
+        # 模拟不支持 -drop 的 jpegtran 版本
+        calls.append(args)
+        if '-drop' in args:
+            raise subprocess.CalledProcessError(1, ['jpegtran'] + args)
+
+    original_run, original_find = jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran
+    original_supported = jpeg_patch._drop_supported
+    jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran = fake_jpegtran, lambda: 'jpegtran'
+    jpeg_patch._drop_supported = None
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            options = {'output_format': 'JPEG', 'jpeg_patch': True}
+            for index in range(3):
+                source_path = os.path.join(output_dir, f"photo{index}.jpg")
+                Image.new('RGB', (640, 480), (90, 90, 90)).save(source_path, "JPEG")
+                output_path = watermark_engine.export_file(
+                    source_path, f"photo{index}.jpg", {'text': 'wm'}, options, output_dir)
+                with Image.open(output_path) as result:
+                    assert result.size == (640, 480)
+    finally:
+        jpeg_patch._run_jpegtran, jpeg_patch.find_jpegtran = original_run, original_find
+        jpeg_patch._drop_supported = original_supported
+
+    # 只有一次探测，之后不再裁剪
+    assert len(calls) == 1 and '-drop' in calls[0]
+    assert not any('-crop' in args for args in calls)
+    print("✓ 不支持 -drop 时回退正常")
+
+def test_export_orientation_metadata():
+    """测试导出时按 EXIF 方向转正，并保留 EXIF 和 ICC 配置"""
+    import tempfile
+    from PIL import ImageCms
+    import watermark_engine
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        source_path = os.path.join(output_dir, "portrait.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        Image.new('RGB', (600, 400), (30, 60, 90)).save(
+            source_path, "JPEG", exif=exif.tobytes(), icc_profile=icc_profile)
+
+        output_path = watermark_engine.export_file(source_path, "portrait.jpg", {'text': 'wm'},
+                                                   {'output_format': 'JPEG'}, output_dir)
+        with Image.open(output_path) as result:
+            assert result.size == (400, 600)
+            assert result.getexif()[0x0112] == 1
+            assert result.info.get('icc_profile') == icc_profile
+    print("✓ 方向与元数据保留正常")
+
+def test_tiff_orientation():
+    """测试 TIFF 方向只转一次：普通导出、分块导出和批量分组都按正向尺寸处理"""
+    import tempfile
+    import watermark_engine
+    from PIL import ImageChops
+    from batch_export import read_header
+
+    settings = {'text': 'wm', 'position': 'bottom_right', 'x_offset': -30}
+    with tempfile.TemporaryDirectory() as folder:
+        source_path = os.path.join(folder, "portrait.tif")
+        Image.new('RGB', (800, 600), (30, 60, 90)).save(source_path, tiffinfo={0x0112: 6})
+        with Image.open(source_path) as image:
+            image.load()
+            upright = image.convert('RGB')
+        assert upright.size == (600, 800)
+        key, _ = read_header(source_path, watermark_engine.DEFAULT_EXPORT_OPTIONS)
+        assert key == ((600, 800), 'RGB', 1)
+
+        results = []
+        for name, threshold in (("full", 10 ** 12), ("tiled", 0)):
+            output_dir = os.path.join(folder, name)
+            os.makedirs(output_dir)
+            output_path = watermark_engine.export_file(
+                source_path, "portrait.tif", settings,
+                {'output_format': 'TIFF', 'tiled_threshold': threshold}, output_dir)
+            with Image.open(output_path) as result:
+                results.append(result.convert('RGB'))
+        assert [result.size for result in results] == [(600, 800), (600, 800)]
+        # 分块导出改写原始方向的条带，显示效果与完整导出一致
+        assert ImageChops.difference(results[0], results[1]).getbbox() is None
+        # 水印在正向图片的右下角
+        bbox = ImageChops.difference(results[0], upright).getbbox()
+        assert bbox[0] > 300 and bbox[1] > 600
+    print("✓ TIFF 方向正常")
+
+def test_profiler_spans():
+    """测试性能诊断的分阶段计时和 Chrome Trace 输出"""
+    import profiler
+    import watermark_engine
+
+    profiler.reset()
+    watermark_engine.clear_stamp_cache()
+    profiler.enable()
+    try:
+        watermark_engine.apply_watermark(Image.new('RGB', (200, 100)), {'text': 'wm'})
+    finally:
+        profiler.disable()
+
+    names = {row['name'] for row in profiler.summary()}
+    assert {'apply_watermark', 'watermark.draw', 'watermark.composite'} <= names
+    assert all(event['ph'] == 'X' for event in profiler.chrome_trace()['traceEvents'])
+    profiler.reset()
+    print("✓ 性能诊断正常")
+
+def test_stream_api():
+    """测试内存接口：bytes、memoryview、文件对象输入，写入不可随机访问的流"""
+    import io
+    import watermark_engine
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (320, 240), (10, 20, 30)).save(buffer, "JPEG")
+    data = buffer.getvalue()
+    settings = {'text': 'wm'}
+
+    for source in (data, memoryview(data), io.BytesIO(data)):
+        result = watermark_engine.watermark_bytes(source, settings, {'output_format': 'PNG'})
+        with Image.open(io.BytesIO(result)) as image:
+            assert image.format == 'PNG' and image.size == (320, 240)
+
+    class WriteOnlyStream:
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            self.chunks.append(bytes(chunk))
+
+    stream = WriteOnlyStream()
+    assert watermark_engine.watermark_stream(data, stream, settings,
+                                             {'output_format': 'TIFF'}) == 'TIFF'
+    with Image.open(io.BytesIO(b''.join(stream.chunks))) as image:
+        assert image.format == 'TIFF' and image.size == (320, 240)
+
+    # 文本占位符与 export_file 一样按传入的文件名和序号展开
+    fields = {'text': '{filename} #{index:03d}', 'font_size': 30}
+    options = {'output_format': 'PNG'}
+    bound = watermark_engine.bind_text_fields(fields, options, "IMG_7.jpg", index=3)
+    assert bound.text == "IMG_7 #003"
+    result = watermark_engine.watermark_bytes(data, fields, options, "IMG_7.jpg", 3)
+    assert result == watermark_engine.watermark_bytes(data, bound, options)
+    # 不展开时占位符会原样画出
+    with Image.open(io.BytesIO(data)) as source:
+        literal = watermark_engine.render_export(source, watermark_engine.compile_plan(fields),
+                                                 options)
+    with Image.open(io.BytesIO(result)) as image:
+        assert image.tobytes() != literal.tobytes()
+    print("✓ 内存接口正常")
+
+def test_render_plan():
+    """测试模板编译：渲染计划可哈希、摘要稳定，渲染结果与设置字典一致"""
+    import subprocess
+    import sys
+    from PIL import ImageChops
+    import watermark_engine
+
+    template = {'text': 'wm', 'font_size': 40, 'color': '#FF8000', 'opacity': 200,
+                'position': 'bottom_right', 'output_format': 'JPEG'}
+    plan, options = watermark_engine.compile_template(template)
+    assert plan.fill == (255, 128, 0, 200) and options['output_format'] == 'JPEG'
+    assert plan == watermark_engine.compile_template(dict(template))[0]
+    assert len({plan, watermark_engine.compile_template(dict(template))[0]}) == 1
+    assert plan.key != watermark_engine.compile_plan({**template, 'text': 'other'}).key
+
+    # 摘要在不同进程中保持一致
+    code = ("import watermark_engine as w; print(w.compile_template("
+            f"{template!r})[0].key)")
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True).stdout.strip()
+    assert output == plan.key
+
+    settings = plan.settings()
+    assert watermark_engine.compile_plan(settings, options) == plan
+    image = Image.new('RGB', (400, 300), (20, 40, 60))
+    from_plan = watermark_engine.apply_watermark(image, plan)
+    from_settings = watermark_engine.apply_watermark(image, settings)
+    assert ImageChops.difference(from_plan, from_settings).getbbox() is None
+    assert watermark_engine.scale_settings(plan, 0.5).font_size == 20
+    print("✓ 模板编译正常")
+
+def test_watch_folder():
+    """测试监视文件夹（轮询）：文件稳定后才处理，已有文件跳过，处理记录随文件删除清理"""
+    import struct
+    import sys
+    import tempfile
+    import threading
+    import time
+    import watch_folder
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_dir = os.path.join(folder, "in")
+        output_dir = os.path.join(folder, "out")
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        Image.new('RGB', (64, 48)).save(os.path.join(input_dir, "old.png"))
+
+        watcher = watch_folder.FolderWatcher(
+            [input_dir], output_dir, {'text': 'wm'}, {'output_format': 'PNG'}, workers=1,
+            settle_time=0.3, poll_interval=0.02, use_inotify=False)
+        assert watcher.backend.name == "轮询"
+        watcher.mark_existing_processed()
+
+        # 刚写入的文件要保持不变一段时间才会提交
+        new_path = os.path.join(input_dir, "new.png")
+        Image.new('RGB', (64, 48), (200, 10, 10)).save(new_path)
+        watcher._note_changes(watcher.backend.wait(0))
+        watcher._submit_settled()
+        assert list(watcher.pending) == [new_path] and not watcher.running
+
+        stop_event = threading.Event()
+        thread = threading.Thread(target=watcher.run, args=(stop_event,))
+        thread.start()
+        deadline = time.monotonic() + 10
+        while watcher.stats['done'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        stop_event.set()
+        thread.join()
+
+        assert os.listdir(output_dir) == ["new_watermarked.png"]
+        assert watcher.stats['done'] == 1 and len(watcher.stats['latency']) == 1
+        assert watcher.stats['latency'].maxlen == watch_folder.LATENCY_SAMPLES
+        assert set(watcher.processed) == {new_path, os.path.join(input_dir, "old.png")}
+        os.remove(new_path)
+        watcher._prune_processed(force=True)
+        assert list(watcher.processed) == [os.path.join(input_dir, "old.png")]
+
+        # inotify 事件队列溢出时重新扫描输入文件夹
+        if sys.platform.startswith('linux'):
+            backend = watch_folder.InotifyBackend([input_dir])
+            try:
+                overflow = struct.pack('iIII', -1, watch_folder.IN_Q_OVERFLOW, 0, 0)
+                assert backend.parse_events(overflow) == [os.path.join(input_dir, "old.png")]
+            finally:
+                backend.close()
+    print("✓ 监视文件夹正常")
+
+def test_template_library():
+    """测试模板库：保存、搜索、重命名、删除，以及外部修改后的增量刷新"""
+    import json
+    import tempfile
+    from template_library import TemplateLibrary
+
+    with tempfile.TemporaryDirectory() as templates_dir:
+        library = TemplateLibrary(templates_dir, refresh_interval=0)
+        library.save("客户A", {'text': 'Studio A', 'font_size': 30})
+        library.save("客户B", {'text': 'Photo B', 'output_format': 'JPEG'})
+        assert [entry['name'] for entry in library.search("studio")] == ["客户A"]
+        assert library.get("客户A")['thumbnail']
+        plan, options = library.load("客户B")
+        assert plan.text == 'Photo B' and options['output_format'] == 'JPEG'
+
+        library.rename("客户B", "客户C")
+        library.delete("客户A")
+        assert library.names() == ["客户C"]
+
+        # 新的模板库从索引读取，文件未变化时不重新读取
+        reopened = TemplateLibrary(templates_dir, refresh_interval=0)
+        assert reopened.refresh() == set()
+        assert reopened.load("客户C")[0].key == plan.key
+
+        # 外部程序修改模板文件后自动生效
+        with open(os.path.join(templates_dir, "客户C.json"), 'w', encoding='utf-8') as f:
+            json.dump({'text': 'Changed', 'font_size': 31}, f)
+        assert reopened.refresh() == {"客户C"}
+        assert reopened.load("客户C")[0].text == 'Changed'
+    print("✓ 模板库正常")
+
+def test_text_fields():
+    """测试水印文本占位符：文件名、EXIF 日期、序号和 CSV 数据，固定片段只渲染一次"""
+    import tempfile
+    import profiler
+    import text_fields
+    import watermark_engine
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        csv_path = os.path.join(work_dir, "info.csv")
+        with open(csv_path, 'w', encoding='utf-8') as f:
+            f.write("filename,photographer\nIMG_1.jpg,张三\nIMG_2.jpg,李四\n")
+        exif = Image.Exif()
+        exif[0x8769] = {0x9003: "2024:05:01 14:30:00"}
+        image = Image.new('RGB', (400, 300))
+        image.info['exif'] = exif.tobytes()
+
+        text = "© {csv.photographer} {date} #{index:03d} {filename} {unknown}"
+        values = text_fields.collect_values(text, "IMG_1.jpg", image=image, index=7,
+                                            csv_path=csv_path)
+        runs = text_fields.expand_runs(text, values)
+        assert ''.join(runs) == "© 张三 2024-05-01 #007 IMG_1 {unknown}"
+        assert text_fields.expand_runs("{datetime:%Y年%m月}", values) == ("2024年05月",)
+        assert not text_fields.has_fields("plain {text") and text_fields.has_fields("{name}")
+
+        # 第二张图片只需要光栅化新出现的字符（李、四、2）
+        settings = {'text': "Photo by {csv.photographer} ({index})", 'font_size': 30}
+        options = {'csv_path': csv_path}
+        watermark_engine.clear_stamp_cache()
+        first = watermark_engine.bind_text_fields(settings, options, "IMG_1.jpg", index=1)
+        profiler.reset()
+        profiler.enable()
+        try:
+            second = watermark_engine.bind_text_fields(settings, options, "IMG_2.jpg", index=2)
+        finally:
+            profiler.disable()
+        renders = [row['count'] for row in profiler.summary()
+                   if row['name'] == 'watermark.glyph_render']
+        assert second.text == "Photo by 李四 (2)" and renders == [3]
+        profiler.reset()
+    print("✓ 水印文本占位符正常")
+
+def test_glyph_atlas():
+    """测试字形缓存拼接的文本与 ImageDraw.text 逐像素一致（含小字号、字距调整、重叠和多行）"""
+    import random
+    from PIL import ImageChops
+    import glyph_atlas
+    import watermark_engine
+
+    if not glyph_atlas.supports(watermark_engine.load_font(40)):
+        print("✓ 字形缓存跳过（当前字体使用复杂排版）")
+        return
+    draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+    alphabet = "AVWYTLfijlrtvwxykgq,.;:'\"-_ 水印ÅéWörld0123456789"
+    rng = random.Random(1)
+    texts = ["AVAWAY Wörld 水印", "第一行\nSecond line gy\n\n  末行", "rt ff", " 5", "yy_1Ty ",
+             "ab\n  \nc"]
+    texts += ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 14))) for _ in range(20)]
+    for font_size in list(range(9, 18)) + [24, 40]:
+        font = watermark_engine.load_font(font_size)
+        for text in texts:
+            coverage, bbox = glyph_atlas.render_mask(text, font)
+            assert bbox == draw.textbbox((0, 0), text, font=font), (font_size, text)
+            expected = Image.new('L', coverage.size, 0)
+            ImageDraw.Draw(expected).text((-bbox[0], -bbox[1]), text, fill=255, font=font)
+            assert ImageChops.difference(coverage, expected).getbbox() is None, (font_size, text)
+    print("✓ 字形缓存正常")
+
+def test_text_effects():
+    """测试阴影和描边：只在首次渲染时模糊，之后直接使用缓存的图章"""
+    import profiler
+    import watermark_engine
+
+    plain = {'text': 'Effects', 'font_size': 40, 'position': 'center'}
+    styled = {**plain, 'shadow': True, 'stroke_width': 2, 'stroke_color': '#202020'}
+    plain_plan = watermark_engine.compile_plan(plain)
+    watermark_engine.clear_stamp_cache()
+    profiler.reset()
+    profiler.enable()
+    try:
+        plan = watermark_engine.compile_plan(styled)
+        again = watermark_engine.compile_plan(dict(styled))
+    finally:
+        profiler.disable()
+    shadows = [row['count'] for row in profiler.summary() if row['name'] == 'watermark.shadow']
+    profiler.reset()
+    assert shadows == [1] and again.stamp is plan.stamp
+    assert plan.key != plain_plan.key and plan.settings()['stroke_color'] == '#202020'
+    assert watermark_engine.compile_plan(plan.settings()) == plan
+
+    # 效果扩大了图章，但文本框不变，水印位置与无效果时相同
+    stamp, text_size, _ = plan.stamp
+    plain_stamp, plain_size, _ = plain_plan.stamp
+    assert stamp.width > plain_stamp.width and stamp.height > plain_stamp.height
+    assert text_size == plain_size
+    image = Image.new('RGB', (400, 300), (200, 200, 200))
+    result = watermark_engine.apply_watermark(image, plan)
+    assert result.getpixel((200, 150)) != (200, 200, 200)
+    assert watermark_engine.scale_settings(plan, 0.25).settings()['shadow_blur'] == 1
+    print("✓ 阴影和描边正常")
+
+def test_auto_contrast():
+    """测试自动对比色：亮背景上的白色文字改为深色，只对水印区域的缩小图做统计"""
+    import profiler
+    import watermark_engine
+
+    settings = {'text': 'Sky', 'font_size': 40, 'color': '#FFFFFF', 'opacity': 255,
+                'position': 'center', 'auto_contrast': True}
+    bright = Image.new('RGB', (2000, 1500), (235, 240, 250))
+    dark = Image.new('RGB', (2000, 1500), (20, 25, 30))
+    profiler.reset()
+    profiler.enable()
+    try:
+        on_bright = watermark_engine.apply_watermark(bright, settings)
+    finally:
+        profiler.disable()
+    samples = [row['count'] for row in profiler.summary()
+               if row['name'] == 'watermark.contrast']
+    profiler.reset()
+    assert samples == [1]
+    assert on_bright.getextrema()[0][0] < 50
+    assert watermark_engine.apply_watermark(dark, settings).getextrema()[0][1] == 255
+    assert watermark_engine.apply_watermark(
+        bright, {**settings, 'auto_contrast': False}).getextrema()[0][0] == 235
+
+    # 颜色与背景的对比已经足够时保持原色
+    assert watermark_engine.contrast_color((255, 200, 0), 20) == (255, 200, 0)
+    assert watermark_engine.region_luminance(bright, (-50, -50, -1, -1)) is None
+    print("✓ 自动对比色正常")
+
+def test_auto_position():
+    """测试自动位置：在缩略图上评分，选择背景最简单的预设位置"""
+    import profiler
+    import watermark_engine
+
+    image = Image.effect_noise((1600, 1200), 80).convert('RGB')
+    image.paste((90, 140, 200), (800, 0, 1600, 600))  # 右上角是纯色天空
+    settings = {'text': 'Quiet', 'font_size': 60, 'opacity': 255, 'position': 'auto'}
+    plan = watermark_engine.compile_plan(settings)
+    profiler.reset()
+    profiler.enable()
+    try:
+        stamp, (x, y) = watermark_engine.prepare_stamp(image.size, plan, image=image)
+    finally:
+        profiler.disable()
+    placements = [row['count'] for row in profiler.summary()
+                  if row['name'] == 'watermark.placement']
+    profiler.reset()
+    assert placements == [1]
+    assert x > 800 and y + stamp.height < 600
+
+    # 没有图片可供分析时使用固定位置
+    fallback = watermark_engine.prepare_stamp(image.size, plan)[1]
+    expected = watermark_engine.prepare_stamp(image.size, {**settings, 'position': 'bottom_right'})
+    assert fallback == expected[1]
+    print("✓ 自动位置正常")
+
+def test_relative_size():
+    """测试相对尺寸：字号和偏移随图片短边变化，相近尺寸共用缓存的图章"""
+    import watermark_engine
+
+    settings = {'text': 'Rel', 'relative': True, 'relative_font_size': 0.05,
+                'relative_x_offset': -0.1, 'relative_y_offset': 0.0, 'position': 'custom'}
+    plan = watermark_engine.compile_plan(settings)
+    small = plan.resolved((640, 480))
+    large = plan.resolved((6000, 4000))
+    assert small.font_size == 24 and small.x_offset == -48
+    assert abs(large.font_size - 200) <= 200 * 0.02 and large.x_offset == -400
+    assert watermark_engine.compile_plan(plan.settings()) == plan
+    scaled = watermark_engine.scale_settings(settings, 0.5)
+    assert {key: scaled[key] for key in settings} == settings
+
+    # 尺寸各不相同的一批图片只需要少量图章
+    sizes = {plan.resolved((short * 3 // 2, short)).font_size for short in range(3000, 4000, 5)}
+    assert len(sizes) <= 10
+
+    # 导出缩小后水印仍占相同比例
+    image = Image.new('RGB', (3000, 2000), (40, 40, 40))
+    full = watermark_engine.prepare_stamp(image.size, plan)[0]
+    half = watermark_engine.render_export(image, plan, {'resize_mode': 'percent',
+                                                        'resize_value': 50})
+    assert half.size == (1500, 1000)
+    half_width = watermark_engine.prepare_stamp(half.size, plan)[0].width
+    assert abs(half_width * 2 / full.width - 1) < 0.08
+    print("✓ 相对尺寸正常")
+
+def test_fast_preview():
+    """测试快速预览和预览金字塔：尺寸和缩放比例与精细预览相同，水印位置一致"""
+    from PIL import ImageChops
+    import watermark_engine
+
+    image = Image.new('RGB', (3000, 2000), (30, 30, 30))
+    plan = watermark_engine.compile_plan({'text': 'Preview', 'font_size': 200,
+                                          'color': '#FFFFFF', 'opacity': 255})
+    fine, scale = watermark_engine.render_preview(image, plan, (900, 700))
+    fast, fast_scale = watermark_engine.render_preview(image, plan, (900, 700), fast=True)
+    assert fast.size == fine.size and fast_scale == scale
+    background = Image.new('RGB', fine.size, (30, 30, 30))
+    fine_box = ImageChops.difference(fine.convert('RGB'), background).getbbox()
+    fast_box = ImageChops.difference(fast.convert('RGB'), background).getbbox()
+    assert all(abs(a - b) <= 5 for a, b in zip(fine_box, fast_box))
+
+    # 金字塔按需生成，从不小于预览尺寸的最小一级渲染
+    pyramid = watermark_engine.PreviewPyramid(image)
+    assert pyramid.level_for(0.3)[0].size == (1500, 1000) and len(pyramid.levels) == 2
+    assert pyramid.level_for(0.2) == (pyramid.levels[2], 0.25)
+    assert pyramid.level_for(0.6)[0] is image
+    from_pyramid, _ = watermark_engine.render_preview(image, plan, (900, 700), pyramid=pyramid)
+    pyramid_box = ImageChops.difference(from_pyramid.convert('RGB'), background).getbbox()
+    assert from_pyramid.size == fine.size
+    assert all(abs(a - b) <= 3 for a, b in zip(fine_box, pyramid_box))
+    print("✓ 快速预览和预览金字塔正常")
+
+def test_viewport():
+    """测试缩放查看：只渲染可见区域，100% 时与导出图片的对应区域逐像素一致"""
+    from PIL import ImageChops
+    import watermark_engine
+
+    image = Image.effect_noise((3000, 2000), 40).convert('RGB')
+    plan = watermark_engine.compile_plan({'text': 'Zoom', 'font_size': 80,
+                                          'position': 'bottom_right', 'opacity': 200})
+    pyramid = watermark_engine.PreviewPyramid(image)
+    # 中心超出图片时向内平移
+    region, box = watermark_engine.render_viewport(image, plan, (800, 600), 1.0, (2990, 1990),
+                                                   pyramid=pyramid)
+    assert box == (2200, 1400, 3000, 2000) and region.size == (800, 600)
+    exported = watermark_engine.apply_watermark(image.copy(), plan)
+    assert ImageChops.difference(region, exported.crop(box)).getbbox() is None
+    assert len(pyramid.levels) == 1
+
+    zoomed, box = watermark_engine.render_viewport(image, plan, (800, 600), 4.0, (1500, 1000))
+    assert box == (1400, 925, 1600, 1075) and zoomed.size == (800, 600)
+    small, box = watermark_engine.render_viewport(image, plan, (800, 600), 0.2, (0, 0),
+                                                  pyramid=pyramid)
+    assert box == (0, 0, 3000, 2000) and small.size == (600, 400)
+    print("✓ 缩放查看正常")
+
+class _FakePhoto:
+    """代替 ImageTk.PhotoImage，记录 paste() 调用"""
+
+    def __init__(self, image):
+        self.size = image.size
+        self.pasted = []
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def paste(self, image):
+        self.pasted.append(image)
+
+class _FakeCanvas:
+    """代替 tk.Canvas，记录对画布项的操作"""
+
+    def __init__(self):
+        self.calls = []
+
+    def create_image(self, x, y, **kwargs):
+        self.calls.append(('create_image', x, y, kwargs))
+        return len(self.calls)
+
+    def coords(self, item, *args):
+        self.calls.append(('coords', item) + args)
+
+    def itemconfigure(self, item, **kwargs):
+        self.calls.append(('itemconfigure', item, kwargs))
+
+def test_preview_photo_reuse():
+    """测试预览图复用：尺寸不变时 paste 到原 PhotoImage，画布上始终是同一个图片项"""
+    from types import SimpleNamespace
+    from PIL import ImageTk
+    from watermark_app import WatermarkApp
+
+    created = []
+
+    def fake_photo_image(image):
+        photo = _FakePhoto(image)
+        created.append(photo)
+        return photo
+
+    app = SimpleNamespace(preview_image=None, preview_item=None, message_item=None,
+                          canvas=_FakeCanvas())
+    original = ImageTk.PhotoImage
+    ImageTk.PhotoImage = fake_photo_image
+    try:
+        WatermarkApp.show_preview_image(app, Image.new('RGB', (40, 30)), 5, 6)
+        assert len(created) == 1 and app.preview_item == 1
+        first = app.preview_image
+
+        # 尺寸不变：不创建新的 PhotoImage，也不创建新的画布项
+        frame = Image.new('RGB', (40, 30), (255, 0, 0))
+        app.canvas.calls.clear()
+        WatermarkApp.show_preview_image(app, frame, 7, 8)
+        assert len(created) == 1 and app.preview_image is first
+        assert first.pasted == [frame]
+        assert not any(call[0] == 'create_image' for call in app.canvas.calls)
+        assert ('coords', 1, 7, 8) in app.canvas.calls
+
+        # 尺寸变化：创建新的 PhotoImage，原画布项改为引用它
+        app.canvas.calls.clear()
+        WatermarkApp.show_preview_image(app, Image.new('RGB', (50, 30)), 0, 0)
+        assert len(created) == 2 and app.preview_image is created[1]
+        assert ('itemconfigure', 1, {'image': created[1]}) in app.canvas.calls
+        assert not any(call[0] == 'create_image' for call in app.canvas.calls)
+    finally:
+        ImageTk.PhotoImage = original
+    print("✓ 预览图复用正常")
+
+def test_deferred_startup():
+    """测试延迟启动：设置面板在首次绘制后的空闲回调中创建，同时预热字体"""
+    import threading
+    from types import SimpleNamespace
+    import watermark_engine
+    from watermark_app import WatermarkApp
+
+    steps = []
+    idle_callbacks = []
+    root = SimpleNamespace(title=lambda text: None, geometry=lambda size: None,
+                           minsize=lambda width, height: None,
+                           after_idle=idle_callbacks.append)
+
+    class StubApp(WatermarkApp):
+        def create_variables(self):
+            self.font_size_var = _FakeVar(48)
+
+        def load_default_settings(self):
+            steps.append('defaults')
+
+        def create_widgets(self):
+            steps.append('widgets')
+
+        def create_status_bar(self):
+            steps.append('status_bar')
+
+        def create_settings_panel(self):
+            steps.append('settings_panel')
+
+    warmed = threading.Event()
+    warmed_sizes = []
+
+    def fake_warm_up(sizes):
+        warmed_sizes.extend(sizes)
+        warmed.set()
+
+    original = watermark_engine.warm_up_fonts
+    watermark_engine.warm_up_fonts = fake_warm_up
+    try:
+        app = StubApp(root)
+        assert steps == ['defaults', 'widgets', 'status_bar']
+        assert idle_callbacks == [app.finish_startup]
+
+        idle_callbacks[0]()
+        assert steps[-1] == 'settings_panel'
+        assert warmed.wait(5) and warmed_sizes == [48]
+    finally:
+        watermark_engine.warm_up_fonts = original
+    print("✓ 延迟启动正常")
+
+def test_watermark_server():
+    """测试水印服务：参数解析、POST /watermark 和 /metrics"""
+    import http.client
+    import io
+    import json
+    import tempfile
+    import urllib.error
+    import urllib.request
+    from template_library import TemplateLibrary
+    from watermark_server import WatermarkService, parse_request_params
+
+    settings, options = parse_request_params("text=wm&font_size=20&output_format=jpeg")
+    assert settings['font_size'] == 20 and options['output_format'] == 'JPEG'
+    assert parse_request_params("shadow=on")[0]['shadow'] is True
+    assert parse_request_params("shadow=0")[0]['shadow'] is False
+    for query in ("unknown=1", "font_size=big", "output_format=GIF", "color=zz", "shadow=maybe"):
+        try:
+            parse_request_params(query)
+        except ValueError:
+            continue
+        raise AssertionError(f"参数应被拒绝: {query}")
+
+    # 模板参数只读取模板数据，不在 HTTP 线程中编译渲染计划
+    with tempfile.TemporaryDirectory() as templates_dir:
+        library = TemplateLibrary(templates_dir)
+        library.save("logo", {'text': 'tpl', 'font_size': 30, 'output_format': 'JPEG'})
+        library._plans.clear()
+        settings, options = parse_request_params("template=logo&font_size=40", library)
+        assert settings['text'] == 'tpl' and settings['font_size'] == 40
+        assert options['output_format'] == 'JPEG' and library._plans == {}
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (320, 240), (10, 20, 30)).save(buffer, "PNG")
+    service = WatermarkService(port=0, workers=1).start()
+    try:
+        request = urllib.request.Request(f"{service.url}/watermark?text=wm&output_format=JPEG",
+                                         data=buffer.getvalue(), method='POST')
+        with urllib.request.urlopen(request) as response:
+            assert response.headers['Content-Type'] == 'image/jpeg'
+            with Image.open(io.BytesIO(response.read())) as result:
+                assert result.format == 'JPEG' and result.size == (320, 240)
+        with urllib.request.urlopen(f"{service.url}/metrics") as response:
+            metrics = json.load(response)
+        assert metrics['counts']['ok'] == 1 and 'p50' in metrics['latency_ms']
+
+        # 发给工作进程的只有图片数据和请求参数，不包含渲染好的图章
+        payloads = []
+        submit = service.pool.submit
+        service.pool.submit = lambda fn, *args: payloads.append(args) or submit(fn, *args)
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        service.pool.submit = submit
+        assert [type(arg) for arg in payloads[0]] == [bytes, str, dict, dict]
+
+        # 缺少或无效的 Content-Length 返回 400
+        host, port = service.httpd.server_address[:2]
+        for length in (None, 'abc'):
+            connection = http.client.HTTPConnection(host, port)
+            connection.putrequest('POST', '/watermark?text=wm')
+            if length is not None:
+                connection.putheader('Content-Length', length)
+            connection.endheaders()
+            response = connection.getresponse()
+            assert response.status == 400 and 'Content-Length' in json.load(response)['error']
+            connection.close()
+
+        # 未预料的错误返回 JSON 格式的 500
+        def broken_submit(*args):
+            raise RuntimeError("工作进程池已损坏")
+        service.submit = broken_submit
+        try:
+            urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            assert e.code == 500 and json.load(e) == {'error': "工作进程池已损坏"}
+        else:
+            raise AssertionError("应返回 500")
+    finally:
+        service.stop()
+    print("✓ 水印服务正常")
+
 if __name__ == "__main__":
     print("开始创建测试图片...")
     create_test_images()
@@ -0,0 +1,167 @@
+"""
+水印文本占位符 - 为每张图片生成不同的水印文本
+
+支持的占位符（格式与 Python str.format 相同，{{ 和 }} 表示花括号本身）:
+    {filename}     文件名（不含扩展名）      {name}  完整文件名
+    {ext}          扩展名（不含点）
+    {index}        批量导出中的序号，从 1 开始，可写成 {index:04d}
+    {date}         拍摄日期（EXIF，没有时使用文件修改时间），默认格式 2024-05-01
+    {time}         拍摄时间，默认格式 14:30
+    {datetime}     拍摄日期和时间，可写成 {datetime:%Y年%m月%d日}
+    {csv.列名}     CSV 文件中该图片所在行的指定列
+
+CSV 文件需要有 filename（或"文件名"）列，按文件名匹配图片，没有该列时使用第一列。
+无法识别的占位符保持原样显示。
+"""
+
+import csv
+import os
+from datetime import datetime
+from string import Formatter
+
+# 日期类占位符没有指定格式时使用的格式
+DATE_FORMATS = {
+    'date': '%Y-%m-%d',
+    'time': '%H:%M',
+    'datetime': '%Y-%m-%d %H:%M',
+}
+FIELD_NAMES = {'filename', 'name', 'ext', 'index'} | set(DATE_FORMATS)
+CSV_PREFIX = 'csv.'
+CSV_KEY_COLUMNS = ('filename', '文件名')
+
+# EXIF 拍摄时间：Exif IFD 中的 DateTimeOriginal，以及 IFD0 中的 DateTime
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+DATETIME = 0x0132
+
+_sidecar_cache = {}
+
+
+def _is_known(field_name):
+    return field_name in FIELD_NAMES or (field_name.startswith(CSV_PREFIX)
+                                         and len(field_name) > len(CSV_PREFIX))
+
+
+def parse_text(text):
+    """
+    把水印文本拆分为 [(文字, 占位符名, 格式, 转换), ...]
+
+    格式不正确的文本整体视为普通文字，无法识别的占位符按原样作为文字。
+    """
+    try:
+        parsed = list(Formatter().parse(text))
+    except ValueError:
+        return [(text, None, '', None)]
+
+    parts = []
+    for literal, field_name, format_spec, conversion in parsed:
+        if field_name is not None and not _is_known(field_name):
+            # 保留原样，例如 "{abc}"
+            original = '{' + field_name + (f'!{conversion}' if conversion else '') + \
+                (f':{format_spec}' if format_spec else '') + '}'
+            literal, field_name, format_spec, conversion = literal + original, None, '', None
+        parts.append((literal, field_name, format_spec or '', conversion))
+    return parts
+
+
+def used_fields(text):
+    """文本中使用的占位符名称"""
+    return {field for _, field, _, _ in parse_text(text) if field is not None}
+
+
+def has_fields(text):
+    """文本中是否包含占位符"""
+    return '{' in text and bool(used_fields(text))
+
+
+def read_capture_time(image):
+    """读取 EXIF 拍摄时间，没有或无法解析时返回 None"""
+    if image is None:
+        return None
+    exif = image.getexif()
+    value = exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def load_sidecar(csv_path):
+    """读取 CSV 数据文件，返回 {文件名: 行}，按修改时间缓存"""
+    stat = os.stat(csv_path)
+    cached = _sidecar_cache.get(csv_path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    rows = {}
+    with open(csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        columns = reader.fieldnames or []
+        key_column = next((c for c in columns if c.strip().lower() in CSV_KEY_COLUMNS),
+                          columns[0] if columns else None)
+        for row in reader:
+            key = (row.get(key_column) or '').strip()
+            if key:
+                rows[key] = row
+                rows.setdefault(os.path.splitext(key)[0], row)
+    _sidecar_cache[csv_path] = ((stat.st_mtime_ns, stat.st_size), rows)
+    return rows
+
+
+def collect_values(text, name, path=None, image=None, index=1, csv_path=None):
+    """只计算文本中用到的占位符的值"""
+    fields = used_fields(text)
+    stem, ext = os.path.splitext(name or '')
+    values = {'filename': stem, 'name': name or '', 'ext': ext.lstrip('.'), 'index': index}
+
+    if fields & set(DATE_FORMATS):
+        captured = read_capture_time(image)
+        if captured is None and path is not None:
+            try:
+                captured = datetime.fromtimestamp(os.path.getmtime(path))
+            except OSError:
+                pass
+        for field in DATE_FORMATS:
+            values[field] = captured
+
+    csv_fields = [field for field in fields if field.startswith(CSV_PREFIX)]
+    if csv_fields:
+        row = {}
+        if csv_path:
+            sidecar = load_sidecar(csv_path)
+            row = sidecar.get(name) or sidecar.get(stem) or {}
+        for field in csv_fields:
+            values[field] = row.get(field[len(CSV_PREFIX):]) or ''
+    return values
+
+
+def _format_value(field, value, format_spec, conversion):
+    if value is None:
+        return ''
+    if field in DATE_FORMATS:
+        return value.strftime(format_spec or DATE_FORMATS[field])
+    if conversion:
+        value = Formatter().convert_field(value, conversion)
+    try:
+        return format(value, format_spec)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def expand_runs(text, values):
+    """
+    展开占位符，返回文本片段元组
+
+    固定文字和占位符的值分别作为独立片段，片段随渲染计划保存（计划摘要包含它们）。
+    渲染时片段拼接为整段文本，字形按字符缓存（见 glyph_atlas），批量导出中
+    只有新出现的字符需要光栅化。
+    """
+    runs = []
+    for literal, field, format_spec, conversion in parse_text(text):
+        if literal:
+            runs.append(literal)
+        if field is not None:
+            value = _format_value(field, values.get(field), format_spec, conversion)
+            if value:
+                runs.append(value)
+    return tuple(runs)
@@ -0,0 +1,348 @@
+"""
+超大 TIFF 分块导出 - 按条带/分块读写，内存占用与图片尺寸无关
+
+未压缩的 TIFF：先把原文件按固定大小的缓冲区流式复制到输出路径，再只读取
+与水印图章相交的条带（或分块）中的对应行段，叠加水印后按原位置写回。
+
+LZW、Deflate、PackBits 压缩的 TIFF：改写后的条带长度会变化，不能原位写回，
+改为逐个条带/分块写出新的 TIFF。与图章相交的条带单独解码、叠加水印后按原来
+的压缩方式和预测器重新编码，其余条带的压缩数据原样复制，最后写入更新了
+偏移的 IFD（只保留第一页）。
+
+两种方式都不解码整张图片，未被水印覆盖的数据原样保留，内存占用只与单个
+条带和图章的大小有关。其他压缩方式（如 JPEG）、非 8 位采样或单个条带过大
+的 TIFF 达到分块导出阈值时直接报错并说明原因，不会悄悄改为完整解码；需要
+完整解码时调高 tiled_threshold（仍受 max_pixels 限制）。
+"""
+
+import io
+import os
+import shutil
+import struct
+
+from PIL import Image, TiffImagePlugin, TiffTags
+from PIL.TiffImagePlugin import (BITSPERSAMPLE, COMPRESSION, EXTRASAMPLES, FILLORDER,
+                                 IMAGELENGTH, IMAGEWIDTH, PHOTOMETRIC_INTERPRETATION,
+                                 PLANAR_CONFIGURATION, PREDICTOR, ROWSPERSTRIP,
+                                 SAMPLEFORMAT, SAMPLESPERPIXEL, STRIPBYTECOUNTS,
+                                 STRIPOFFSETS, SUBIFD, TILEBYTECOUNTS, TILELENGTH,
+                                 TILEOFFSETS, TILEWIDTH)
+
+import watermark_engine
+
+# 支持分块导出的图片模式（原始数据格式与模式相同）
+SUPPORTED_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK')
+
+# 流式复制时的缓冲区大小
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# 可以逐个条带解码、重新编码的压缩方式（条带之间互相独立，libtiff 可以写出）
+STREAM_COMPRESSIONS = ('tiff_lzw', 'tiff_adobe_deflate', 'tiff_deflate', 'packbits')
+
+# 压缩的条带/分块解码后的最大字节数。解码结果、读入的压缩数据和重新编码的
+# 结果都不超过这个大小，合计在 memory_governor.TILED_EXPORT_BYTES 之内
+MAX_BLOCK_BYTES = 16 * 1024 * 1024
+
+# 改写后的文件使用 32 位偏移，重新编码的条带可能略微变大，留出余量
+CLASSIC_TIFF_LIMIT = 2 ** 32 - 64 * 1024 * 1024
+
+# 各模式对应的 PhotometricInterpretation，与 Pillow 写出条带时使用的一致
+PHOTOMETRIC_BY_MODE = {'L': 1, 'LA': 1, 'RGB': 2, 'RGBA': 2, 'CMYK': 5}
+
+# 解码单个条带时需要从原文件带上的标签
+BLOCK_TAGS = (BITSPERSAMPLE, COMPRESSION, PHOTOMETRIC_INTERPRETATION, SAMPLESPERPIXEL,
+              PLANAR_CONFIGURATION, PREDICTOR, EXTRASAMPLES, SAMPLEFORMAT)
+
+# 指向文件中其他位置的子 IFD，改写时重新写入
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+
+def unsupported_reason(image):
+    """返回条带/分块不能逐块读写的原因，可以分块导出时返回 None"""
+    if image.format != 'TIFF' or not image.tile:
+        return "不是 TIFF 文件"
+    if image.mode not in SUPPORTED_MODES:
+        return f"图片模式为 {image.mode}"
+
+    tags = image.tag_v2
+    bits = tags.get(BITSPERSAMPLE, (8,))
+    if isinstance(bits, int):
+        bits = (bits,)
+    if any(b != 8 for b in bits):
+        return "不是 8 位采样"
+    if tags.get(PLANAR_CONFIGURATION, 1) != 1:
+        return "按通道分平面存储"
+
+    compression = image.info.get('compression', 'raw')
+    if compression == 'raw':
+        for tile in image.tile:
+            codec, args = tile[0], tile[3]
+            if codec != 'raw' or args[0] != image.mode or (len(args) > 2 and args[2] != 1):
+                return "像素行的存储格式与图片模式不一致"
+        return None
+
+    if compression not in STREAM_COMPRESSIONS:
+        return f"使用了 {compression} 压缩"
+    if (tags.get(PHOTOMETRIC_INTERPRETATION) != PHOTOMETRIC_BY_MODE[image.mode]
+            or tags.get(FILLORDER, 1) != 1):
+        return "像素的存储格式与图片模式不一致"
+    if image.mode.endswith('A') and tags.get(EXTRASAMPLES) not in (2, (2,)):
+        return "透明通道为预乘格式"
+    bands = len(image.getbands())
+    if max(width * height * bands for _, (width, height), _, _ in _block_layout(image)) \
+            > MAX_BLOCK_BYTES:
+        return "单个条带过大"
+    if image.filename and os.path.getsize(image.filename) > CLASSIC_TIFF_LIMIT:
+        return "文件超过 4 GB"
+    return None
+
+
+def can_export_tiled(image):
+    """判断图片的条带/分块能否按偏移直接读写"""
+    return unsupported_reason(image) is None
+
+
+def check_tiled_layout(image):
+    """需要分块导出的图片不支持分块读写时抛出 ValueError，而不是悄悄改为完整解码"""
+    reason = unsupported_reason(image)
+    if reason is not None:
+        raise ValueError(
+            f"该 TIFF {reason}，分块导出只支持 8 位、交错存储，未压缩或 LZW、Deflate、"
+            f"PackBits 压缩的 TIFF。请先转换格式，或调高 tiled_threshold 改用完整解码导出"
+            f"（受 max_pixels 限制）")
+
+
+def raw_orientation(image):
+    """读取 TIFF 的方向标签（Pillow 解码时会自动转正，read_metadata 按 1 返回）"""
+    orientation = image.tag_v2.get(watermark_engine.ORIENTATION_TAG, 1)
+    return orientation if orientation in watermark_engine.ORIENTATION_TRANSPOSE else 1
+
+
+def wants_tiled(image, options):
+    """该 TIFF 是否达到分块导出的条件（输出 TIFF、不缩放、像素数达到阈值）"""
+    return (image.format == 'TIFF'
+            and options.get('output_format') == 'TIFF'
+            and options.get('resize_mode', 'none') == 'none'
+            and image.width * image.height >= options.get('tiled_threshold', 0))
+
+
+def should_export_tiled(image, options):
+    """是否对该图片使用分块导出"""
+    return wants_tiled(image, options) and can_export_tiled(image)
+
+
+def _tile_layout(image):
+    """返回未压缩 TIFF 每个条带/分块的 (范围, 文件偏移, 行跨度)"""
+    bands = len(image.getbands())
+    layout = []
+    for tile in image.tile:
+        extents, offset, args = tile[1], tile[2], tile[3]
+        stride = args[1] or (extents[2] - extents[0]) * bands
+        layout.append((extents, offset, stride))
+    return layout
+
+
+def _block_layout(image):
+    """
+    按标签返回每个条带/分块的 (范围, 编码尺寸, 文件偏移, 字节数)
+
+    压缩的 TIFF 在 Pillow 中只有一个覆盖整张图片的 libtiff 分块，条带位置
+    要直接读标签。范围裁到图片以内，编码尺寸是条带数据实际的宽高（边缘的
+    分块包含填充）。坐标是文件的原始像素方向。
+    """
+    tags = image.tag_v2
+    width, height = tags[IMAGEWIDTH], tags[IMAGELENGTH]
+    if TILEOFFSETS in tags:
+        block_width, block_height = tags[TILEWIDTH], tags[TILELENGTH]
+        offsets, counts = tags[TILEOFFSETS], tags[TILEBYTECOUNTS]
+    else:
+        block_width, block_height = width, min(tags.get(ROWSPERSTRIP, height), height)
+        offsets, counts = tags[STRIPOFFSETS], tags[STRIPBYTECOUNTS]
+
+    columns = -(-width // block_width)
+    layout = []
+    for index, (offset, count) in enumerate(zip(offsets, counts)):
+        x, y = index % columns * block_width, index // columns * block_height
+        extents = (x, y, min(x + block_width, width), min(y + block_height, height))
+        coded_height = block_height if TILEOFFSETS in tags else extents[3] - y
+        layout.append((extents, (block_width, coded_height), offset, count))
+    return layout
+
+
+def _composite_region(region, box, stamp, stamp_origin):
+    """把图章叠加到 region（对应原图 box 区域），只替换图章有覆盖的像素"""
+    left, top = box[0], box[1]
+    sx, sy = left - stamp_origin[0], top - stamp_origin[1]
+    stamp_part = stamp.crop((sx, sy, sx + region.width, sy + region.height))
+    watermarked = region.convert('RGBA')
+    watermarked.alpha_composite(stamp_part)
+    mask = stamp_part.getchannel('A').point(lambda a: 255 if a else 0)
+    region.paste(watermarked.convert(region.mode), mask=mask)
+
+
+def _patch_region(fp, mode, extents, offset, stride, box, stamp, stamp_origin):
+    """读取一个条带中与图章相交的行段，叠加水印后写回原位置"""
+    bands = Image.getmodebands(mode)
+    left, top, right, bottom = box
+    row_bytes = (right - left) * bands
+    column_offset = (left - extents[0]) * bands
+
+    # 逐行读取相交的列段
+    rows = []
+    for row in range(top, bottom):
+        fp.seek(offset + (row - extents[1]) * stride + column_offset)
+        rows.append(fp.read(row_bytes))
+    region = Image.frombytes(mode, (right - left, bottom - top), b''.join(rows))
+    _composite_region(region, box, stamp, stamp_origin)
+
+    data = region.tobytes()
+    for index, row in enumerate(range(top, bottom)):
+        fp.seek(offset + (row - extents[1]) * stride + column_offset)
+        fp.write(data[index * row_bytes:(index + 1) * row_bytes])
+
+
+def _tiff_header(prefix, ifd_offset):
+    """TIFF 文件头：字节序、版本号和第一个 IFD 的位置"""
+    endian = '<' if prefix == TiffImagePlugin.II else '>'
+    return prefix + struct.pack(endian + 'HI', 42, ifd_offset)
+
+
+def _set_tag(ifd, tag, value, tag_type):
+    ifd.tagtype[tag] = tag_type
+    ifd[tag] = value
+
+
+def _decode_block(image, prefix, data, size):
+    """把一个压缩的条带/分块包装成单条带的 TIFF，交给 libtiff 解码"""
+    tags = image.tag_v2
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(_tiff_header(prefix, 8))
+    for tag in BLOCK_TAGS:
+        if tag in tags:
+            _set_tag(ifd, tag, tags[tag], tags.tagtype[tag])
+    _set_tag(ifd, IMAGEWIDTH, size[0], TiffTags.LONG)
+    _set_tag(ifd, IMAGELENGTH, size[1], TiffTags.LONG)
+    _set_tag(ifd, ROWSPERSTRIP, size[1], TiffTags.LONG)
+    # 条带偏移相对于 IFD 之后的位置，由 tobytes 换算为绝对偏移
+    _set_tag(ifd, STRIPOFFSETS, (0,), TiffTags.LONG)
+    _set_tag(ifd, STRIPBYTECOUNTS, (len(data),), TiffTags.LONG)
+
+    block = Image.open(io.BytesIO(_tiff_header(prefix, 8) + ifd.tobytes(8) + data))
+    block.load()
+    return block
+
+
+def _encode_block(block, image):
+    """按原图的压缩方式和预测器把一个条带重新编码，返回条带数据"""
+    buffer = io.BytesIO()
+    block.save(buffer, 'TIFF', compression=image.info['compression'],
+               tiffinfo={PREDICTOR: image.tag_v2.get(PREDICTOR, 1),
+                         ROWSPERSTRIP: block.height})
+    with Image.open(buffer) as encoded:
+        offset, = encoded.tag_v2[STRIPOFFSETS]
+        count, = encoded.tag_v2[STRIPBYTECOUNTS]
+    return buffer.getvalue()[offset:offset + count]
+
+
+def _output_ifd(image, prefix, offsets, counts):
+    """复制原图第一页的 IFD，换上新的条带/分块偏移，子 IFD 按内容重新写入"""
+    tags = image.tag_v2
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(_tiff_header(prefix, 8))
+    for tag, value in tags.items():
+        if tag not in (SUBIFD, EXIF_IFD, GPS_IFD):
+            _set_tag(ifd, tag, value, tags.tagtype[tag])
+
+    exif = image.getexif()
+    for tag in (EXIF_IFD, GPS_IFD):
+        sub_ifd = exif.get_ifd(tag) if tag in tags else {}
+        if sub_ifd:
+            _set_tag(ifd, tag, dict(sub_ifd), TiffTags.LONG)
+
+    if TILEOFFSETS in tags:
+        _set_tag(ifd, TILEOFFSETS, tuple(offsets), TiffTags.LONG)
+        _set_tag(ifd, TILEBYTECOUNTS, tuple(counts), TiffTags.LONG)
+    else:
+        _set_tag(ifd, STRIPOFFSETS, tuple(offsets), TiffTags.LONG)
+        _set_tag(ifd, STRIPBYTECOUNTS, tuple(counts), TiffTags.LONG)
+    return ifd
+
+
+def _rewrite_blocks(image, source_path, output_path, stamp, stamp_origin, stamp_box):
+    """
+    逐个条带/分块写出新的 TIFF
+
+    文件布局为：文件头、IFD、条带数据。IFD 的长度与偏移的取值无关，先按
+    占位的偏移留出位置，写完所有条带后再写入真正的 IFD。tobytes 会给条带
+    偏移加上 IFD 结束的位置，分块偏移则需要直接写绝对位置。
+    """
+    layout = _block_layout(image)
+    tiled = TILEOFFSETS in image.tag_v2
+
+    with open(source_path, 'rb') as src, open(output_path, 'wb') as dst:
+        prefix = src.read(2)
+        placeholder = _output_ifd(image, prefix, [0] * len(layout), [0] * len(layout))
+        data_start = 8 + len(placeholder.tobytes(8))
+        dst.write(_tiff_header(prefix, 8))
+        dst.write(bytes(data_start - 8))
+
+        offsets, counts = [], []
+        for extents, coded_size, offset, count in layout:
+            src.seek(offset)
+            data = src.read(count)
+            box = (max(extents[0], stamp_box[0]), max(extents[1], stamp_box[1]),
+                   min(extents[2], stamp_box[2]), min(extents[3], stamp_box[3]))
+            if box[2] > box[0] and box[3] > box[1]:
+                block = _decode_block(image, prefix, data, coded_size)
+                local = (box[0] - extents[0], box[1] - extents[1],
+                         box[2] - extents[0], box[3] - extents[1])
+                region = block.crop(local)
+                _composite_region(region, box, stamp, stamp_origin)
+                block.paste(region, local[:2])
+                data = _encode_block(block, image)
+
+            offsets.append(dst.tell() - (0 if tiled else data_start))
+            counts.append(len(data))
+            dst.write(data)
+            if dst.tell() % 2:
+                dst.write(b'\0')  # 条带按字对齐
+
+        ifd = _output_ifd(image, prefix, offsets, counts)
+        dst.seek(8)
+        dst.write(ifd.tobytes(8))
+
+
+def export_tiled(image, source_path, name, settings, options, output_dir):
+    """分块导出超大 TIFF，返回输出路径"""
+    output_name = watermark_engine.build_output_name(
+        name, options['naming_option'], options['naming_text'], 'TIFF')
+    output_path = os.path.join(output_dir, output_name)
+    if os.path.exists(output_path) and os.path.samefile(source_path, output_path):
+        raise ValueError("输出文件不能覆盖原图")
+
+    # 水印按正向坐标放置，再换算到文件的原始像素方向。Pillow 给出的 TIFF 尺寸
+    # 已是正向尺寸，原始方向要直接读方向标签，条带按原始尺寸排列
+    orientation = raw_orientation(image)
+    display_size = image.size
+    raw_width, raw_height = watermark_engine.oriented_size(display_size, orientation)
+    stamp, position = watermark_engine.prepare_stamp(display_size, settings)
+    stamp, (x, y) = watermark_engine.stamp_to_raw(stamp, position, display_size, orientation)
+    stamp_box = (max(0, x), max(0, y),
+                 min(raw_width, x + stamp.width), min(raw_height, y + stamp.height))
+
+    if image.info.get('compression', 'raw') != 'raw':
+        _rewrite_blocks(image, source_path, output_path, stamp, (x, y), stamp_box)
+        return output_path
+
+    # 未压缩：流式复制原文件
+    with open(source_path, 'rb') as src, open(output_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+    # 只改写与图章相交的条带
+    with open(output_path, 'r+b') as fp:
+        for extents, offset, stride in _tile_layout(image):
+            box = (max(extents[0], stamp_box[0]), max(extents[1], stamp_box[1]),
+                   min(extents[2], stamp_box[2]), min(extents[3], stamp_box[3]))
+            if box[2] > box[0] and box[3] > box[1]:
+                _patch_region(fp, image.mode, extents, offset, stride, box, stamp, (x, y))
+
+    return output_path
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+监视文件夹 - 无界面运行，自动为放入输入文件夹的新图片添加水印
+
+用法:
+    python watch_folder.py --input 收件箱 --output 已加水印 --template 客户A
+    python watch_folder.py --input a b --output out --template 默认 --process-existing
+
+Linux 上使用 inotify 接收文件变化通知，其他平台按固定间隔轮询。
+文件大小和修改时间在一段时间内不再变化后才会处理，避免读到写了一半的文件。
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import watermark_engine
+from template_library import TemplateLibrary
+
+# 文件写入完成后需要保持不变的时间（秒）
+DEFAULT_SETTLE_TIME = 0.3
+DEFAULT_POLL_INTERVAL = 0.5
+
+# 统计延迟时保留的最近样本数，长时间运行时内存占用保持不变
+LATENCY_SAMPLES = 1000
+
+# 每隔多少秒清理一次已删除文件的处理记录
+PRUNE_INTERVAL = 60
+
+# inotify 事件
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def log(message):
+    """带时间戳输出日志"""
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+class PollingBackend:
+    """按固定间隔扫描文件夹"""
+
+    name = "轮询"
+
+    def __init__(self, input_dirs, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.input_dirs = input_dirs
+        self.poll_interval = poll_interval
+
+    def wait(self, timeout):
+        """等待后返回所有候选文件，由调用方比较文件状态"""
+        time.sleep(min(timeout, self.poll_interval))
+        return list_images(self.input_dirs)
+
+    def close(self):
+        pass
+
+
+class InotifyBackend:
+    """使用 Linux inotify 接收文件变化通知"""
+
+    name = "inotify"
+
+    def __init__(self, input_dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+
+        self.watches = {}
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        for input_dir in input_dirs:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(input_dir), mask)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"无法监视 {input_dir}")
+            self.watches[wd] = input_dir
+
+    def wait(self, timeout):
+        """等待文件事件，返回发生变化的文件路径"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        return self.parse_events(data)
+
+    def parse_events(self, data):
+        """
+        解析 inotify 事件，返回发生变化的图片路径
+
+        事件队列溢出时内核会丢弃之后的事件，此时重新扫描所有输入文件夹，
+        由调用方按文件状态找出新文件，不会漏掉图片。
+        """
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                log("inotify 事件队列溢出，重新扫描输入文件夹")
+                return list_images(self.watches.values())
+            if name and wd in self.watches:
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if is_image(path):
+                    paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_image(path):
+    """按扩展名判断是否为支持的图片（忽略隐藏文件和临时文件）"""
+    name = os.path.basename(path)
+    return (not name.startswith('.')
+            and Path(name).suffix.lower() in watermark_engine.SUPPORTED_EXTENSIONS)
+
+
+def list_images(input_dirs):
+    """列出输入文件夹中的图片"""
+    paths = []
+    for input_dir in input_dirs:
+        for entry in os.scandir(input_dir):
+            if entry.is_file() and is_image(entry.path):
+                paths.append(entry.path)
+    return paths
+
+
+def file_signature(path):
+    """文件状态（大小、修改时间），文件不存在时返回 None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FolderWatcher:
+    """监视输入文件夹，把稳定下来的新图片交给线程池添加水印"""
+
+    def __init__(self, input_dirs, output_dir, settings, options, workers=None,
+                 settle_time=DEFAULT_SETTLE_TIME, poll_interval=DEFAULT_POLL_INTERVAL,
+                 use_inotify=True, library=None, template_name=None):
+        self.input_dirs = [os.path.abspath(d) for d in input_dirs]
+        self.output_dir = os.path.abspath(output_dir)
+        if self.output_dir in self.input_dirs:
+            raise ValueError("输出文件夹不能是输入文件夹")
+
+        self.settings = settings
+        self.options = options
+        # 提供模板库时，模板文件修改后自动使用新的设置
+        self.library = library
+        self.template_name = template_name
+        self.settle_time = settle_time
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1))
+        self.backend = self._create_backend(use_inotify, poll_interval)
+
+        self.pending = {}    # 路径 -> (文件状态, 最后一次变化的时间)
+        self.processed = {}  # 路径 -> 已处理时的文件状态
+        self.running = []    # (路径, 提交时间, future)
+        self.sequence = 0    # 水印文本中 {index} 占位符的序号
+        self.stats = {'done': 0, 'failed': 0, 'latency': deque(maxlen=LATENCY_SAMPLES)}
+        self.pruned_at = time.monotonic()
+
+    def _create_backend(self, use_inotify, poll_interval):
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                return InotifyBackend(self.input_dirs)
+            except OSError as e:
+                log(f"inotify 不可用，改用轮询: {e}")
+        return PollingBackend(self.input_dirs, poll_interval)
+
+    def mark_existing_processed(self):
+        """把已存在的文件视为已处理，只处理之后新增的文件"""
+        for path in list_images(self.input_dirs):
+            self.processed[path] = file_signature(path)
+
+    def queue_existing(self):
+        """把已存在的文件加入待处理队列"""
+        now = time.monotonic()
+        for path in list_images(self.input_dirs):
+            self.pending[path] = (file_signature(path), now - self.settle_time)
+
+    def _note_changes(self, paths):
+        """记录发生变化的文件，状态变化时重新开始计时"""
+        now = time.monotonic()
+        for path in paths:
+            signature = file_signature(path)
+            if signature is None:
+                self.processed.pop(path, None)
+                continue
+            if signature == self.processed.get(path):
+                continue
+            previous = self.pending.get(path)
+            if previous is None or previous[0] != signature:
+                self.pending[path] = (signature, now)
+
+    def _prune_processed(self, force=False):
+        """定期清理已删除文件的处理记录，避免长时间运行时记录无限增长"""
+        now = time.monotonic()
+        if not force and now - self.pruned_at < PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        for path in [path for path in self.processed if not os.path.exists(path)]:
+            del self.processed[path]
+
+    def _reload_template(self):
+        """模板文件发生变化时重新加载（模板库自身会限制刷新频率）"""
+        if self.library is None or not self.library.refresh():
+            return
+        try:
+            plan, options = self.library.load(self.template_name)
+        except KeyError:
+            log(f"模板 {self.template_name} 已被删除，继续使用原来的设置")
+            return
+        if plan != self.settings or options != self.options:
+            self.settings, self.options = plan, options
+            log(f"模板 {self.template_name} 已更新")
+
+    def _submit_settled(self):
+        """提交状态已稳定的文件"""
+        now = time.monotonic()
+        for path, (signature, changed_at) in list(self.pending.items()):
+            current = file_signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)
+            elif now - changed_at >= self.settle_time:
+                del self.pending[path]
+                self.processed[path] = signature
+                self.sequence += 1
+                future = self.pool.submit(watermark_engine.export_file, path,
+                                          os.path.basename(path), self.settings,
+                                          self.options, self.output_dir, self.sequence)
+                self.running.append((path, changed_at, future))
+
+    def _collect_finished(self):
+        """输出已完成任务的结果"""
+        still_running = []
+        for path, changed_at, future in self.running:
+            if not future.done():
+                still_running.append((path, changed_at, future))
+                continue
+
+            latency = time.monotonic() - changed_at
+            try:
+                output_path = future.result()
+                self.stats['done'] += 1
+                self.stats['latency'].append(latency)
+                log(f"已处理 {os.path.basename(path)} -> {output_path} ({latency:.2f}s)")
+            except Exception as e:
+                # 文件可能仍未写完，下次变化时会重新处理
+                self.stats['failed'] += 1
+                self.processed.pop(path, None)
+                log(f"处理 {os.path.basename(path)} 失败: {e}")
+        self.running = still_running
+
+    def run(self, stop_event=None):
+        """运行监视循环，直到 stop_event 被设置"""
+        stop_event = stop_event or threading.Event()
+        log(f"开始监视 {', '.join(self.input_dirs)}（{self.backend.name}），输出到 {self.output_dir}")
+        try:
+            while not stop_event.is_set():
+                # 有待处理的文件时缩短等待时间，以便及时提交
+                timeout = 0.05 if self.pending or self.running else DEFAULT_POLL_INTERVAL
+                self._note_changes(self.backend.wait(timeout))
+                self._reload_template()
+                self._submit_settled()
+                self._collect_finished()
+                self._prune_processed()
+        finally:
+            self.backend.close()
+            self.pool.shutdown(wait=True)
+            self._collect_finished()
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="监视文件夹并自动添加水印")
+    parser.add_argument('--input', nargs='+', required=True, help="输入文件夹")
+    parser.add_argument('--output', required=True, help="输出文件夹")
+    parser.add_argument('--template', required=True, help="templates 文件夹中的模板名称")
+    parser.add_argument('--templates-dir', default=watermark_engine.TEMPLATES_DIR,
+                        help="模板文件夹")
+    parser.add_argument('--workers', type=int, help="并行处理的线程数")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_TIME,
+                        help="文件保持不变多少秒后才处理")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="轮询间隔（秒）")
+    parser.add_argument('--polling', action='store_true', help="强制使用轮询")
+    parser.add_argument('--process-existing', action='store_true',
+                        help="启动时处理输入文件夹中已有的图片")
+    args = parser.parse_args()
+
+    # 模板只编译一次，所有图片共用同一个渲染计划
+    library = TemplateLibrary(args.templates_dir)
+    try:
+        plan, options = library.load(args.template)
+    except KeyError:
+        parser.error(f"模板不存在: {args.template}")
+    os.makedirs(args.output, exist_ok=True)
+
+    watcher = FolderWatcher(args.input, args.output, plan, options, args.workers,
+                            args.settle, args.poll_interval, use_inotify=not args.polling,
+                            library=library, template_name=args.template)
+    if args.process_existing:
+        watcher.queue_existing()
+    else:
+        watcher.mark_existing_processed()
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+    latency = sorted(watcher.stats['latency'])
+    if latency:
+        log(f"共处理 {watcher.stats['done']} 张，失败 {watcher.stats['failed']} 张，"
+            f"延迟中位数 {latency[len(latency) // 2]:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
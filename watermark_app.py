@@ -1,17 +1,45 @@
+import sys
+import time
+
+# 启动计时的起点；--startup-profile 需要在其他模块导入之前安装导入计时
+_startup_time = time.perf_counter()
+import startup_profile
+if startup_profile.FLAG in sys.argv:
+    startup_profile.install(_startup_time)
+
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, colorchooser, simpledialog
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from tkinter import ttk, messagebox
+from PIL import Image
 import os
 import json
+import threading
 from pathlib import Path
 import shutil
 
+import profiler
+import watermark_engine
+
 try:
     from version import __version__, __description__
 except ImportError:
     __version__ = "1.0.0"
     __description__ = "图片水印工具"
 
+# 导出尺寸选项（界面显示名 -> 引擎中的缩放方式）
+RESIZE_MODE_NAMES = {
+    '原始尺寸': 'none',
+    '按宽度': 'width',
+    '按高度': 'height',
+    '按百分比': 'percent'
+}
+
+# 停止拖拽、输入等操作多少毫秒后，用 LANCZOS 重新渲染精细预览
+PREVIEW_REFINE_DELAY = 150
+
+# 滚轮每一格的缩放倍数和最大显示比例
+ZOOM_STEP = 1.25
+MAX_ZOOM = 8.0
+
 class WatermarkApp:
     def __init__(self, root):
         self.root = root
@@ -23,7 +51,16 @@ class WatermarkApp:
         self.images = []  # 存储导入的图片信息
         self.current_image_index = 0
         self.current_image = None
+        # 当前图片的多分辨率金字塔，随图片一起加载
+        self.preview_pyramid = None
         self.preview_image = None
+        # 上次预览的图片和 (渲染计划摘要, 画布尺寸)，未变化时跳过重新渲染
+        self.preview_source = None
+        self.preview_key = None
+        # 当前显示的是否是交互过程中的快速预览，以及等待执行的精细渲染
+        self.preview_fast = False
+        self.refine_job = None
+        self.template_library = None
         self.watermark_settings = {
             'text': '水印文本',
             'font_size': 36,
@@ -33,13 +70,46 @@ class WatermarkApp:
             'position': 'center',
             'x_offset': 0,
             'y_offset': 0,
-            'rotation': 0
+            'rotation': 0,
+            'stroke_color': '#000000',
+            'relative_x_offset': 0.0,
+            'relative_y_offset': 0.0
         }
         
-        # 创建界面
+        # 创建界面：先完成首次绘制，设置面板的内容在空闲时再创建
+        self.create_variables()
+        self.load_default_settings()
         self.create_widgets()
         self.create_status_bar()
-        self.load_default_settings()
+        self.root.after_idle(self.finish_startup)
+        
+    def create_variables(self):
+        """创建界面使用的变量"""
+        self.text_var = tk.StringVar(value=self.watermark_settings['text'])
+        self.font_size_var = tk.IntVar(value=self.watermark_settings['font_size'])
+        self.opacity_var = tk.IntVar(value=self.watermark_settings['opacity'])
+        self.shadow_var = tk.BooleanVar(value=False)
+        self.stroke_width_var = tk.IntVar(value=0)
+        self.auto_contrast_var = tk.BooleanVar(value=False)
+        self.relative_var = tk.BooleanVar(value=False)
+        self.output_format = tk.StringVar(value="PNG")
+        self.naming_option = tk.StringVar(value="suffix")
+        self.naming_text = tk.StringVar(value="_watermarked")
+        self.resize_mode = tk.StringVar(value="原始尺寸")
+        self.resize_value = tk.StringVar(value="100")
+        self.jpeg_patch_var = tk.BooleanVar(value=False)
+        self.csv_path = tk.StringVar(value="")
+        # 多规格输出只能在模板文件中编辑，加载模板时记录下来，导出和保存模板时沿用
+        self.renditions = None
+        
+    def finish_startup(self):
+        """首次绘制之后完成的启动工作"""
+        self.create_settings_panel()
+        
+        # 在后台线程中预热字体
+        font_size = int(self.font_size_var.get())
+        threading.Thread(target=watermark_engine.warm_up_fonts, args=([font_size],),
+                         daemon=True).start()
         
     def create_widgets(self):
         # 主框架
@@ -76,9 +146,8 @@ class WatermarkApp:
         format_frame = ttk.Frame(btn_frame)
         format_frame.pack(fill=tk.X, pady=2)
         ttk.Label(format_frame, text="格式:").pack(side=tk.LEFT)
-        self.output_format = tk.StringVar(value="PNG")
         format_combo = ttk.Combobox(format_frame, textvariable=self.output_format, 
-                                   values=["PNG", "JPEG"], state="readonly", width=8)
+                                   values=["PNG", "JPEG", "TIFF"], state="readonly", width=8)
         format_combo.pack(side=tk.RIGHT)
         
         # 文件命名
@@ -86,7 +155,6 @@ class WatermarkApp:
         naming_frame.pack(fill=tk.X, pady=2)
         ttk.Label(naming_frame, text="命名:").pack(anchor=tk.W)
         
-        self.naming_option = tk.StringVar(value="suffix")
         ttk.Radiobutton(naming_frame, text="保留原名", variable=self.naming_option, 
                        value="original").pack(anchor=tk.W)
         ttk.Radiobutton(naming_frame, text="添加前缀", variable=self.naming_option, 
@@ -94,9 +162,33 @@ class WatermarkApp:
         ttk.Radiobutton(naming_frame, text="添加后缀", variable=self.naming_option, 
                        value="suffix").pack(anchor=tk.W)
         
-        self.naming_text = tk.StringVar(value="_watermarked")
         ttk.Entry(naming_frame, textvariable=self.naming_text, width=15).pack(fill=tk.X, pady=2)
         
+        # 导出尺寸
+        resize_frame = ttk.Frame(btn_frame)
+        resize_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(resize_frame, text="尺寸:").pack(side=tk.LEFT)
+        resize_combo = ttk.Combobox(resize_frame, textvariable=self.resize_mode,
+                                    values=list(RESIZE_MODE_NAMES), state="readonly", width=8)
+        resize_combo.pack(side=tk.RIGHT)
+        
+        resize_value_frame = ttk.Frame(btn_frame)
+        resize_value_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(resize_value_frame, text="数值(像素/%):").pack(side=tk.LEFT)
+        ttk.Entry(resize_value_frame, textvariable=self.resize_value, width=8).pack(side=tk.RIGHT)
+        
+        # JPEG 局部重编码
+        ttk.Checkbutton(btn_frame, text="JPEG 仅重编码水印区域",
+                        variable=self.jpeg_patch_var).pack(anchor=tk.W, pady=2)
+        
+        # 水印文本中 {csv.列名} 占位符使用的数据文件
+        csv_frame = ttk.Frame(btn_frame)
+        csv_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(csv_frame, text="CSV:").pack(side=tk.LEFT)
+        ttk.Button(csv_frame, text="...", width=3, command=self.choose_csv).pack(side=tk.RIGHT)
+        ttk.Entry(csv_frame, textvariable=self.csv_path, width=12).pack(
+            side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        
         # 导出按钮
         ttk.Button(btn_frame, text="导出当前图片", command=self.export_current).pack(fill=tk.X, pady=2)
         ttk.Button(btn_frame, text="批量导出", command=self.export_all).pack(fill=tk.X, pady=2)
@@ -120,6 +212,15 @@ class WatermarkApp:
         center_frame = ttk.LabelFrame(parent, text="预览")
         center_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5)
         
+        # 缩放工具栏
+        zoom_bar = ttk.Frame(center_frame)
+        zoom_bar.pack(fill=tk.X, padx=5, pady=(5, 0))
+        ttk.Button(zoom_bar, text="适应窗口", command=self.zoom_fit).pack(side=tk.LEFT)
+        ttk.Button(zoom_bar, text="100%", command=lambda: self.set_zoom(1.0)).pack(side=tk.LEFT, padx=2)
+        self.zoom_label = ttk.Label(zoom_bar, text="适应窗口")
+        self.zoom_label.pack(side=tk.LEFT, padx=5)
+        ttk.Label(zoom_bar, text="滚轮缩放，右键拖动平移", foreground="gray").pack(side=tk.RIGHT)
+        
         # 预览画布
         self.canvas = tk.Canvas(center_frame, bg='white', cursor='hand2')
         self.canvas.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -127,10 +228,26 @@ class WatermarkApp:
         # 绑定鼠标事件用于拖拽水印
         self.canvas.bind('<Button-1>', self.on_canvas_click)
         self.canvas.bind('<B1-Motion>', self.on_canvas_drag)
+        self.canvas.bind('<Configure>', self.on_canvas_resize)
+        
+        # 缩放和平移（Windows/macOS 使用 MouseWheel，Linux 使用 Button-4/5）
+        self.canvas.bind('<MouseWheel>', self.on_mouse_wheel)
+        self.canvas.bind('<Button-4>', self.on_mouse_wheel)
+        self.canvas.bind('<Button-5>', self.on_mouse_wheel)
+        self.canvas.bind('<ButtonPress-3>', self.on_pan_start)
+        self.canvas.bind('<B3-Motion>', self.on_pan_drag)
         
         self.dragging = False
         self.preview_rect = None
         self.scale_factor = 1.0
+        # 预览左上角对应的原图坐标；缩放查看时的显示比例（None 表示适应窗口）和可见区域中心
+        self.preview_origin = (0, 0)
+        self.zoom = None
+        self.view_center = None
+        self.pan_start = None
+        # 画布上常驻的预览图片项和提示文字项，更新时只修改内容，不重新创建
+        self.preview_item = None
+        self.message_item = None
         
     def create_right_panel(self, parent):
         # 右栏 - 设置面板
@@ -154,23 +271,32 @@ class WatermarkApp:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
+        self.settings_frame = scrollable_frame
+        
+    def create_settings_panel(self):
+        """创建设置面板的内容"""
+        scrollable_frame = self.settings_frame
+        
         # 文本水印设置
         text_frame = ttk.LabelFrame(scrollable_frame, text="文本水印")
         text_frame.pack(fill=tk.X, padx=5, pady=5)
         
         # 水印文本
         ttk.Label(text_frame, text="水印文本:").pack(anchor=tk.W, padx=5, pady=2)
-        self.text_var = tk.StringVar(value=self.watermark_settings['text'])
         text_entry = ttk.Entry(text_frame, textvariable=self.text_var)
         text_entry.pack(fill=tk.X, padx=5, pady=2)
         text_entry.bind('<KeyRelease>', self.on_text_change)
+        ttk.Label(text_frame, text="占位符: {filename} {date} {index} {csv.列名}",
+                  foreground="gray").pack(anchor=tk.W, padx=5)
         
         # 字体大小
         ttk.Label(text_frame, text="字体大小:").pack(anchor=tk.W, padx=5, pady=2)
-        self.font_size_var = tk.IntVar(value=self.watermark_settings['font_size'])
         font_size_scale = ttk.Scale(text_frame, from_=12, to=100, variable=self.font_size_var, 
                                    orient=tk.HORIZONTAL, command=self.on_setting_change)
         font_size_scale.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Checkbutton(text_frame, text="相对尺寸（字号为图片短边的千分之几）",
+                       variable=self.relative_var,
+                       command=self.update_preview).pack(anchor=tk.W, padx=5, pady=2)
         
         # 字体颜色
         color_frame = ttk.Frame(text_frame)
@@ -179,14 +305,34 @@ class WatermarkApp:
         self.color_button = tk.Button(color_frame, text="选择颜色", bg=self.watermark_settings['color'],
                                      command=self.choose_color)
         self.color_button.pack(side=tk.RIGHT)
+        ttk.Checkbutton(text_frame, text="自动对比色（按背景亮度改用浅色或深色）",
+                       variable=self.auto_contrast_var,
+                       command=self.update_preview).pack(anchor=tk.W, padx=5, pady=2)
         
         # 透明度
         ttk.Label(text_frame, text="透明度:").pack(anchor=tk.W, padx=5, pady=2)
-        self.opacity_var = tk.IntVar(value=self.watermark_settings['opacity'])
         opacity_scale = ttk.Scale(text_frame, from_=0, to=255, variable=self.opacity_var,
                                  orient=tk.HORIZONTAL, command=self.on_setting_change)
         opacity_scale.pack(fill=tk.X, padx=5, pady=2)
         
+        # 阴影和描边
+        style_frame = ttk.LabelFrame(scrollable_frame, text="样式")
+        style_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        ttk.Checkbutton(style_frame, text="阴影", variable=self.shadow_var,
+                       command=self.update_preview).pack(anchor=tk.W, padx=5, pady=2)
+        ttk.Label(style_frame, text="描边宽度:").pack(anchor=tk.W, padx=5, pady=2)
+        stroke_scale = ttk.Scale(style_frame, from_=0, to=8, variable=self.stroke_width_var,
+                                orient=tk.HORIZONTAL, command=self.on_setting_change)
+        stroke_scale.pack(fill=tk.X, padx=5, pady=2)
+        stroke_color_frame = ttk.Frame(style_frame)
+        stroke_color_frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Label(stroke_color_frame, text="描边颜色:").pack(side=tk.LEFT)
+        self.stroke_color_button = tk.Button(stroke_color_frame, text="选择颜色",
+                                            bg=self.watermark_settings['stroke_color'],
+                                            command=self.choose_stroke_color)
+        self.stroke_color_button.pack(side=tk.RIGHT)
+        
         # 位置设置
         position_frame = ttk.LabelFrame(scrollable_frame, text="位置设置")
         position_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -207,6 +353,9 @@ class WatermarkApp:
             btn = ttk.Button(position_buttons_frame, text=text, width=6,
                            command=lambda p=pos: self.set_position(p))
             btn.grid(row=row, column=col, padx=1, pady=1)
+        ttk.Button(position_buttons_frame, text="自动（避开复杂背景）",
+                  command=lambda: self.set_position('auto')).grid(
+            row=3, column=0, columnspan=3, sticky=tk.EW, padx=1, pady=1)
         
 
         
@@ -217,7 +366,8 @@ class WatermarkApp:
         ttk.Button(template_frame, text="保存模板", command=self.save_template).pack(fill=tk.X, padx=5, pady=2)
         ttk.Button(template_frame, text="加载模板", command=self.load_template).pack(fill=tk.X, padx=5, pady=2)
         
-        # 关于按钮
+        # 诊断和关于按钮
+        ttk.Button(template_frame, text="性能诊断", command=self.show_diagnostics).pack(fill=tk.X, padx=5, pady=2)
         ttk.Button(template_frame, text="关于程序", command=self.show_about).pack(fill=tk.X, padx=5, pady=2)
         
 
@@ -260,6 +410,7 @@ class WatermarkApp:
             ("所有文件", "*.*")
         ]
         
+        from tkinter import filedialog
         files = filedialog.askopenfilenames(
             title="选择图片文件",
             filetypes=filetypes
@@ -270,14 +421,13 @@ class WatermarkApp:
             
     def import_folder(self):
         """导入文件夹中的所有图片"""
+        from tkinter import filedialog
         folder_path = filedialog.askdirectory(title="选择图片文件夹")
         if not folder_path:
             return
             
-        supported_formats = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
-        
         for file_path in Path(folder_path).rglob('*'):
-            if file_path.suffix.lower() in supported_formats:
+            if file_path.suffix.lower() in watermark_engine.SUPPORTED_EXTENSIONS:
                 self.add_image(str(file_path))
                 
     def add_image(self, file_path):
@@ -310,7 +460,8 @@ class WatermarkApp:
         self.images.clear()
         self.image_listbox.delete(0, tk.END)
         self.current_image = None
-        self.canvas.delete("all")
+        self.preview_pyramid = None
+        self.zoom_fit()
         
     def on_image_select(self, event):
         """图片选择事件"""
@@ -327,32 +478,40 @@ class WatermarkApp:
         try:
             image_path = self.images[self.current_image_index]['path']
             self.update_status(f"正在加载图片...")
-            self.current_image = Image.open(image_path)
-            self.update_preview()
+            with profiler.span('load_current_image'):
+                image = Image.open(image_path)
+                # 按 EXIF 方向转正，使预览与导出的水印位置一致
+                orientation = watermark_engine.read_metadata(image)['orientation']
+                self.current_image = watermark_engine.apply_orientation(image, orientation)
+                self.current_image.load()
+                self.preview_pyramid = watermark_engine.PreviewPyramid(self.current_image)
+            self.zoom_fit()
             self.update_image_info()
             self.update_status("就绪")
         except Exception as e:
             messagebox.showerror("错误", f"无法加载图片: {str(e)}")
             self.update_status("加载失败")
             
-    def update_preview(self):
-        """更新预览"""
+    def schedule_preview(self):
+        """交互过程中更新预览：立即显示快速预览，停止操作一段时间后再精细渲染"""
+        self.update_preview(fast=True)
+        if self.refine_job is not None:
+            self.root.after_cancel(self.refine_job)
+        self.refine_job = self.root.after(PREVIEW_REFINE_DELAY, self.refine_preview)
+        
+    def refine_preview(self):
+        """用 LANCZOS 重新渲染预览"""
+        self.refine_job = None
+        self.update_preview()
+        
+    def update_preview(self, fast=False):
+        """更新预览，fast 为 True 时使用快速缩放（见 render_preview）"""
         if not self.current_image:
-            self.canvas.delete("all")
-            self.canvas.create_text(
-                self.canvas.winfo_width()//2, 
-                self.canvas.winfo_height()//2,
-                text="请选择图片", 
-                fill="gray", 
-                font=("Arial", 16)
-            )
+            self.preview_source = None
+            self.show_canvas_message("请选择图片", "gray", ("Arial", 16))
             return
             
         try:
-            # 创建水印图片
-            watermarked_image = self.apply_watermark(self.current_image.copy())
-            
-            # 调整图片大小以适应画布
             canvas_width = self.canvas.winfo_width()
             canvas_height = self.canvas.winfo_height()
             
@@ -360,167 +519,249 @@ class WatermarkApp:
                 self.root.after(100, self.update_preview)
                 return
                 
-            # 计算缩放比例
-            img_width, img_height = watermarked_image.size
-            scale_x = (canvas_width - 20) / img_width  # 留出边距
-            scale_y = (canvas_height - 20) / img_height
-            scale = min(scale_x, scale_y, 1.0)  # 不放大图片
-            
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            
-            # 调整图片大小
-            display_image = watermarked_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # 转换为 PhotoImage
-            self.preview_image = ImageTk.PhotoImage(display_image)
+            # 水印设置和画布尺寸都没有变化时（如按下方向键）不重新渲染
+            # 占位符按当前图片展开
+            image_info = self.images[self.current_image_index]
+            plan = watermark_engine.bind_text_fields(
+                watermark_engine.compile_plan(self.get_current_settings()),
+                self.get_export_options(), image_info['name'], image_info['path'],
+                self.current_image, self.current_image_index + 1)
+            canvas_size = (canvas_width, canvas_height)
+            preview_key = (plan.key, canvas_width, canvas_height)
+            if self.zoom is not None:
+                self.view_center = watermark_engine.clamp_view_center(
+                    self.current_image.size, canvas_size, self.zoom, self.view_center)
+                preview_key += (self.zoom, self.view_center)
+            # 已经显示精细预览时，快速预览和精细预览都不需要重新渲染
+            if (self.preview_source is self.current_image and self.preview_key == preview_key
+                    and (fast or not self.preview_fast)):
+                return
+
+            if self.zoom is None:
+                # 创建水印图片并缩放到画布大小
+                display_image, scale = watermark_engine.render_preview(
+                    self.current_image, plan, canvas_size, fast, self.preview_pyramid)
+                origin = (0, 0)
+            else:
+                # 缩放查看：只渲染可见区域
+                display_image, box = watermark_engine.render_viewport(
+                    self.current_image, plan, canvas_size, self.zoom, self.view_center,
+                    fast, self.preview_pyramid)
+                scale = self.zoom
+                origin = box[:2]
+            new_width, new_height = display_image.size
             
             # 在画布中央显示图片
-            self.canvas.delete("all")
             x = (canvas_width - new_width) // 2
             y = (canvas_height - new_height) // 2
-            self.canvas.create_image(x, y, anchor=tk.NW, image=self.preview_image)
+            self.show_preview_image(display_image, x, y)
             
             # 存储图片在画布中的位置和尺寸，用于拖拽计算
             self.preview_rect = (x, y, x + new_width, y + new_height)
             self.scale_factor = scale
+            self.preview_origin = origin
+            self.preview_source = self.current_image
+            self.preview_key = preview_key
+            self.preview_fast = fast
             
         except Exception as e:
-            self.canvas.delete("all")
-            self.canvas.create_text(
-                canvas_width//2, 
-                canvas_height//2,
-                text=f"预览错误: {str(e)}", 
-                fill="red", 
-                font=("Arial", 12)
-            )
-        
-    def apply_watermark(self, image):
-        """应用水印到图片"""
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-            
-        # 创建透明图层用于水印
-        watermark_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_layer)
-        
-        # 获取水印设置
-        text = self.text_var.get()
-        font_size = int(self.font_size_var.get())
-        color = self.watermark_settings['color']
-        opacity = int(self.opacity_var.get())
-        
-        # 创建字体
-        try:
-            # Windows系统字体路径
-            font_paths = [
-                "C:/Windows/Fonts/arial.ttf",
-                "C:/Windows/Fonts/Arial.ttf", 
-                "C:/Windows/Fonts/simhei.ttf",  # 黑体，支持中文
-                "C:/Windows/Fonts/simsun.ttc",  # 宋体，支持中文
-                "/System/Library/Fonts/Arial.ttf",  # macOS
-                "/usr/share/fonts/truetype/arial.ttf",  # Linux
-            ]
-            
-            font = None
-            for font_path in font_paths:
-                try:
-                    if os.path.exists(font_path):
-                        font = ImageFont.truetype(font_path, font_size)
-                        break
-                except:
-                    continue
-                    
-            if font is None:
-                font = ImageFont.load_default()
+            self.preview_source = None
+            self.show_canvas_message(f"预览错误: {str(e)}", "red", ("Arial", 12))
+        
+    def show_preview_image(self, display_image, x, y):
+        """
+        在画布的 (x, y) 处显示预览图
+        
+        尺寸不变时用 PhotoImage.paste() 就地更新像素，只有尺寸变化时才创建新的
+        PhotoImage，画布上的图片项始终是同一个，长时间编辑也不会累积 Tk 图片对象。
+        """
+        from PIL import ImageTk
+        with profiler.span('preview.photoimage'):
+            if (self.preview_image is not None and
+                    (self.preview_image.width(), self.preview_image.height()) == display_image.size):
+                self.preview_image.paste(display_image)
+            else:
+                photo = ImageTk.PhotoImage(display_image)
+                if self.preview_item is not None:
+                    # 先让图片项引用新图片，再释放旧图片
+                    self.canvas.itemconfigure(self.preview_item, image=photo)
+                self.preview_image = photo
                 
-        except Exception as e:
-            print(f"字体加载失败: {e}")
-            font = ImageFont.load_default()
-        
-        # 获取文本尺寸
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # 计算位置
-        x, y = self.calculate_watermark_position(image.size, text_width, text_height)
-        
-        # 转换颜色并添加透明度
-        if color.startswith('#'):
-            color = color[1:]
-        r = int(color[0:2], 16)
-        g = int(color[2:4], 16)
-        b = int(color[4:6], 16)
-        text_color = (r, g, b, opacity)
-        
-        # 绘制文本
-        draw.text((x, y), text, font=font, fill=text_color)
-        
-        # 合并图层
-        result = Image.alpha_composite(image, watermark_layer)
-        
-        return result
-        
-    def calculate_watermark_position(self, image_size, text_width, text_height):
-        """计算水印位置"""
-        img_width, img_height = image_size
-        position = self.watermark_settings['position']
-        
-        if position == 'custom':
-            # 自定义位置，直接使用偏移值
-            x = img_width // 2 + self.watermark_settings['x_offset'] - text_width // 2
-            y = img_height // 2 + self.watermark_settings['y_offset'] - text_height // 2
+        if self.preview_item is None:
+            self.preview_item = self.canvas.create_image(x, y, anchor=tk.NW,
+                                                         image=self.preview_image)
         else:
-            # 预设位置
-            positions = {
-                'top_left': (10, 10),
-                'top_center': ((img_width - text_width) // 2, 10),
-                'top_right': (img_width - text_width - 10, 10),
-                'middle_left': (10, (img_height - text_height) // 2),
-                'center': ((img_width - text_width) // 2, (img_height - text_height) // 2),
-                'middle_right': (img_width - text_width - 10, (img_height - text_height) // 2),
-                'bottom_left': (10, img_height - text_height - 10),
-                'bottom_center': ((img_width - text_width) // 2, img_height - text_height - 10),
-                'bottom_right': (img_width - text_width - 10, img_height - text_height - 10)
-            }
-            
-            base_x, base_y = positions.get(position, positions['center'])
+            self.canvas.coords(self.preview_item, x, y)
+            self.canvas.itemconfigure(self.preview_item, state=tk.NORMAL)
+        if self.message_item is not None:
+            self.canvas.itemconfigure(self.message_item, state=tk.HIDDEN)
             
-            # 添加偏移
-            x = base_x + self.watermark_settings['x_offset']
-            y = base_y + self.watermark_settings['y_offset']
+    def show_canvas_message(self, text, fill, font):
+        """隐藏预览图，在画布中央显示提示文字"""
+        if self.preview_item is not None:
+            self.canvas.itemconfigure(self.preview_item, state=tk.HIDDEN)
+        x, y = self.canvas.winfo_width() // 2, self.canvas.winfo_height() // 2
+        if self.message_item is None:
+            self.message_item = self.canvas.create_text(x, y)
+        self.canvas.coords(self.message_item, x, y)
+        self.canvas.itemconfigure(self.message_item, text=text, fill=fill, font=font,
+                                  state=tk.NORMAL)
+        
+    def get_current_settings(self):
+        """获取当前的水印设置"""
+        return {
+            'text': self.text_var.get(),
+            'font_size': int(self.font_size_var.get()),
+            'color': self.watermark_settings['color'],
+            'opacity': int(self.opacity_var.get()),
+            'position': self.watermark_settings['position'],
+            'x_offset': self.watermark_settings['x_offset'],
+            'y_offset': self.watermark_settings['y_offset'],
+            **self.get_relative_settings(),
+            **self.get_style_settings()
+        }
         
-        # 确保水印不会超出图片边界
-        x = max(0, min(x, img_width - text_width))
-        y = max(0, min(y, img_height - text_height))
+    def get_relative_settings(self):
+        """获取相对尺寸设置：字号滑块按千分比换算，偏移使用拖拽时记录的比例"""
+        return {
+            'relative': self.relative_var.get(),
+            'relative_font_size': int(self.font_size_var.get()) / 1000,
+            'relative_x_offset': self.watermark_settings['relative_x_offset'],
+            'relative_y_offset': self.watermark_settings['relative_y_offset']
+        }
         
-        return x, y
+    def get_style_settings(self):
+        """获取当前的阴影和描边设置"""
+        return {
+            'shadow': self.shadow_var.get(),
+            'stroke_width': int(self.stroke_width_var.get()),
+            'stroke_color': self.watermark_settings['stroke_color'],
+            'auto_contrast': self.auto_contrast_var.get()
+        }
+        
+    def get_export_options(self):
+        """获取当前的导出设置"""
+        return {
+            'output_format': self.output_format.get(),
+            'quality': 95,
+            'naming_option': self.naming_option.get(),
+            'naming_text': self.naming_text.get(),
+            'resize_mode': RESIZE_MODE_NAMES.get(self.resize_mode.get(), 'none'),
+            'resize_value': self.resize_value.get(),
+            'jpeg_patch': self.jpeg_patch_var.get(),
+            'csv_path': self.csv_path.get() or None,
+            'renditions': self.renditions,
+            # 批量导出的并发数和内存预算，界面中不提供设置，按机器配置自动选择
+            'max_workers': None,
+            'memory_budget': None
+        }
         
     def on_text_change(self, event=None):
         """文本变化事件"""
         self.watermark_settings['text'] = self.text_var.get()
-        self.update_preview()
+        self.schedule_preview()
         
     def on_setting_change(self, event=None):
         """设置变化事件"""
         self.watermark_settings['font_size'] = int(self.font_size_var.get())
         self.watermark_settings['opacity'] = int(self.opacity_var.get())
-        self.update_preview()
+        self.schedule_preview()
         
     def choose_color(self):
         """选择颜色"""
+        from tkinter import colorchooser
         color = colorchooser.askcolor(color=self.watermark_settings['color'])
         if color[1]:
             self.watermark_settings['color'] = color[1]
             self.color_button.config(bg=color[1])
             self.update_preview()
             
+    def choose_stroke_color(self):
+        """选择描边颜色"""
+        from tkinter import colorchooser
+        color = colorchooser.askcolor(color=self.watermark_settings['stroke_color'])
+        if color[1]:
+            self.watermark_settings['stroke_color'] = color[1]
+            self.stroke_color_button.config(bg=color[1])
+            self.update_preview()
+            
+    def choose_csv(self):
+        """选择水印文本占位符使用的 CSV 数据文件"""
+        from tkinter import filedialog
+        csv_path = filedialog.askopenfilename(
+            title="选择 CSV 数据文件", filetypes=[("CSV 文件", "*.csv"), ("所有文件", "*.*")])
+        if csv_path:
+            self.csv_path.set(csv_path)
+            self.update_preview()
+            
     def set_position(self, position):
         """设置水印位置"""
         self.watermark_settings['position'] = position
         self.update_preview()
         
+    def on_canvas_resize(self, event):
+        """画布尺寸变化时按新尺寸更新预览"""
+        if self.current_image:
+            self.schedule_preview()
+            
+    def canvas_to_image(self, x, y):
+        """把画布坐标换算为原图坐标"""
+        x1, y1 = self.preview_rect[:2]
+        origin_x, origin_y = self.preview_origin
+        return (origin_x + (x - x1) / self.scale_factor,
+                origin_y + (y - y1) / self.scale_factor)
+        
+    def zoom_fit(self):
+        """恢复为适应窗口显示"""
+        self.zoom = None
+        self.view_center = None
+        self.zoom_label.config(text="适应窗口")
+        self.update_preview()
+        
+    def set_zoom(self, zoom, anchor=None):
+        """
+        设置显示比例，anchor 为缩放时保持不动的画布坐标（默认为画布中心）
+        
+        比例不大于适应窗口的比例时恢复为适应窗口显示。
+        """
+        if not self.current_image or not self.preview_rect:
+            return
+        canvas_size = (self.canvas.winfo_width(), self.canvas.winfo_height())
+        if zoom <= watermark_engine.fit_scale(self.current_image.size, canvas_size):
+            self.zoom_fit()
+            return
+        zoom = min(zoom, MAX_ZOOM)
+        anchor_x, anchor_y = anchor or (canvas_size[0] / 2, canvas_size[1] / 2)
+        # 锚点下的原图位置在缩放前后保持不变
+        image_x, image_y = self.canvas_to_image(anchor_x, anchor_y)
+        self.zoom = zoom
+        self.view_center = (image_x - (anchor_x - canvas_size[0] / 2) / zoom,
+                            image_y - (anchor_y - canvas_size[1] / 2) / zoom)
+        self.zoom_label.config(text=f"{zoom:.0%}")
+        self.schedule_preview()
+        
+    def on_mouse_wheel(self, event):
+        """滚轮缩放，以鼠标位置为中心"""
+        if not self.current_image:
+            return
+        zoom_in = event.num == 4 if event.num in (4, 5) else event.delta > 0
+        current = self.zoom or self.scale_factor
+        self.set_zoom(current * ZOOM_STEP if zoom_in else current / ZOOM_STEP,
+                      (event.x, event.y))
+        
+    def on_pan_start(self, event):
+        """开始平移（缩放查看时）"""
+        self.pan_start = (event.x, event.y, self.view_center) if self.zoom else None
+        
+    def on_pan_drag(self, event):
+        """拖动平移可见区域"""
+        if self.zoom is None or self.pan_start is None:
+            return
+        start_x, start_y, (center_x, center_y) = self.pan_start
+        self.view_center = (center_x - (event.x - start_x) / self.zoom,
+                            center_y - (event.y - start_y) / self.zoom)
+        self.schedule_preview()
+        
     def on_canvas_click(self, event):
         """画布点击事件"""
         self.dragging = True
@@ -532,17 +773,21 @@ class WatermarkApp:
             x1, y1, x2, y2 = self.preview_rect
             if x1 <= event.x <= x2 and y1 <= event.y <= y2:
                 # 计算相对于图片的位置
-                relative_x = (event.x - x1) / self.scale_factor
-                relative_y = (event.y - y1) / self.scale_factor
+                relative_x, relative_y = self.canvas_to_image(event.x, event.y)
                 
-                # 转换为水印偏移
+                # 转换为水印偏移，同时记录相对短边的比例，供相对尺寸使用
                 img_width, img_height = self.current_image.size
+                short_edge = min(img_width, img_height)
                 self.watermark_settings['x_offset'] = int(relative_x - img_width // 2)
                 self.watermark_settings['y_offset'] = int(relative_y - img_height // 2)
+                self.watermark_settings['relative_x_offset'] = (
+                    self.watermark_settings['x_offset'] / short_edge)
+                self.watermark_settings['relative_y_offset'] = (
+                    self.watermark_settings['y_offset'] / short_edge)
                 
                 # 设置为自定义位置
                 self.watermark_settings['position'] = 'custom'
-                self.update_preview()
+                self.schedule_preview()
             
     def export_current(self):
         """导出当前图片"""
@@ -550,6 +795,7 @@ class WatermarkApp:
             messagebox.showwarning("警告", "请先选择一张图片")
             return
             
+        from tkinter import filedialog
         output_dir = filedialog.askdirectory(title="选择输出文件夹")
         if not output_dir:
             return
@@ -569,24 +815,32 @@ class WatermarkApp:
             messagebox.showwarning("警告", "请先导入图片")
             return
             
+        from tkinter import filedialog
         output_dir = filedialog.askdirectory(title="选择输出文件夹")
         if not output_dir:
             return
             
+        from batch_export import export_batch
+        from memory_governor import MemoryGovernor
+        
         try:
             success_count = 0
             total_count = len(self.images)
+            jobs = [(info['path'], info['name']) for info in self.images]
+            options = self.get_export_options()
+            governor = MemoryGovernor(options['memory_budget'])
+            # 水印设置只编译一次，所有图片共用同一个渲染计划和图章
+            plan = watermark_engine.compile_plan(self.get_current_settings(), options)
             
-            for i in range(total_count):
-                try:
-                    self.update_status(f"正在导出 {i+1}/{total_count}: {self.images[i]['name']}")
-                    # 临时加载图片
-                    temp_image = Image.open(self.images[i]['path'])
-                    self.export_image_with_data(temp_image, self.images[i], output_dir)
+            for done_count, (i, output_path, error) in enumerate(
+                    export_batch(jobs, plan, options, output_dir, governor), start=1):
+                if error is None:
                     success_count += 1
-                except Exception as e:
-                    print(f"导出图片 {self.images[i]['name']} 失败: {str(e)}")
+                else:
+                    print(f"导出图片 {self.images[i]['name']} 失败: {str(error)}")
+                self.update_status(f"正在导出 {done_count}/{total_count}: {self.images[i]['name']}")
                     
+            print(governor.summary())
             self.update_status(f"批量导出完成: {success_count}/{total_count}")
             messagebox.showinfo("完成", f"成功导出 {success_count}/{total_count} 张图片")
         except Exception as e:
@@ -596,57 +850,25 @@ class WatermarkApp:
     def export_image(self, image_index, output_dir):
         """导出指定索引的图片"""
         image_info = self.images[image_index]
-        image = Image.open(image_info['path'])
-        self.export_image_with_data(image, image_info, output_dir)
-        
-    def export_image_with_data(self, image, image_info, output_dir):
-        """使用图片数据导出图片"""
-        # 应用水印
-        watermarked_image = self.apply_watermark(image.copy())
-        
-        # 生成输出文件名
-        original_name = Path(image_info['name']).stem
-        original_ext = Path(image_info['name']).suffix
-        
-        naming_option = self.naming_option.get()
-        naming_text = self.naming_text.get()
-        
-        if naming_option == "original":
-            new_name = original_name
-        elif naming_option == "prefix":
-            new_name = f"{naming_text}{original_name}"
-        else:  # suffix
-            new_name = f"{original_name}{naming_text}"
-            
-        # 确定输出格式和扩展名
-        output_format = self.output_format.get()
-        if output_format == "JPEG":
-            output_ext = ".jpg"
-            # 转换为RGB模式（JPEG不支持透明度）
-            if watermarked_image.mode == 'RGBA':
-                background = Image.new('RGB', watermarked_image.size, (255, 255, 255))
-                background.paste(watermarked_image, mask=watermarked_image.split()[-1])
-                watermarked_image = background
-        else:
-            output_ext = ".png"
-            
-        output_path = os.path.join(output_dir, f"{new_name}{output_ext}")
+        # 超大 TIFF 会自动使用分块导出
+        watermark_engine.export_file(image_info['path'], image_info['name'],
+                                     self.get_current_settings(), self.get_export_options(),
+                                     output_dir, image_index + 1)
+        
+    def get_template_library(self):
+        """模板库在第一次使用时创建"""
+        if self.template_library is None:
+            from template_library import TemplateLibrary
+            self.template_library = TemplateLibrary(watermark_engine.TEMPLATES_DIR)
+        return self.template_library
         
-        # 保存图片
-        if output_format == "JPEG":
-            watermarked_image.save(output_path, "JPEG", quality=95)
-        else:
-            watermarked_image.save(output_path, "PNG")
-            
     def save_template(self):
         """保存水印模板"""
-        template_name = tk.simpledialog.askstring("保存模板", "请输入模板名称:")
+        from tkinter import simpledialog
+        template_name = simpledialog.askstring("保存模板", "请输入模板名称:")
         if not template_name:
             return
             
-        templates_dir = Path("templates")
-        templates_dir.mkdir(exist_ok=True)
-        
         template_data = {
             'text': self.text_var.get(),
             'font_size': int(self.font_size_var.get()),
@@ -655,62 +877,122 @@ class WatermarkApp:
             'position': self.watermark_settings['position'],
             'x_offset': self.watermark_settings['x_offset'],
             'y_offset': self.watermark_settings['y_offset'],
+            **self.get_relative_settings(),
+            **self.get_style_settings(),
             'output_format': self.output_format.get(),
             'naming_option': self.naming_option.get(),
-            'naming_text': self.naming_text.get()
+            'naming_text': self.naming_text.get(),
+            'resize_mode': RESIZE_MODE_NAMES.get(self.resize_mode.get(), 'none'),
+            'resize_value': self.resize_value.get(),
+            'jpeg_patch': self.jpeg_patch_var.get(),
+            'csv_path': self.csv_path.get() or None,
+            'renditions': self.renditions
         }
         
-        template_path = templates_dir / f"{template_name}.json"
-        with open(template_path, 'w', encoding='utf-8') as f:
-            json.dump(template_data, f, ensure_ascii=False, indent=2)
+        try:
+            template_name = self.get_template_library().save(template_name, template_data)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("错误", f"保存模板失败: {str(e)}")
+            return
             
         messagebox.showinfo("成功", f"模板 '{template_name}' 保存成功!")
         
     def load_template(self):
         """加载水印模板"""
-        templates_dir = Path("templates")
-        if not templates_dir.exists():
-            messagebox.showwarning("警告", "没有找到模板文件夹")
-            return
-            
-        template_files = list(templates_dir.glob("*.json"))
-        if not template_files:
+        library = self.get_template_library()
+        library.refresh(force=True)
+        if not library.names():
             messagebox.showwarning("警告", "没有找到模板文件")
             return
             
-        # 创建模板选择对话框
-        template_names = [f.stem for f in template_files]
-        
-        # 简单的选择对话框
+        # 模板选择对话框：搜索、缩略图预览、重命名和删除
         selection_window = tk.Toplevel(self.root)
         selection_window.title("选择模板")
-        selection_window.geometry("300x200")
+        selection_window.geometry("420x360")
         selection_window.transient(self.root)
         selection_window.grab_set()
         
-        tk.Label(selection_window, text="选择要加载的模板:").pack(pady=10)
-        
-        listbox = tk.Listbox(selection_window)
-        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-        
-        for name in template_names:
-            listbox.insert(tk.END, name)
+        search_var = tk.StringVar()
+        search_frame = ttk.Frame(selection_window)
+        search_frame.pack(fill=tk.X, padx=10, pady=(10, 5))
+        ttk.Label(search_frame, text="搜索:").pack(side=tk.LEFT)
+        search_entry = ttk.Entry(search_frame, textvariable=search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        
+        # 缩略图是带透明度的图章，放在灰色背景上便于看清白色文字
+        style = ttk.Style(selection_window)
+        style.configure("Template.Treeview", rowheight=46, background="#808080")
+        tree = ttk.Treeview(selection_window, style="Template.Treeview", show="tree",
+                            selectmode="browse")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        thumbnails = {}
+        
+        def populate(event=None):
+            tree.delete(*tree.get_children())
+            thumbnails.clear()
+            for entry in library.search(search_var.get()):
+                try:
+                    thumbnails[entry['name']] = tk.PhotoImage(data=entry['thumbnail'])
+                except tk.TclError:
+                    thumbnails[entry['name']] = ''
+                tree.insert('', tk.END, iid=entry['name'], text=f"  {entry['name']}",
+                            image=thumbnails[entry['name']])
+                    
+        def selected_name():
+            selection = tree.selection()
+            return selection[0] if selection else None
             
-        def load_selected():
-            selection = listbox.curselection()
-            if selection:
-                template_name = template_names[selection[0]]
+        def load_selected(event=None):
+            template_name = selected_name()
+            if template_name:
                 self.load_template_by_name(template_name)
                 selection_window.destroy()
                 
-        ttk.Button(selection_window, text="加载", command=load_selected).pack(pady=5)
+        def rename_selected():
+            from tkinter import simpledialog
+            template_name = selected_name()
+            if not template_name:
+                return
+            new_name = simpledialog.askstring("重命名模板", "请输入新名称:",
+                                              initialvalue=template_name,
+                                              parent=selection_window)
+            if not new_name or new_name == template_name:
+                return
+            try:
+                library.rename(template_name, new_name)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("错误", f"重命名失败: {str(e)}", parent=selection_window)
+            populate()
+            
+        def delete_selected():
+            template_name = selected_name()
+            if not template_name:
+                return
+            if not messagebox.askyesno("确认", f"确定删除模板 '{template_name}' 吗？",
+                                       parent=selection_window):
+                return
+            try:
+                library.delete(template_name)
+            except OSError as e:
+                messagebox.showerror("错误", f"删除失败: {str(e)}", parent=selection_window)
+            populate()
+            
+        search_entry.bind('<KeyRelease>', populate)
+        tree.bind('<Double-1>', load_selected)
+        
+        button_frame = ttk.Frame(selection_window)
+        button_frame.pack(pady=5)
+        ttk.Button(button_frame, text="加载", command=load_selected).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="重命名", command=rename_selected).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="删除", command=delete_selected).pack(side=tk.LEFT, padx=2)
+        
+        populate()
+        search_entry.focus_set()
         
     def load_template_by_name(self, template_name):
         """根据名称加载模板"""
         try:
-            template_path = Path("templates") / f"{template_name}.json"
-            with open(template_path, 'r', encoding='utf-8') as f:
-                template_data = json.load(f)
+            template_data = self.get_template_library().get(template_name)['data']
                 
             # 应用模板设置
             self.text_var.set(template_data.get('text', '水印文本'))
@@ -721,9 +1003,27 @@ class WatermarkApp:
             self.watermark_settings['position'] = template_data.get('position', 'center')
             self.watermark_settings['x_offset'] = template_data.get('x_offset', 0)
             self.watermark_settings['y_offset'] = template_data.get('y_offset', 0)
+            self.relative_var.set(template_data.get('relative', False))
+            if self.relative_var.get():
+                self.font_size_var.set(round(template_data.get('relative_font_size', 0.05) * 1000))
+            self.watermark_settings['relative_x_offset'] = template_data.get('relative_x_offset', 0.0)
+            self.watermark_settings['relative_y_offset'] = template_data.get('relative_y_offset', 0.0)
+            self.shadow_var.set(template_data.get('shadow', False))
+            self.stroke_width_var.set(template_data.get('stroke_width', 0))
+            self.watermark_settings['stroke_color'] = template_data.get('stroke_color', '#000000')
+            self.stroke_color_button.config(bg=self.watermark_settings['stroke_color'])
+            self.auto_contrast_var.set(template_data.get('auto_contrast', False))
             self.output_format.set(template_data.get('output_format', 'PNG'))
             self.naming_option.set(template_data.get('naming_option', 'suffix'))
             self.naming_text.set(template_data.get('naming_text', '_watermarked'))
+            resize_mode = template_data.get('resize_mode', 'none')
+            for display_name, mode in RESIZE_MODE_NAMES.items():
+                if mode == resize_mode:
+                    self.resize_mode.set(display_name)
+            self.resize_value.set(str(template_data.get('resize_value', 100)))
+            self.jpeg_patch_var.set(template_data.get('jpeg_patch', False))
+            self.csv_path.set(template_data.get('csv_path') or '')
+            self.renditions = template_data.get('renditions')
             
             # 更新预览
             self.update_preview()
@@ -745,7 +1045,6 @@ class WatermarkApp:
                 self.text_var.set(settings.get('text', '水印文本'))
                 self.font_size_var.set(settings.get('font_size', 36))
                 self.watermark_settings['color'] = settings.get('color', '#FFFFFF')
-                self.color_button.config(bg=self.watermark_settings['color'])
                 self.opacity_var.set(settings.get('opacity', 128))
                 self.watermark_settings['position'] = settings.get('position', 'center')
                 
@@ -821,6 +1120,71 @@ class WatermarkApp:
         ttk.Button(content_frame, text="确定", 
                   command=about_window.destroy).pack(pady=10)
     
+    def show_diagnostics(self):
+        """显示性能诊断窗口"""
+        diag_window = tk.Toplevel(self.root)
+        diag_window.title("性能诊断")
+        diag_window.geometry("760x420")
+        diag_window.transient(self.root)
+        
+        # 开关和操作按钮
+        toolbar = ttk.Frame(diag_window)
+        toolbar.pack(fill=tk.X, padx=10, pady=5)
+        
+        enabled_var = tk.BooleanVar(value=profiler.enabled)
+        
+        def toggle_profiling():
+            if enabled_var.get():
+                profiler.enable()
+            else:
+                profiler.disable()
+                
+        ttk.Checkbutton(toolbar, text="开启计时", variable=enabled_var,
+                        command=toggle_profiling).pack(side=tk.LEFT)
+        
+        # 各阶段耗时统计表
+        columns = ('count', 'mean', 'p50', 'p95', 'max', 'histogram')
+        tree = ttk.Treeview(diag_window, columns=columns)
+        tree.heading('#0', text="阶段")
+        tree.column('#0', width=170)
+        for column, title, width in [('count', "次数", 50), ('mean', "平均(ms)", 70),
+                                     ('p50', "P50(ms)", 70), ('p95', "P95(ms)", 70),
+                                     ('max', "最大(ms)", 70), ('histogram', "分布", 220)]:
+            tree.heading(column, text=title)
+            tree.column(column, width=width, anchor=tk.E if column != 'histogram' else tk.W)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        def refresh():
+            tree.delete(*tree.get_children())
+            bars = " ▁▂▃▄▅▆▇█"
+            for row in profiler.summary():
+                peak = max(row['histogram'])
+                histogram_text = "".join(bars[round(count / peak * 8)] for count in row['histogram'])
+                tree.insert('', tk.END, text=row['name'], values=(
+                    row['count'], f"{row['mean_ms']:.2f}", f"{row['p50_ms']:.2f}",
+                    f"{row['p95_ms']:.2f}", f"{row['max_ms']:.2f}", histogram_text))
+                
+        def clear():
+            profiler.reset()
+            refresh()
+            
+        def dump_trace():
+            from tkinter import filedialog
+            path = filedialog.asksaveasfilename(
+                title="导出 Chrome Trace", defaultextension=".json",
+                filetypes=[("JSON", "*.json")], parent=diag_window)
+            if path:
+                profiler.dump_chrome_trace(path)
+                self.update_status(f"已导出性能记录: {path}")
+                
+        ttk.Button(toolbar, text="刷新", command=refresh).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="清空", command=clear).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="导出 Chrome Trace", command=dump_trace).pack(side=tk.LEFT, padx=5)
+        
+        ttk.Label(diag_window, text="分布按 " + ", ".join(f"≤{b}" for b in profiler.HISTOGRAM_BUCKETS)
+                  + " ms 分桶", foreground="gray").pack(anchor=tk.W, padx=10, pady=(0, 5))
+        refresh()
+    
     def on_closing(self):
         """程序关闭时的处理"""
         self.save_current_settings()
@@ -833,6 +1197,16 @@ def main():
     # 绑定关闭事件
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
     
+    if startup_profile.FLAG in sys.argv:
+        def on_first_map(event):
+            if event.widget is root:
+                root.unbind('<Map>')
+                startup_profile.mark("首次绘制")
+                # 设置面板在空闲时创建，等它完成后再输出报告
+                root.after_idle(lambda: (startup_profile.mark("界面就绪"), startup_profile.report()))
+                
+        root.bind('<Map>', on_first_map)
+    
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,1327 @@
+"""
+水印引擎 - 与界面无关的水印渲染和导出流程
+"""
+
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from PIL import Image
+
+import profiler
+
+# 按优先级排列的字体路径
+FONT_PATHS = [
+    "C:/Windows/Fonts/arial.ttf",
+    "C:/Windows/Fonts/Arial.ttf",
+    "C:/Windows/Fonts/simhei.ttf",  # 黑体，支持中文
+    "C:/Windows/Fonts/simsun.ttc",  # 宋体，支持中文
+    "/System/Library/Fonts/Arial.ttf",  # macOS
+    "/usr/share/fonts/truetype/arial.ttf",  # Linux
+]
+
+# 预设位置距图片边缘的距离（像素）
+EDGE_MARGIN = 10
+
+# 预览图与画布边缘的留白（像素）
+PREVIEW_MARGIN = 20
+
+# 支持导入的图片格式
+SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
+
+# 模板文件夹
+TEMPLATES_DIR = "templates"
+
+# 导出尺寸调整方式
+RESIZE_MODES = ('none', 'width', 'height', 'percent')
+
+# 输出格式对应的扩展名
+OUTPUT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'TIFF': '.tif'}
+
+# 完整解码的像素上限，默认与 Pillow 解压炸弹报错的阈值一致
+DEFAULT_MAX_PIXELS = 2 * (Image.MAX_IMAGE_PIXELS or 89478485)
+
+DEFAULT_SETTINGS = {
+    'text': '水印文本',
+    'font_size': 36,
+    'color': '#FFFFFF',
+    'opacity': 128,
+    'position': 'center',
+    'x_offset': 0,
+    'y_offset': 0,
+    # 阴影（偏移和模糊半径以像素计）和描边，用于在复杂背景上保持可读性
+    'shadow': False,
+    'shadow_color': '#000000',
+    'shadow_opacity': 160,
+    'shadow_offset': 3,
+    'shadow_blur': 3,
+    'stroke_width': 0,
+    'stroke_color': '#000000',
+    # 按水印所在区域的亮度自动改用浅色或深色文字
+    'auto_contrast': False,
+    # 相对尺寸：开启后字号和偏移按图片短边的比例计算，忽略 font_size、x_offset、y_offset
+    'relative': False,
+    'relative_font_size': 0.05,
+    'relative_x_offset': 0.0,
+    'relative_y_offset': 0.0,
+}
+
+# 相对尺寸的设置
+RELATIVE_SETTINGS = ('relative_font_size', 'relative_x_offset', 'relative_y_offset')
+
+# 水印样式设置（阴影、描边）
+STYLE_SETTINGS = ('shadow', 'shadow_color', 'shadow_opacity', 'shadow_offset', 'shadow_blur',
+                  'stroke_width', 'stroke_color', 'auto_contrast')
+
+DEFAULT_EXPORT_OPTIONS = {
+    'output_format': 'PNG',
+    'quality': 95,
+    'naming_option': 'suffix',
+    'naming_text': '_watermarked',
+    'resize_mode': 'none',
+    'resize_value': 100,
+    # 像素上限策略：完整解码的上限，以及分块导出的上限（None 表示不限制）
+    'max_pixels': DEFAULT_MAX_PIXELS,
+    'tiled_max_pixels': None,
+    # 超过该像素数的 TIFF 在输出 TIFF 时改用分块导出
+    'tiled_threshold': 100_000_000,
+    # JPEG 输出 JPEG 时只重新编码水印覆盖的 MCU 块（需要 jpegtran）
+    'jpeg_patch': False,
+    # 批量导出的并发数和内存预算（字节），None 表示自动
+    'max_workers': None,
+    'memory_budget': None,
+    # 水印文本中 {csv.列名} 占位符使用的 CSV 数据文件
+    'csv_path': None,
+    # 多规格输出：一次解码输出多个文件，每项可设置 RENDITION_OPTIONS 中的导出设置，
+    # 例如 [{'suffix': '_web', 'resize_mode': 'width', 'resize_value': 2048}]
+    'renditions': None,
+}
+
+# 每个输出规格可以单独设置的导出设置，suffix 加在输出文件名的扩展名之前
+RENDITION_OPTIONS = ('suffix', 'output_format', 'quality', 'resize_mode', 'resize_value')
+
+# 编译进渲染计划的导出设置（影响输出像素和编码的部分）
+PLAN_EXPORT_OPTIONS = ('output_format', 'quality', 'resize_mode', 'resize_value')
+
+# EXIF 方向标签及各方向对应的转置操作
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# TIFF 描述像素布局的标签（尺寸、采样、压缩、条带/分块等），只属于原文件，
+# 写回输出文件会覆盖编码器自己的布局
+TIFF_LAYOUT_TAGS = frozenset({256, 257, 258, 259, 262, 266, 273, 277, 278, 279, 284, 317,
+                              322, 323, 324, 325, 338, 339, 530, 531, 532})
+
+# ICC 配置文件的色彩空间 -> 可以携带该配置的输出模式
+ICC_COLOR_SPACES = {b'RGB ': ('RGB', 'RGBA'), b'GRAY': ('L', 'LA')}
+
+# 自动对比色：采样区域缩小到的最大边长，文字与背景的最小亮度差，以及备选的浅色和深色
+CONTRAST_SAMPLE_SIZE = 32
+MIN_CONTRAST = 96
+CONTRAST_COLORS = ((255, 255, 255), (0, 0, 0))
+
+# 自动位置：候选的预设位置（按偏好排列，得分相同时取靠前的），没有图片时使用的位置，
+# 以及评估背景复杂度的缩略图的最大边长
+AUTO_POSITIONS = ('bottom_right', 'bottom_left', 'top_right', 'top_left', 'bottom_center',
+                  'top_center', 'middle_right', 'middle_left', 'center')
+AUTO_POSITION_FALLBACK = 'bottom_right'
+PLACEMENT_PROXY_SIZE = 256
+
+# 相对尺寸换算出的字号按约 4% 的几何级数取整，不同分辨率的图片可以共用缓存的图章
+FONT_SIZE_STEP = 1.04
+
+# 最多缓存的水印图章数，批量导出和服务进程中相同的文本只渲染一次
+STAMP_CACHE_SIZE = 64
+
+# 最多缓存的派生渲染计划数（按输出比例缩放、按图片尺寸换算相对尺寸的结果）。
+# 批量导出按图片尺寸分组调度，同一组的图片连续命中缓存
+PLAN_CACHE_SIZE = 64
+
+# ImageFont、ImageDraw 在首次渲染水印时才导入，以加快程序启动
+_font_cache = {}
+_font_path = None
+_pixel_limit_lock = threading.Lock()
+_pixel_limit_holders = 0
+_saved_pixel_limit = None
+
+
+class _LruCache:
+    """线程安全的 LRU 缓存"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_stamp_cache = _LruCache(STAMP_CACHE_SIZE)
+_plan_cache = _LruCache(PLAN_CACHE_SIZE)
+
+
+def resolve_font_path():
+    """查找第一个可用的字体文件，结果会被缓存，找不到时返回空字符串"""
+    global _font_path
+    if _font_path is None:
+        _font_path = next((path for path in FONT_PATHS if os.path.exists(path)), '')
+    return _font_path
+
+
+def load_font(font_size):
+    """加载指定字号的字体（带缓存）"""
+    from PIL import ImageFont
+
+    font_size = max(1, int(font_size))
+    font = _font_cache.get(font_size)
+    if font is not None:
+        return font
+
+    font = None
+    if resolve_font_path():
+        try:
+            font = ImageFont.truetype(resolve_font_path(), font_size)
+        except Exception as e:
+            print(f"字体加载失败: {e}")
+
+    if font is None:
+        try:
+            font = ImageFont.load_default(font_size)
+        except TypeError:
+            # 旧版本 Pillow 的默认字体不支持字号
+            font = ImageFont.load_default()
+
+    _font_cache[font_size] = font
+    return font
+
+
+def warm_up_fonts(font_sizes):
+    """预先导入字体模块、查找字体文件并加载常用字号，可在后台线程中调用"""
+    from PIL import ImageDraw  # 预先导入绘图模块
+
+    for font_size in font_sizes:
+        load_font(font_size)
+
+
+def parse_color(color, opacity):
+    """将 #RRGGBB 颜色与透明度转换为 RGBA 元组"""
+    if color.startswith('#'):
+        color = color[1:]
+    r = int(color[0:2], 16)
+    g = int(color[2:4], 16)
+    b = int(color[4:6], 16)
+    return (r, g, b, int(opacity))
+
+
+def quantize_font_size(font_size):
+    """把字号取整到 FONT_SIZE_STEP 的几何级数上，小字号保持整数精度"""
+    if font_size <= 1 / (FONT_SIZE_STEP - 1):
+        return max(1, round(font_size))
+    return round(FONT_SIZE_STEP ** round(math.log(font_size, FONT_SIZE_STEP)))
+
+
+def render_text_stamp(text, font, fill):
+    """
+    将文本渲染为紧凑的 RGBA 水印图章
+
+    返回 (图章, 文本框尺寸, 图章相对文本框原点的偏移)。
+    TrueType 字体由字形缓存拼接，只有未缓存过的字符需要光栅化。
+    """
+    from PIL import ImageDraw
+    import glyph_atlas
+
+    if glyph_atlas.supports(font):
+        with profiler.span('watermark.draw'):
+            coverage, bbox = glyph_atlas.render_mask(text, font)
+        if coverage is not None:
+            # 与 ImageDraw.text 相同：按覆盖率填充颜色
+            stamp = Image.new('RGBA', coverage.size, (0, 0, 0, 0))
+            stamp.paste(fill, (0, 0) + coverage.size, coverage)
+            return stamp, coverage.size, (bbox[0], bbox[1])
+
+    with profiler.span('watermark.text_measure'):
+        probe = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        bbox = probe.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+
+    with profiler.span('watermark.draw'):
+        stamp = Image.new('RGBA', (max(1, text_width), max(1, text_height)), (0, 0, 0, 0))
+        ImageDraw.Draw(stamp).text((-bbox[0], -bbox[1]), text, font=font, fill=fill)
+    return stamp, (text_width, text_height), (bbox[0], bbox[1])
+
+
+def has_effects(style):
+    """样式中是否启用了阴影或描边"""
+    return bool(style) and (style['shadow'] or style['stroke_width'] > 0)
+
+
+def render_styled_stamp(text, font, fill, style):
+    """
+    渲染带阴影和描边的图章，返回值与 render_text_stamp 相同
+
+    描边和阴影都在紧凑的图章遮罩上计算，高斯模糊只作用于图章大小的区域；
+    结果随图章一起缓存，批量导出时每张图片的开销与普通水印相同。
+    文本框尺寸不包含效果，开启效果不会改变文字的位置。
+    """
+    from PIL import ImageDraw, ImageFilter
+
+    stroke_width = style['stroke_width']
+    with profiler.span('watermark.text_measure'):
+        probe = ImageDraw.Draw(Image.new('L', (1, 1)))
+        bbox = probe.textbbox((0, 0), text, font=font)
+        outer = probe.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    size = (max(1, outer[2] - outer[0]), max(1, outer[3] - outer[1]))
+
+    with profiler.span('watermark.draw'):
+        glyphs = Image.new('L', size, 0)
+        ImageDraw.Draw(glyphs).text((-outer[0], -outer[1]), text, fill=255, font=font)
+        body = glyphs
+        if stroke_width > 0:
+            body = Image.new('L', size, 0)
+            ImageDraw.Draw(body).text((-outer[0], -outer[1]), text, fill=255, font=font,
+                                      stroke_width=stroke_width, stroke_fill=255)
+
+    layers = []  # (颜色, 遮罩, 相对文本原点的位置)，从下到上
+    if style['shadow']:
+        with profiler.span('watermark.shadow'):
+            blur = style['shadow_blur']
+            pad = math.ceil(blur * 3)
+            shadow = Image.new('L', (size[0] + 2 * pad, size[1] + 2 * pad), 0)
+            shadow.paste(body, (pad, pad))
+            if blur > 0:
+                shadow = shadow.filter(ImageFilter.GaussianBlur(blur))
+            shadow_opacity = style['shadow_opacity']
+            shadow = shadow.point(lambda v: v * shadow_opacity // 255)
+        offset = style['shadow_offset']
+        layers.append((style['shadow_color'], shadow,
+                       (outer[0] - pad + offset, outer[1] - pad + offset)))
+    if stroke_width > 0:
+        layers.append((style['stroke_color'], body, (outer[0], outer[1])))
+    layers.append((fill[:3], glyphs, (outer[0], outer[1])))
+
+    left = min(position[0] for _, _, position in layers)
+    top = min(position[1] for _, _, position in layers)
+    right = max(position[0] + mask.width for _, mask, position in layers)
+    bottom = max(position[1] + mask.height for _, mask, position in layers)
+
+    with profiler.span('watermark.compose'):
+        stamp = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        for color, mask, (x, y) in layers:
+            layer = Image.new('RGBA', mask.size, color)
+            layer.putalpha(mask)
+            stamp.alpha_composite(layer, (x - left, y - top))
+        # 整体透明度最后统一应用，重叠的描边和文字不会叠加得更不透明
+        opacity = fill[3]
+        stamp.putalpha(stamp.getchannel('A').point(lambda v: v * opacity // 255))
+    return stamp, (bbox[2] - bbox[0], bbox[3] - bbox[1]), (left, top)
+
+
+def parse_style(settings):
+    """把阴影、描边设置整理为渲染使用的字典，颜色解析为 RGB 元组"""
+    settings = {**DEFAULT_SETTINGS, **settings}
+    return {
+        'shadow': bool(settings['shadow']),
+        'shadow_color': parse_color(settings['shadow_color'], 255)[:3],
+        'shadow_opacity': max(0, min(255, int(settings['shadow_opacity']))),
+        'shadow_offset': int(settings['shadow_offset']),
+        'shadow_blur': max(0, int(settings['shadow_blur'])),
+        'stroke_width': max(0, int(settings['stroke_width'])),
+        'stroke_color': parse_color(settings['stroke_color'], 255)[:3],
+        'auto_contrast': bool(settings['auto_contrast']),
+    }
+
+
+def render_stamp_cached(text, font_size, fill, style=None):
+    """按 (文本, 字号, 颜色, 样式) 缓存渲染结果，图章只读，可在多处共用"""
+    effects = has_effects(style)
+    key = (text, max(1, int(font_size)), fill,
+           tuple(sorted(style.items())) if effects else None)
+    cached = _stamp_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with profiler.span('watermark.font_load'):
+        font = load_font(font_size)
+    if effects:
+        rendered = render_styled_stamp(text, font, fill, style)
+    else:
+        rendered = render_text_stamp(text, font, fill)
+    _stamp_cache.put(key, rendered)
+    return rendered
+
+
+def clear_stamp_cache():
+    """清空水印图章、派生渲染计划和字形缓存"""
+    import glyph_atlas
+
+    _stamp_cache.clear()
+    _plan_cache.clear()
+    glyph_atlas.get_atlas().clear()
+
+
+def calculate_watermark_position(image_size, text_width, text_height, settings,
+                                 margin=EDGE_MARGIN):
+    """计算水印位置"""
+    img_width, img_height = image_size
+    position = settings.get('position', 'center')
+    x_offset = settings.get('x_offset', 0)
+    y_offset = settings.get('y_offset', 0)
+    if position == 'auto':
+        # 没有图片可供分析（分块导出等）时使用固定位置
+        position = AUTO_POSITION_FALLBACK
+
+    if position == 'custom':
+        # 自定义位置，直接使用偏移值
+        x = img_width // 2 + x_offset - text_width // 2
+        y = img_height // 2 + y_offset - text_height // 2
+    else:
+        # 预设位置
+        positions = {
+            'top_left': (margin, margin),
+            'top_center': ((img_width - text_width) // 2, margin),
+            'top_right': (img_width - text_width - margin, margin),
+            'middle_left': (margin, (img_height - text_height) // 2),
+            'center': ((img_width - text_width) // 2, (img_height - text_height) // 2),
+            'middle_right': (img_width - text_width - margin, (img_height - text_height) // 2),
+            'bottom_left': (margin, img_height - text_height - margin),
+            'bottom_center': ((img_width - text_width) // 2, img_height - text_height - margin),
+            'bottom_right': (img_width - text_width - margin, img_height - text_height - margin)
+        }
+
+        base_x, base_y = positions.get(position, positions['center'])
+
+        # 添加偏移
+        x = base_x + x_offset
+        y = base_y + y_offset
+
+    # 确保水印不会超出图片边界
+    x = max(0, min(x, img_width - text_width))
+    y = max(0, min(y, img_height - text_height))
+
+    return x, y
+
+
+def placement_proxy(image):
+    """
+    用于评估背景复杂度的边缘强度缩略图（灰度），返回 (缩略图, 缩小比例)
+
+    先用最近邻采样取出约两倍大小的缩略图（不触及整张图片的像素），
+    再用 reduce(2) 平均，避免最近邻采样的噪点被当成边缘。
+    """
+    from PIL import ImageDraw, ImageFilter
+
+    scale = min(1.0, PLACEMENT_PROXY_SIZE / max(image.size))
+    size = (max(2, round(image.width * scale) * 2), max(2, round(image.height * scale) * 2))
+    proxy = image.resize(size, Image.Resampling.NEAREST).convert('L').reduce(2)
+    edges = proxy.filter(ImageFilter.FIND_EDGES)
+    # 滤镜不处理最外一圈像素（保留原值），清零以免图片边缘被误判为复杂
+    ImageDraw.Draw(edges).rectangle((0, 0, edges.width - 1, edges.height - 1), outline=0)
+    return edges, edges.width / image.width
+
+
+def choose_position(image, stamp_size, settings, margin=EDGE_MARGIN, offset=(0, 0)):
+    """
+    在九个预设位置中选择背景最简单（边缘强度平均值最小）的一个
+
+    stamp_size 为文本框尺寸，offset 为图章相对文本框的偏移；
+    评分只在 PLACEMENT_PROXY_SIZE 大小的缩略图上进行，每个候选只做一次区域统计。
+    """
+    from PIL import ImageStat
+
+    with profiler.span('watermark.placement'):
+        edges, scale = placement_proxy(image)
+        scores = []
+        for position in AUTO_POSITIONS:
+            x, y = calculate_watermark_position(image.size, *stamp_size,
+                                                {**settings, 'position': position}, margin)
+            box = (int((x + offset[0]) * scale), int((y + offset[1]) * scale),
+                   math.ceil((x + offset[0] + stamp_size[0]) * scale),
+                   math.ceil((y + offset[1] + stamp_size[1]) * scale))
+            box = (max(0, box[0]), max(0, box[1]),
+                   min(edges.width, max(box[2], box[0] + 1)),
+                   min(edges.height, max(box[3], box[1] + 1)))
+            scores.append(ImageStat.Stat(edges.crop(box)).mean[0])
+        return AUTO_POSITIONS[scores.index(min(scores))]
+
+
+def luminance(color):
+    """RGB 颜色的亮度（0-255），与 Image.convert('L') 的公式相同"""
+    r, g, b = color[:3]
+    return (r * 299 + g * 587 + b * 114) / 1000
+
+
+def region_luminance(image, box):
+    """
+    图片指定区域的平均亮度
+
+    只取出该区域，转为灰度后用 reduce() 缩小到 CONTRAST_SAMPLE_SIZE 左右再统计，
+    开销与图片分辨率无关。区域与图片不相交时返回 None。
+    """
+    from PIL import ImageStat
+
+    box = (max(0, box[0]), max(0, box[1]),
+           min(image.width, box[2]), min(image.height, box[3]))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    with profiler.span('watermark.contrast'):
+        # 不在整张图上调用 reduce(box=...)：RGBA 图片会先整体转换为预乘透明度
+        region = image.crop(box).convert('L')
+        factor = max(1, max(region.size) // CONTRAST_SAMPLE_SIZE)
+        return ImageStat.Stat(region.reduce(factor)).mean[0]
+
+
+def contrast_color(color, background):
+    """文字颜色与背景亮度差足够时保持不变，否则改用对比更强的浅色或深色"""
+    if background is None or abs(luminance(color) - background) >= MIN_CONTRAST:
+        return color
+    light, dark = CONTRAST_COLORS
+    return light if background < 128 else dark
+
+
+def contrast_plan(settings, image, box):
+    """
+    开启自动对比色时，按 image 中 box 区域的亮度选择文字颜色，返回该图片的渲染计划
+
+    透明度不变；两种颜色的图章都会被缓存，批量导出中不会重复渲染。
+    """
+    plan = settings if isinstance(settings, RenderPlan) else compile_plan(settings)
+    if not dict(plan.style).get('auto_contrast'):
+        return plan
+    color = contrast_color(plan.fill[:3], region_luminance(image, box))
+    if color == plan.fill[:3]:
+        return plan
+    r, g, b = color
+    return compile_plan({**plan.settings(), 'color': f'#{r:02X}{g:02X}{b:02X}'},
+                        plan.options(), plan.runs)
+
+
+def composite_stamp(image, stamp, x, y):
+    """把图章就地叠加到 RGBA 图片的 (x, y) 处，只处理相交区域"""
+    left, top = max(0, x), max(0, y)
+    right = min(image.width, x + stamp.width)
+    bottom = min(image.height, y + stamp.height)
+    if right <= left or bottom <= top:
+        return image
+
+    source = (left - x, top - y, right - x, bottom - y)
+    image.alpha_composite(stamp, dest=(left, top), source=source)
+    return image
+
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """
+    编译后的水印模板：字体、颜色、图章、位置规则和编码设置都已解析
+
+    不可变且可哈希；key 是跨进程稳定的摘要，可作为预览、导出等缓存的键。
+    预先渲染的图章不参与比较和哈希。runs 为展开占位符后的文本片段（见 text_fields），
+    非空表示文本已按图片展开，不会再次展开。
+    """
+    text: str
+    font_path: str
+    font_size: int
+    fill: tuple
+    position: str
+    x_offset: int
+    y_offset: int
+    export_options: tuple  # 排序后的 (导出设置名, 值)
+    style: tuple           # (样式设置名, 值)，即 parse_style 的结果
+    relative: tuple        # 相对尺寸 (字号, 横向偏移, 纵向偏移)，空元组表示使用像素值
+    stamp: tuple = field(compare=False, repr=False)  # (图章, 文本框尺寸, 偏移)
+    runs: tuple = field(default=(), compare=False)
+    key: str = field(init=False, compare=False)
+
+    def __post_init__(self):
+        digest = hashlib.sha256(json.dumps(
+            [self.text, self.font_path, self.font_size, self.fill, self.position,
+             self.x_offset, self.y_offset, self.export_options, self.style, self.relative],
+            ensure_ascii=False).encode('utf-8'))
+        object.__setattr__(self, 'key', digest.hexdigest()[:16])
+
+    def position_rule(self):
+        """位置规则，格式与水印设置相同"""
+        return {'position': self.position, 'x_offset': self.x_offset, 'y_offset': self.y_offset}
+
+    def settings(self):
+        """还原为水印设置字典"""
+        r, g, b, opacity = self.fill
+        return {'text': self.text, 'font_size': self.font_size,
+                'color': f'#{r:02X}{g:02X}{b:02X}', 'opacity': opacity,
+                **self.position_rule(),
+                **{key: f'#{value[0]:02X}{value[1]:02X}{value[2]:02X}'
+                   if isinstance(value, tuple) else value for key, value in self.style},
+                'relative': bool(self.relative),
+                **dict(zip(RELATIVE_SETTINGS, self.relative))}
+
+    def options(self):
+        """编译进计划的导出设置"""
+        return dict(self.export_options)
+
+    def resolved(self, image_size):
+        """
+        按图片尺寸把相对尺寸换算为像素，返回新的计划；未使用相对尺寸时返回自身
+
+        字号按 quantize_font_size 取整，尺寸相近的图片得到相同的计划和图章。
+        """
+        if not self.relative:
+            return self
+        short_edge = min(image_size)
+        key = (self.key, 'resolved', short_edge)
+        plan = _plan_cache.get(key)
+        if plan is None:
+            font_size, x_offset, y_offset = self.relative
+            plan = compile_plan({**self.settings(), 'relative': False,
+                                 'font_size': quantize_font_size(font_size * short_edge),
+                                 'x_offset': round(x_offset * short_edge),
+                                 'y_offset': round(y_offset * short_edge)},
+                                self.options(), self.runs)
+            _plan_cache.put(key, plan)
+        return plan
+
+    def scaled(self, factor):
+        """按输出比例缩放字号和偏移，返回新的计划"""
+        if factor == 1:
+            return self
+        key = (self.key, 'scaled', factor)
+        plan = _plan_cache.get(key)
+        if plan is None:
+            plan = compile_plan(scale_settings(self.settings(), factor), self.options(),
+                                self.runs)
+            _plan_cache.put(key, plan)
+        return plan
+
+
+def compile_plan(settings, options=None, runs=None):
+    """把水印设置和导出设置编译为渲染计划，runs 为已展开占位符的文本片段"""
+    settings = {**DEFAULT_SETTINGS, **settings}
+    options = {**DEFAULT_EXPORT_OPTIONS, **(options or {})}
+    font_size = max(1, int(settings['font_size']))
+    fill = parse_color(settings['color'], settings['opacity'])
+    if runs:
+        settings['text'] = ''.join(runs)
+    style = parse_style(settings)
+    stamp = render_stamp_cached(settings['text'], font_size, fill, style)
+    return RenderPlan(
+        text=settings['text'],
+        font_path=resolve_font_path(),
+        font_size=font_size,
+        fill=fill,
+        position=settings['position'],
+        x_offset=int(settings['x_offset']),
+        y_offset=int(settings['y_offset']),
+        export_options=tuple((key, options[key]) for key in PLAN_EXPORT_OPTIONS),
+        style=tuple(style.items()),
+        relative=tuple(float(settings[key]) for key in RELATIVE_SETTINGS)
+        if settings['relative'] else (),
+        stamp=stamp,
+        runs=tuple(runs or ()),
+    )
+
+
+def bind_text_fields(settings, options, name, path=None, image=None, index=1):
+    """
+    为一张图片展开水印文本中的占位符（文件名、拍摄日期、序号、CSV 数据等）
+
+    文本没有占位符时原样返回 settings；否则返回该图片的渲染计划。
+    """
+    import text_fields
+
+    if isinstance(settings, RenderPlan) and settings.runs:
+        return settings  # 已经展开过
+    template = settings.settings() if isinstance(settings, RenderPlan) else settings
+    text = template.get('text', DEFAULT_SETTINGS['text'])
+    if not text_fields.has_fields(text):
+        return settings
+
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    values = text_fields.collect_values(text, name, path, image, index, options['csv_path'])
+    return compile_plan(template, options, text_fields.expand_runs(text, values))
+
+
+def compile_template(template_data):
+    """把模板数据编译为渲染计划，返回 (渲染计划, 导出设置)"""
+    settings, options = split_template(template_data)
+    return compile_plan(settings, options), options
+
+
+def prepare_stamp(image_size, settings, margin=EDGE_MARGIN, image=None):
+    """
+    渲染水印图章并计算其在图片上的左上角坐标，settings 可以是渲染计划
+
+    提供 image 时，位置为 auto 则选择背景最简单的预设位置（见 choose_position），
+    并按水印区域的亮度应用自动对比色（见 contrast_plan）。
+    """
+    plan = settings if isinstance(settings, RenderPlan) else compile_plan(settings)
+    plan = plan.resolved(image_size)
+    stamp, (text_width, text_height), (dx, dy) = plan.stamp
+
+    rule = plan.position_rule()
+    if rule['position'] == 'auto' and image is not None:
+        rule['position'] = choose_position(image, (text_width, text_height), rule, margin,
+                                           (dx, dy))
+    x, y = calculate_watermark_position(image_size, text_width, text_height, rule, margin)
+    x, y = x + dx, y + dy
+    if image is not None:
+        stamp = contrast_plan(plan, image, (x, y, x + stamp.width, y + stamp.height)).stamp[0]
+    return stamp, (x, y)
+
+
+def apply_watermark(image, settings, margin=EDGE_MARGIN):
+    """应用水印到图片，返回 RGBA 图片（输入已是 RGBA 时就地修改）"""
+    with profiler.span('apply_watermark'):
+        if image.mode != 'RGBA':
+            with profiler.span('watermark.convert'):
+                image = image.convert('RGBA')
+
+        stamp, (x, y) = prepare_stamp(image.size, settings, margin, image)
+        with profiler.span('watermark.composite'):
+            return composite_stamp(image, stamp, x, y)
+
+
+def read_metadata(image):
+    """
+    从文件头读取 EXIF、方向和 ICC 配置，不解码像素
+
+    Pillow 11.0 起打开 TIFF 时已按方向标签给出正向尺寸，解码时也会自动转正
+    （requirements.txt 要求该版本），因此 TIFF 的方向按 1 返回，避免再转一次。
+    TIFF 的 EXIF 就是整个 IFD，复制一份并去掉像素布局标签，只保留描述信息。
+    """
+    exif = image.getexif()
+    orientation = exif.get(ORIENTATION_TAG, 1)
+    if orientation not in ORIENTATION_TRANSPOSE:
+        orientation = 1
+    if image.format == 'TIFF':
+        orientation = 1
+        tiff_exif, exif = exif, Image.Exif()
+        exif.load(tiff_exif.tobytes())
+        for tag in TIFF_LAYOUT_TAGS & set(exif):
+            del exif[tag]
+    return {
+        'exif': exif,
+        'orientation': orientation,
+        'icc_profile': image.info.get('icc_profile')
+    }
+
+
+def oriented_size(size, orientation):
+    """按 EXIF 方向换算显示尺寸（方向 5-8 宽高互换）"""
+    if orientation in (5, 6, 7, 8):
+        return size[1], size[0]
+    return tuple(size)
+
+
+def apply_orientation(image, orientation):
+    """按 EXIF 方向把图片转为正向"""
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    return image.transpose(method) if method is not None else image
+
+
+def _transpose_point(point, size, method):
+    """计算一个坐标点经过转置后的位置，size 为转置前的图片尺寸"""
+    x, y = point
+    width, height = size
+    return {
+        Image.Transpose.FLIP_LEFT_RIGHT: (width - x, y),
+        Image.Transpose.FLIP_TOP_BOTTOM: (x, height - y),
+        Image.Transpose.ROTATE_180: (width - x, height - y),
+        Image.Transpose.ROTATE_90: (y, width - x),
+        Image.Transpose.ROTATE_270: (height - y, x),
+        Image.Transpose.TRANSPOSE: (y, x),
+        Image.Transpose.TRANSVERSE: (height - y, width - x),
+    }[method]
+
+
+def stamp_to_raw(stamp, position, display_size, orientation):
+    """
+    把正向坐标系中的图章换算到文件的原始像素方向
+
+    用于不解码整图、直接改写原始数据的导出方式，返回 (图章, 左上角坐标)。
+    """
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    if method is None:
+        return stamp, position
+
+    # 方向 6/8 的逆操作互换，其余转置是自身的逆
+    inverse = {
+        Image.Transpose.ROTATE_90: Image.Transpose.ROTATE_270,
+        Image.Transpose.ROTATE_270: Image.Transpose.ROTATE_90,
+    }.get(method, method)
+
+    x, y = position
+    corners = [_transpose_point(point, display_size, inverse)
+               for point in ((x, y), (x + stamp.width, y + stamp.height))]
+    left = min(corner[0] for corner in corners)
+    top = min(corner[1] for corner in corners)
+    return stamp.transpose(inverse), (left, top)
+
+
+def build_save_params(metadata, output_format, mode):
+    """生成保存参数：写回 EXIF（方向重置为正向）和匹配的 ICC 配置"""
+    params = {}
+    if not metadata:
+        return params
+
+    exif = metadata.get('exif')
+    if exif:
+        if ORIENTATION_TAG in exif:
+            exif[ORIENTATION_TAG] = 1
+        params['exif'] = exif.tobytes()
+
+    icc_profile = metadata.get('icc_profile')
+    if icc_profile and mode in ICC_COLOR_SPACES.get(icc_profile[16:20], ()):
+        params['icc_profile'] = icc_profile
+    return params
+
+
+def fit_scale(image_size, canvas_size, margin=PREVIEW_MARGIN):
+    """计算适应画布的缩放比例（不放大图片）"""
+    img_width, img_height = image_size
+    canvas_width, canvas_height = canvas_size
+    scale_x = (canvas_width - margin) / img_width
+    scale_y = (canvas_height - margin) / img_height
+    return min(scale_x, scale_y, 1.0)
+
+
+def fast_downscale(image, target_size):
+    """
+    交互过程中使用的快速缩小，耗时与输出尺寸成正比
+
+    先最近邻采样到两倍尺寸，再用 reduce(2) 平均，效果接近双线性插值，
+    但不需要读取原图的全部像素。
+    """
+    width, height = target_size
+    if image.width < 2 * width or image.height < 2 * height:
+        return image.resize(target_size, Image.Resampling.BILINEAR)
+    sampled = image.resize((2 * width, 2 * height), Image.Resampling.NEAREST)
+    if sampled.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        sampled = sampled.convert('RGBA')
+    return sampled.reduce(2)
+
+
+class PreviewPyramid:
+    """
+    一张图片的多分辨率金字塔，每一级是上一级 reduce(2) 的结果
+
+    各级在第一次需要时才生成，随解码后的图片一起保存；任意显示比例都从不小于
+    所需尺寸的最小一级缩放，窗口缩放、缩放查看时不需要再处理原图的全部像素。
+    """
+
+    def __init__(self, image):
+        self.levels = [image]
+
+    @property
+    def image(self):
+        return self.levels[0]
+
+    def level_for(self, scale):
+        """返回 (不小于 scale 倍原图尺寸的最小一级, 该级相对原图的比例)"""
+        target = self.image.width * scale
+        # 下一级仍不小于所需尺寸时继续生成（reduce 的结果向上取整）
+        while (self.levels[-1].width + 1) // 2 >= target and min(self.levels[-1].size) >= 4:
+            level = self.levels[-1]
+            if level.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+                level = level.convert('RGBA')
+            with profiler.span('preview.pyramid'):
+                self.levels.append(level.reduce(2))
+        level = next((level for level in reversed(self.levels) if level.width >= target),
+                     self.image)
+        return level, level.width / self.image.width
+
+
+def render_preview(image, settings, canvas_size, fast=False, pyramid=None):
+    """
+    渲染预览图，返回 (缩放到画布大小的水印图片, 缩放比例)
+
+    fast 为 True 时（拖拽、输入等交互过程中）先快速缩小原图，再按预览尺寸渲染水印；
+    否则在原图上渲染水印后用 LANCZOS 缩小，与导出结果一致；提供 image 的金字塔
+    （PreviewPyramid）时改为在不小于预览尺寸的最小一级上渲染水印再缩小。
+    """
+    scale = fit_scale(image.size, canvas_size)
+    new_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    if fast:
+        # 最近邻采样只读取输出尺寸的像素，直接从原图采样比从金字塔缩放更快
+        with profiler.span('preview.resize'):
+            small = fast_downscale(image, new_size) if scale < 1 else image
+        with profiler.span('preview.render'):
+            if small is image and image.mode == 'RGBA':
+                small = image.copy()
+            return apply_watermark(small, scale_settings(settings, scale),
+                                   margin=max(0, round(EDGE_MARGIN * scale))), scale
+
+    source, source_scale = pyramid.level_for(scale) if pyramid is not None else (image, 1.0)
+    with profiler.span('preview.render'):
+        if source.mode == 'RGBA':
+            source = source.copy()
+        watermarked = apply_watermark(source, scale_settings(settings, source_scale),
+                                      margin=max(0, round(EDGE_MARGIN * source_scale)))
+
+    with profiler.span('preview.resize'):
+        return watermarked.resize(new_size, Image.Resampling.LANCZOS), scale
+
+
+def clamp_view_center(image_size, canvas_size, zoom, center):
+    """把缩放查看的可见区域中心限制在图片内，使可见区域不超出图片"""
+    clamped = []
+    for length, view, middle in zip(image_size, canvas_size, center):
+        half = min(length, view / zoom) / 2
+        clamped.append(min(max(half, middle), length - half))
+    return tuple(clamped)
+
+
+def viewport_box(image_size, canvas_size, zoom, center):
+    """
+    缩放查看时画布可见区域在原图中的范围 (left, top, right, bottom)
+
+    center 为可见区域中心在原图中的坐标，超出图片时向内平移；
+    图片缩放后小于画布的方向取整个图片。
+    """
+    center = clamp_view_center(image_size, canvas_size, zoom, center)
+    box = []
+    for length, view, middle in zip(image_size, canvas_size, center):
+        half = min(length, view / zoom) / 2
+        box.append((max(0, math.floor(middle - half)), min(length, math.ceil(middle + half))))
+    (left, right), (top, bottom) = box
+    return left, top, right, bottom
+
+
+def render_viewport(image, settings, canvas_size, zoom, center, fast=False, pyramid=None):
+    """
+    缩放查看：只渲染画布可见的区域，返回 (可见区域的水印图片, 该区域在原图中的范围)
+
+    zoom 为显示比例（1 表示 100%）。从金字塔中不小于显示比例的一级裁出可见区域，
+    只在这一块上叠加按该级比例渲染的水印，耗时与画布大小成正比，与原图大小无关；
+    100% 时结果与导出图片的对应区域逐像素一致。放大时使用最近邻插值以便检查像素，
+    缩小时 fast 为 True 用双线性插值，否则用 LANCZOS。
+    """
+    box = viewport_box(image.size, canvas_size, zoom, center)
+    output_size = (max(1, round((box[2] - box[0]) * zoom)),
+                   max(1, round((box[3] - box[1]) * zoom)))
+    source, source_scale = pyramid.level_for(zoom) if pyramid is not None else (image, 1.0)
+    source_box = (math.floor(box[0] * source_scale), math.floor(box[1] * source_scale),
+                  min(source.width, math.ceil(box[2] * source_scale)),
+                  min(source.height, math.ceil(box[3] * source_scale)))
+
+    with profiler.span('preview.render'):
+        stamp, (x, y) = prepare_stamp(source.size, scale_settings(settings, source_scale),
+                                      max(0, round(EDGE_MARGIN * source_scale)), source)
+        region = source.crop(source_box)
+        if region.mode != 'RGBA':
+            region = region.convert('RGBA')
+        composite_stamp(region, stamp, x - source_box[0], y - source_box[1])
+
+    if region.size != output_size:
+        if zoom >= 1:
+            resample = Image.Resampling.NEAREST
+        else:
+            resample = Image.Resampling.BILINEAR if fast else Image.Resampling.LANCZOS
+        with profiler.span('preview.resize'):
+            region = region.resize(output_size, resample)
+    return region, box
+
+
+def scale_settings(settings, factor):
+    """按输出比例缩放字号和偏移，使水印在输出尺寸下重新渲染"""
+    if isinstance(settings, RenderPlan):
+        return settings.scaled(factor)
+    # 未写出的效果参数按默认值缩放，与 compile_plan 之后再缩放的结果一致
+    settings = {**DEFAULT_SETTINGS, **settings}
+    if factor == 1:
+        return settings
+    scaled = dict(settings)
+    if not settings['relative']:
+        # 相对尺寸按输出图片换算，不需要缩放
+        scaled['font_size'] = max(1, round(settings['font_size'] * factor))
+        scaled['x_offset'] = round(settings['x_offset'] * factor)
+        scaled['y_offset'] = round(settings['y_offset'] * factor)
+    for key in ('shadow_offset', 'shadow_blur', 'stroke_width'):
+        if settings[key]:
+            # 开启的效果缩小后至少保留 1 像素
+            value = settings[key] * factor
+            scaled[key] = max(1, round(abs(value))) * (1 if value > 0 else -1)
+    return scaled
+
+
+def compute_resize_target(size, resize_mode, resize_value):
+    """根据缩放方式计算导出尺寸，不需要缩放时返回 None"""
+    width, height = size
+    if resize_mode not in RESIZE_MODES or resize_mode == 'none':
+        return None
+
+    value = float(resize_value)
+    if value <= 0:
+        raise ValueError(f"无效的缩放数值: {resize_value}")
+
+    if resize_mode == 'width':
+        target = (int(value), round(height * value / width))
+    elif resize_mode == 'height':
+        target = (round(width * value / height), int(value))
+    else:  # percent
+        target = (round(width * value / 100), round(height * value / 100))
+
+    target = (max(1, target[0]), max(1, target[1]))
+    return None if target == (width, height) else target
+
+
+def downscale(image, target_size):
+    """先用 reduce() 做整数倍缩小，再用 LANCZOS 调整到精确尺寸"""
+    width, height = image.size
+    target_width, target_height = target_size
+    factor = min(width // target_width, height // target_height)
+    if factor >= 2:
+        image = image.reduce(factor)
+    if image.size != tuple(target_size):
+        image = image.resize(target_size, Image.Resampling.LANCZOS)
+    return image
+
+
+def resize_for_export(image, target_size):
+    """
+    导出前的尺寸调整阶段
+
+    对尚未解码的 JPEG 先请求 draft 解码（DCT 域按 1/2、1/4、1/8 缩小），
+    再做整数倍 reduce() 和最终的精确缩放。
+    """
+    if target_size is None:
+        return image
+
+    target_width, target_height = target_size
+    if target_width < image.width and target_height < image.height:
+        if image.format == 'JPEG':
+            # 已解码的图片上 draft() 不会生效
+            image.draft(image.mode, target_size)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'CMYK'):
+            image = image.convert('RGBA')
+        return downscale(image, target_size)
+    return image.resize(target_size, Image.Resampling.LANCZOS)
+
+
+def build_output_name(name, naming_option, naming_text, output_format):
+    """生成输出文件名"""
+    original_name = Path(name).stem
+
+    if naming_option == "original":
+        new_name = original_name
+    elif naming_option == "prefix":
+        new_name = f"{naming_text}{original_name}"
+    else:  # suffix
+        new_name = f"{original_name}{naming_text}"
+
+    output_ext = OUTPUT_EXTENSIONS.get(output_format, ".png")
+    return f"{new_name}{output_ext}"
+
+
+def flatten_for_jpeg(image):
+    """转换为RGB模式（JPEG不支持透明度）"""
+    if image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def render_export(image, settings, options, metadata=None):
+    """执行导出流程：缩放 -> 转为正向 -> 按输出尺寸渲染水印 -> 格式转换"""
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    orientation = (metadata or read_metadata(image))['orientation']
+    display_size = oriented_size(image.size, orientation)
+
+    # 缩放尺寸按正向计算，在原始方向的图片上执行，再转置已缩小的图片
+    target = compute_resize_target(display_size, options['resize_mode'], options['resize_value'])
+    if target is not None:
+        target = oriented_size(target, orientation)
+    with profiler.span('export.resize'):
+        image = resize_for_export(image, target)
+    with profiler.span('export.orient'):
+        image = apply_orientation(image, orientation)
+
+    return finish_export(image, settings, options, display_size)
+
+
+def finish_export(image, settings, options, display_size):
+    """在已缩放、转正的图片上按输出尺寸渲染水印，并转换为输出格式需要的模式"""
+    factor = image.width / display_size[0]
+    watermarked = apply_watermark(image, scale_settings(settings, factor),
+                                  margin=max(0, round(EDGE_MARGIN * factor)))
+
+    if options['output_format'] == 'JPEG':
+        with profiler.span('export.convert'):
+            watermarked = flatten_for_jpeg(watermarked)
+    return watermarked
+
+
+def rendition_options(options):
+    """展开多规格输出，返回每个规格完整的导出设置（未设置的项沿用 options）"""
+    return [{**options, 'suffix': '',
+             **{key: value for key, value in rendition.items() if key in RENDITION_OPTIONS}}
+            for rendition in options['renditions']]
+
+
+def _export_rendition(level, name, settings, options, metadata, display_size, output_dir):
+    """为一个规格渲染水印并编码，level 是该规格尺寸的无水印图片（只读）"""
+    if level.mode == 'RGBA':
+        level = level.copy()  # apply_watermark 会就地修改 RGBA 图片，下一级还要从它缩小
+    result = finish_export(level, settings, options, display_size)
+
+    output_path = rendition_path(name, options, output_dir)
+    output_format, params = encode_params(metadata, options, result.mode)
+    write_image(result, output_path, output_format, params)
+    return output_path
+
+
+def rendition_path(name, options, output_dir):
+    """一个规格的输出路径（文件名加上规格的后缀）"""
+    output_name = build_output_name(name, options['naming_option'],
+                                    options['naming_text'], options['output_format'])
+    root, ext = os.path.splitext(output_name)
+    return os.path.join(output_dir, f"{root}{options['suffix']}{ext}")
+
+
+def export_renditions(image, name, settings, options, output_dir):
+    """
+    一次解码输出多个规格（如原图、网页版、缩略图），返回与 renditions 顺序相同的输出路径
+
+    各规格按尺寸从大到小排列，每一级由上一级缩小得到（级联缩放），解码和大部分
+    缩放只做一次；每一级按自己的比例渲染水印，水印和编码在线程池中并行进行。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    specs = rendition_options(options)
+    # 两个规格写到同一文件会互相覆盖，在解码和提交任务前拒绝
+    seen = set()
+    for spec in specs:
+        output_path = rendition_path(name, spec, output_dir)
+        if os.path.normcase(output_path) in seen:
+            raise ValueError(f"多个规格的输出文件相同，请设置不同的后缀: "
+                             f"{os.path.basename(output_path)}")
+        seen.add(os.path.normcase(output_path))
+    metadata = read_metadata(image)
+    orientation = metadata['orientation']
+    display_size = oriented_size(image.size, orientation)
+    targets = [compute_resize_target(display_size, spec['resize_mode'], spec['resize_value'])
+               or display_size for spec in specs]
+    order = sorted(range(len(specs)), key=lambda i: targets[i][0] * targets[i][1], reverse=True)
+
+    # 最大的规格也比原图小时，解码阶段就可以缩小（JPEG draft、reduce）
+    largest = targets[order[0]]
+    with profiler.span('export.resize'):
+        level = resize_for_export(image, None if largest == display_size
+                                  else oriented_size(largest, orientation))
+    with profiler.span('export.orient'):
+        level = apply_orientation(level, orientation)
+    if level.mode not in ('RGB', 'RGBA', 'L', 'LA', 'CMYK'):
+        level = level.convert('RGBA')
+    level.load()  # 各线程共用这一级图片，在提交任务前完成解码
+
+    with ThreadPoolExecutor(max_workers=min(len(specs), os.cpu_count() or 1)) as pool:
+        futures = {}
+        for i in order:
+            if level.size != targets[i]:
+                with profiler.span('export.resize'):
+                    level = downscale(level, targets[i])
+            futures[i] = pool.submit(_export_rendition, level, name, settings, specs[i],
+                                     metadata, display_size, output_dir)
+        return [futures[i].result() for i in range(len(specs))]
+
+
+def encode_params(metadata, options, mode):
+    """确定输出格式和保存参数，返回 (输出格式, 参数)"""
+    output_format = options['output_format'] if options['output_format'] in OUTPUT_EXTENSIONS else 'PNG'
+    params = build_save_params(metadata, output_format, mode)
+    if output_format == "JPEG":
+        params['quality'] = int(options['quality'])
+    return output_format, params
+
+
+def write_image(image, destination, output_format, params):
+    """
+    编码图片并写入文件路径或可写流
+
+    不支持随机访问的流（管道、套接字、HTTP 响应等）先编码到内存再一次写入；
+    开启诊断时同样先编码到内存，以分别统计编码和写入耗时。
+    """
+    is_path = isinstance(destination, (str, os.PathLike))
+    seekable = is_path or _is_seekable(destination)
+    if seekable and not profiler.enabled:
+        image.save(destination, output_format, **params)
+        return
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, output_format, **params)
+    encoded = time.perf_counter()
+    if is_path:
+        with open(destination, 'wb') as f:
+            f.write(buffer.getbuffer())
+    else:
+        destination.write(buffer.getbuffer())
+    if profiler.enabled:
+        profiler.record('export.encode', start, encoded - start)
+        profiler.record('export.write', encoded, time.perf_counter() - encoded)
+
+
+def _is_seekable(stream):
+    try:
+        return stream.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def export_image(image, name, settings, options, output_dir):
+    """导出一张图片，返回输出路径"""
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    metadata = read_metadata(image)
+    result = render_export(image, settings, options, metadata)
+
+    output_name = build_output_name(name, options['naming_option'],
+                                    options['naming_text'], options['output_format'])
+    output_path = os.path.join(output_dir, output_name)
+    output_format, params = encode_params(metadata, options, result.mode)
+    write_image(result, output_path, output_format, params)
+    return output_path
+
+
+def watermark_stream(source, destination, settings, options, name=None, index=1):
+    """
+    为内存中的图片添加水印并写入可写流，不经过临时文件
+
+    source 可以是 bytes、bytearray、memoryview 或可读的文件对象，
+    destination 为任意可写的文件对象。返回输出格式。
+    name 和 index 用于水印文本中的文件名和序号占位符，与 export_file 相同。
+    """
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    with pixel_limit_lifted(), open_image(source) as image:
+        check_pixel_limit(image.size, options['max_pixels'])
+        settings = bind_text_fields(settings, options, name, image=image, index=index)
+        metadata = read_metadata(image)
+        result = render_export(image, settings, options, metadata)
+
+    output_format, params = encode_params(metadata, options, result.mode)
+    write_image(result, destination, output_format, params)
+    return output_format
+
+
+def watermark_bytes(source, settings, options, name=None, index=1):
+    """为内存中的图片添加水印，返回编码后的图片数据"""
+    buffer = io.BytesIO()
+    watermark_stream(source, buffer, settings, options, name, index)
+    return buffer.getvalue()
+
+
+def split_template(template_data):
+    """把模板数据拆分为水印设置和导出设置，缺少的项使用默认值"""
+    settings = {key: template_data.get(key, value) for key, value in DEFAULT_SETTINGS.items()}
+    options = {key: template_data.get(key, value)
+               for key, value in DEFAULT_EXPORT_OPTIONS.items()}
+    return settings, options
+
+
+def check_pixel_limit(size, max_pixels):
+    """按像素上限策略检查图片尺寸，超出时抛出 DecompressionBombError"""
+    pixels = size[0] * size[1]
+    if max_pixels is not None and pixels > max_pixels:
+        raise Image.DecompressionBombError(
+            f"图片像素数 {pixels} 超过上限 {max_pixels}，"
+            f"超大 TIFF 请选择 TIFF 输出以使用分块导出")
+
+
+@contextmanager
+def pixel_limit_lifted():
+    """
+    在范围内关闭 Pillow 全局的解压炸弹检查，像素上限改由调用方的策略检查
+
+    TIFF 在 load() 时还会再检查一次，因此打开和解码都要在这个范围内进行。
+    多个线程可以同时进入，最后一个离开时才恢复原来的上限。
+    """
+    global _pixel_limit_holders, _saved_pixel_limit
+    with _pixel_limit_lock:
+        if _pixel_limit_holders == 0:
+            _saved_pixel_limit = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = None
+        _pixel_limit_holders += 1
+    try:
+        yield
+    finally:
+        with _pixel_limit_lock:
+            _pixel_limit_holders -= 1
+            if _pixel_limit_holders == 0:
+                Image.MAX_IMAGE_PIXELS = _saved_pixel_limit
+
+
+def open_image(source):
+    """
+    只读取文件头打开图片，像素上限由调用方的策略检查
+
+    source 可以是文件路径、可读的文件对象，或 bytes、bytearray、memoryview。
+    解码超过 Pillow 默认上限的 TIFF 时，需要在 pixel_limit_lifted() 范围内进行。
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with pixel_limit_lifted():
+        return Image.open(source)
+
+
+def export_file(path, name, settings, options, output_dir, index=1):
+    """
+    从文件导出一张图片，超大 TIFF 自动使用分块导出，返回输出路径
+
+    index 为批量导出中的序号，用于水印文本中的 {index} 占位符。
+    设置了多规格输出（renditions）时返回输出路径列表。
+    """
+    import jpeg_patch
+    import tiled_export
+
+    options = {**DEFAULT_EXPORT_OPTIONS, **options}
+    with pixel_limit_lifted(), open_image(path) as image:
+        settings = bind_text_fields(settings, options, name, path, image, index)
+        if options['renditions']:
+            check_pixel_limit(image.size, options['max_pixels'])
+            return export_renditions(image, name, settings, options, output_dir)
+
+        if tiled_export.wants_tiled(image, options):
+            tiled_export.check_tiled_layout(image)
+            check_pixel_limit(image.size, options['tiled_max_pixels'])
+            return tiled_export.export_tiled(image, path, name, settings, options, output_dir)
+
+        if jpeg_patch.can_patch(image, options):
+            output_path = jpeg_patch.export_patched(image, path, name, settings, options,
+                                                    output_dir)
+            if output_path is not None:
+                return output_path
+
+        check_pixel_limit(image.size, options['max_pixels'])
+        return export_image(image, name, settings, options, output_dir)
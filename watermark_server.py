@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+水印服务 - 在本机提供 HTTP 接口，供其他程序调用水印功能
+
+用法:
+    python watermark_server.py --port 8765 --workers 4
+    curl --data-binary @photo.jpg -o out.jpg \\
+        "http://127.0.0.1:8765/watermark?text=版权所有&output_format=JPEG"
+    curl http://127.0.0.1:8765/metrics
+
+    python watermark_server.py --load-test 200 --concurrency 8   # 本机压力测试
+
+接口:
+    POST /watermark  请求体为图片数据，水印参数通过查询参数传入（与模板中的
+                     字段相同，也可以用 template=名称 使用已保存的模板），
+                     返回加好水印的图片
+    GET  /metrics    请求计数、排队情况和延迟分位数（JSON）
+
+图片在预先启动的工作进程中处理，工作进程启动时加载字体，并在进程内缓存渲染计划
+和水印图章，每个请求只传递图片数据和参数。排队的请求数达到上限时立即返回 429，
+处理超时返回 504，请求无效（参数错误、缺少 Content-Length、无法识别的图片）返回 400，
+其他未预料的错误返回 500。
+"""
+
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from PIL import Image
+
+import watermark_engine
+from template_library import TemplateLibrary
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_TIMEOUT = 30.0
+
+# 请求体大小上限（字节）
+MAX_BODY_BYTES = 100 * 1024 * 1024
+
+# 工作进程启动时预先加载的字号
+WARM_FONT_SIZES = (24, 36, 48, 72)
+
+# 用于计算延迟分位数的最近请求数
+LATENCY_WINDOW = 10_000
+
+# 每个工作进程缓存的渲染计划数
+WORKER_PLAN_CACHE_SIZE = 64
+
+# 可以通过查询参数修改的导出设置
+REQUEST_OPTIONS = ('output_format', 'quality', 'resize_mode', 'resize_value')
+
+# 布尔参数（如 shadow）可以使用的写法
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off', '')
+
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'TIFF': 'image/tiff'}
+
+# 工作进程内的渲染计划缓存：请求参数摘要 -> 渲染计划
+_worker_plans = OrderedDict()
+
+
+def _init_worker(font_sizes):
+    """工作进程初始化：预先加载字体"""
+    watermark_engine.warm_up_fonts(font_sizes)
+
+
+def _ping():
+    return os.getpid()
+
+
+def request_key(settings, options):
+    """请求参数的摘要，工作进程按它缓存渲染计划"""
+    return json.dumps([settings, {key: options[key] for key in REQUEST_OPTIONS}],
+                      sort_keys=True, ensure_ascii=False)
+
+
+def _worker_plan(key, settings, options):
+    """取出工作进程缓存的渲染计划，没有时编译并缓存"""
+    plan = _worker_plans.get(key)
+    if plan is None:
+        plan = watermark_engine.compile_plan(settings, options)
+        _worker_plans[key] = plan
+        while len(_worker_plans) > WORKER_PLAN_CACHE_SIZE:
+            _worker_plans.popitem(last=False)
+    else:
+        _worker_plans.move_to_end(key)
+    return plan
+
+
+def watermark_job(data, key, settings, options):
+    """
+    在工作进程中为一张图片添加水印，返回编码后的图片数据
+
+    只传递请求参数（很小），渲染计划和图章由每个工作进程自己编译并缓存，
+    相同参数的后续请求不再需要传输或渲染图章。
+    """
+    plan = _worker_plan(key, settings, options)
+    return watermark_engine.watermark_bytes(data, plan, options)
+
+
+def parse_value(value, default):
+    """按默认值的类型转换查询参数，布尔值接受 1/0、true/false、yes/no、on/off"""
+    if isinstance(default, bool):
+        lowered = value.strip().lower()
+        if lowered in TRUE_VALUES:
+            return True
+        if lowered in FALSE_VALUES:
+            return False
+        raise ValueError(value)
+    return type(default)(value)
+
+
+def parse_request_params(query, library=None):
+    """把查询参数转换为 (水印设置, 导出设置)，参数无效时抛出 ValueError"""
+    params = dict(parse_qsl(query, keep_blank_values=True))
+    template = params.pop('template', None)
+    if template:
+        # 只取模板数据，渲染计划由工作进程编译并缓存，不占用 HTTP 线程
+        library = library or TemplateLibrary()
+        try:
+            settings, options = watermark_engine.split_template(library.get(template)['data'])
+        except KeyError:
+            raise ValueError(f"模板不存在: {template}")
+    else:
+        settings = dict(watermark_engine.DEFAULT_SETTINGS)
+        options = dict(watermark_engine.DEFAULT_EXPORT_OPTIONS)
+
+    for key, value in params.items():
+        if key in watermark_engine.DEFAULT_SETTINGS:
+            target, default = settings, watermark_engine.DEFAULT_SETTINGS[key]
+        elif key in REQUEST_OPTIONS:
+            target, default = options, watermark_engine.DEFAULT_EXPORT_OPTIONS[key]
+        else:
+            raise ValueError(f"未知参数: {key}")
+        try:
+            target[key] = parse_value(value, default)
+        except ValueError:
+            raise ValueError(f"参数 {key} 的值无效: {value}")
+
+    options['output_format'] = options['output_format'].upper()
+    if options['output_format'] not in watermark_engine.OUTPUT_EXTENSIONS:
+        raise ValueError(f"不支持的输出格式: {options['output_format']}")
+    if options['resize_mode'] not in watermark_engine.RESIZE_MODES:
+        raise ValueError(f"不支持的缩放方式: {options['resize_mode']}")
+    try:
+        watermark_engine.parse_color(settings['color'], settings['opacity'])
+        watermark_engine.parse_style(settings)
+    except ValueError:
+        raise ValueError(f"无效的颜色: {settings['color']}, {settings['shadow_color']}, "
+                         f"{settings['stroke_color']}")
+    return settings, options
+
+
+class Metrics:
+    """请求计数和延迟统计（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'ok': 0, 'bad_request': 0, 'rejected': 0,
+                       'timeout': 0, 'error': 0}
+        self.latency = deque(maxlen=LATENCY_WINDOW)
+
+    def count(self, name, latency=None):
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts[name] += 1
+            if latency is not None:
+                self.latency.append(latency * 1000)
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+            latency = sorted(self.latency)
+
+        percentiles = {}
+        if latency:
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99)):
+                index = min(len(latency) - 1, int(fraction * len(latency)))
+                percentiles[name] = round(latency[index], 2)
+            percentiles['max'] = round(latency[-1], 2)
+            percentiles['mean'] = round(sum(latency) / len(latency), 2)
+        return {'counts': counts, 'latency_ms': percentiles, 'latency_samples': len(latency)}
+
+
+class WatermarkService:
+    """可嵌入的水印服务：工作进程池 + HTTP 服务器"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT,
+                 templates_dir=watermark_engine.TEMPLATES_DIR):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        # 模板库按索引查找，模板文件修改后自动生效
+        self.library = TemplateLibrary(templates_dir)
+        self.metrics = Metrics()
+
+        # 正在处理和排队的任务总数不超过 工作进程数 + 队列长度
+        self.capacity = self.workers + queue_size
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(WARM_FONT_SIZES,))
+        self._start_workers()
+
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+        self._thread = None
+
+    def _start_workers(self):
+        """立即启动全部工作进程，避免第一批请求承担进程启动的耗时"""
+        futures = [self.pool.submit(_ping) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def submit(self, data, settings, options):
+        """提交任务，队列已满时返回 None"""
+        if not self.slots.acquire(blocking=False):
+            return None
+        with self.in_flight_lock:
+            self.in_flight += 1
+        try:
+            future = self.pool.submit(watermark_job, data, request_key(settings, options),
+                                      settings, options)
+        except Exception:
+            self._release()
+            raise
+        # 超时的任务仍会在工作进程中运行完，完成后才释放名额
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        with self.in_flight_lock:
+            in_flight = self.in_flight
+        snapshot.update({'workers': self.workers, 'capacity': self.capacity,
+                         'in_flight': in_flight})
+        return snapshot
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """在后台线程中运行 HTTP 服务器"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止服务并关闭工作进程"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        if self._thread is not None:
+            self._thread.join()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # 每个请求都输出日志会拖慢压力测试，只记录错误
+        pass
+
+    def _send(self, status, body, content_type='application/json; charset=utf-8',
+              headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self._send(status, body, headers=headers)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/metrics':
+            self._send_json(200, self.server.service.metrics_snapshot())
+        else:
+            self._send_json(404, {'error': '未知路径'})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlsplit(self.path)
+        if url.path != '/watermark':
+            self._send_json(404, {'error': '未知路径'})
+            return
+
+        try:
+            self._watermark(service, url)
+        except ConnectionError:
+            # 客户端已断开，无法再发送响应
+            self.close_connection = True
+        except Exception as e:
+            # 任何未预料的错误都返回 JSON 格式的 500，客户端不会一直等待
+            service.metrics.count('error')
+            self.log_error("处理失败: %s", e)
+            self.close_connection = True
+            self._send_json(500, {'error': str(e)})
+
+    def _watermark(self, service, url):
+        """处理 POST /watermark"""
+        start = time.perf_counter()
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            # 无法确定请求体的长度，连接上剩余的数据也无法再读取
+            self.close_connection = True
+            service.metrics.count('bad_request')
+            self._send_json(400, {'error': '缺少或无效的 Content-Length'})
+            return
+        if length <= 0 or length > MAX_BODY_BYTES:
+            self.close_connection = True
+            service.metrics.count('bad_request')
+            self._send_json(413 if length > 0 else 400, {'error': '请求体为空或过大'})
+            return
+        data = self.rfile.read(length)
+
+        try:
+            settings, options = parse_request_params(url.query, service.library)
+        except ValueError as e:
+            service.metrics.count('bad_request')
+            self._send_json(400, {'error': str(e)})
+            return
+
+        future = service.submit(data, settings, options)
+        if future is None:
+            service.metrics.count('rejected')
+            self._send_json(429, {'error': '服务繁忙，请稍后重试'}, {'Retry-After': '1'})
+            return
+
+        try:
+            result = future.result(timeout=service.timeout)
+        except FutureTimeout:
+            service.metrics.count('timeout')
+            self._send_json(504, {'error': f'处理超时（{service.timeout:g} 秒）'})
+            return
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            # 无法识别的图片数据或超出像素上限
+            service.metrics.count('bad_request')
+            self._send_json(400, {'error': str(e)})
+            return
+
+        latency = time.perf_counter() - start
+        service.metrics.count('ok', latency)
+        self._send(200, result, CONTENT_TYPES[options['output_format']],
+                   {'X-Processing-Time': f"{latency * 1000:.1f}ms"})
+
+
+def load_test(url, data, query, total, concurrency):
+    """向服务并发发送请求，返回各状态码的数量和客户端延迟（毫秒）"""
+    statuses = {}
+    latency = []
+    lock = threading.Lock()
+    remaining = iter(range(total))
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            request = urllib.request.Request(f"{url}/watermark?{query}", data=data,
+                                             method='POST')
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latency.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, sorted(latency)
+
+
+def run_load_test(args):
+    """在随机端口启动服务并进行压力测试"""
+    if args.image:
+        with open(args.image, 'rb') as f:
+            data = f.read()
+    else:
+        buffer = io.BytesIO()
+        Image.linear_gradient('L').resize((3000, 2000)).convert('RGB').save(buffer, 'JPEG')
+        data = buffer.getvalue()
+
+    service = WatermarkService(port=0, workers=args.workers, queue_size=args.queue_size,
+                               timeout=args.timeout, templates_dir=args.templates_dir).start()
+    try:
+        print(f"服务地址 {service.url}，{service.workers} 个工作进程，"
+              f"{args.load_test} 个请求，并发 {args.concurrency}")
+        start = time.perf_counter()
+        statuses, latency = load_test(service.url, data, args.query, args.load_test,
+                                      args.concurrency)
+        elapsed = time.perf_counter() - start
+    finally:
+        metrics = service.metrics_snapshot()
+        service.stop()
+
+    print(f"状态码: {dict(sorted(statuses.items()))}")
+    print(f"吞吐量: {statuses.get(200, 0) / elapsed:.1f} 张/秒")
+    if latency:
+        print(f"客户端延迟 p50 {latency[len(latency) // 2]:.1f} ms，"
+              f"p95 {latency[min(len(latency) - 1, int(0.95 * len(latency)))]:.1f} ms")
+    print(f"服务端统计: {json.dumps(metrics, ensure_ascii=False)}")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="本机水印 HTTP 服务")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="监听地址")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="监听端口")
+    parser.add_argument('--workers', type=int, help="工作进程数，默认为 CPU 核数")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="排队请求数上限，超出时返回 429")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="单个请求的处理超时（秒）")
+    parser.add_argument('--templates-dir', default=watermark_engine.TEMPLATES_DIR,
+                        help="模板文件夹")
+    parser.add_argument('--load-test', type=int, metavar='N',
+                        help="启动临时服务并发送 N 个请求进行压力测试")
+    parser.add_argument('--concurrency', type=int, default=8, help="压力测试的并发数")
+    parser.add_argument('--image', help="压力测试使用的图片，默认生成 6MP 测试图")
+    parser.add_argument('--query', default='text=Benchmark&output_format=JPEG',
+                        help="压力测试的查询参数")
+    args = parser.parse_args()
+
+    if args.load_test:
+        run_load_test(args)
+        return
+
+    service = WatermarkService(args.host, args.port, args.workers, args.queue_size,
+                               args.timeout, args.templates_dir)
+    print(f"水印服务已启动: {service.url}（{service.workers} 个工作进程）")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()